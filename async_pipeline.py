@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+
+#########################################################################
+# File      async_pipeline.py                                           #
+# Author    Adlai Gordon                                                #
+# Purpose   Process a Google Photos Takeout directory like              #
+#             process_google_photos.py, as a pipeline of asyncio stages #
+#           scan + match -> read metadata -> prepare -> write -> move,  #
+#             with a small bounded queue of batches between stages, so  #
+#             exiftool, disk and CPU work overlap while memory stays    #
+#             flat. Results and reports are the same as a normal run    #
+# Usage     ./async_pipeline.py <directory> [--workers N] [--recursive] #
+# Dependencies                                                          #
+#           exiftool, and everything process_google_photos.py needs     #
+#########################################################################
+
+import argparse
+import asyncio
+import functools
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from content_index import ContentIndex
+from exiftool_pool import AsyncExifToolPool
+from file_plan import FilePlan, UndoLog
+from gpx_track_index import GpxTrackIndex, default_max_gap
+import process_google_photos
+from process_google_photos import (
+    ExifWritePlan, JournaledList, ReportJournal, apply_file_plan, cache_file_metadata, cached_file_metadata,
+    create_matched_file_list, desired_datetime_format, plan_duplicate_groups, exiftool_read_command, exiftool_write_commands,
+    exiftool_write_results, group_file_paths, list_input_files, metadata_batch_size, metadata_records,
+    plan_prepared_group, plan_unprocessable_groups, plan_written_files, prepare_group, print_ambiguous_matches,
+    print_report, read_group_sidecar, read_native_metadata, record_duplicates, record_written_files, resolve_sidecar_times, resume_renamed_files, resumed_file_records, run_state_filename,
+    split_batches, write_batch_size, write_natively, write_run_report)
+from name_allocator import NameAllocator
+from run_metrics import metrics, run_profiled
+from run_state import RunState
+
+# Files per batch passed between the stages
+pipeline_batch_size = metadata_batch_size
+
+# Batches waiting between two stages before the earlier stage has to wait
+default_queue_size = 2
+
+
+def split_group_batches(groups, batch_size):
+    # Batches of about batch_size files, in group order. A batch only ends
+    # after the last group using any of its sidecars, because the sidecar
+    # is archived when the batch is moved
+    last_user = {file_group['json']: index for index, (base_name, file_group) in enumerate(groups)}
+    batch, batch_files, reach = [], 0, -1
+    for index, (base_name, file_group) in enumerate(groups):
+        batch.append((base_name, file_group))
+        batch_files += len(file_group['img'])
+        reach = max(reach, last_user[file_group['json']])
+        if batch_files >= batch_size and reach <= index:
+            yield batch
+            batch, batch_files = [], 0
+    if batch:
+        yield batch
+
+
+def new_batch(groups, plan=None):
+    return {
+        'groups': groups,
+        'plan': plan or FilePlan(),
+        'resumed_files': {},
+        'file_metadata': {},
+        'write_plan': ExifWritePlan(),
+        'pending_files': [],
+        'write_results': {},
+    }
+
+
+class TakeoutPipeline:
+    """The stages of one directory run and the state they share.
+
+    Blocking work runs on threads: parsing, preparing and native reads and
+    writes on `workers` threads, while the run state, the report, the name
+    allocator and every move belong to a single file thread, in batch order.
+    Every name is handed out there in group order, like process_matched_files
+    does, which keeps the result the same.
+    """
+
+    def __init__(self, directory, workers, journal, run_state, missing_files, error_files, error_renaming_files,
+                 extension_modifications, undo_log, exiftool, file_thread, worker_threads, recursive=False, queue_size=default_queue_size,
+                 content_index=None):
+        self.directory = directory
+        self.workers = workers
+        self.journal = journal
+        self.run_state = run_state
+        self.missing_files = missing_files
+        self.error_files = error_files
+        self.error_renaming_files = error_renaming_files
+        self.extension_modifications = extension_modifications
+        self.undo_log = undo_log
+        self.exiftool = exiftool
+        self.file_thread = file_thread
+        self.worker_threads = worker_threads
+        self.recursive = recursive
+        self.queue_size = queue_size
+        self.content_index = content_index
+        self.name_allocator = NameAllocator()
+
+    def on_file_thread(self, function, *args):
+        return asyncio.get_running_loop().run_in_executor(self.file_thread, functools.partial(function, *args))
+
+    def on_worker_thread(self, function, *args):
+        return asyncio.get_running_loop().run_in_executor(self.worker_threads, functools.partial(function, *args))
+
+    async def run(self):
+        queues = [asyncio.Queue(self.queue_size) for _ in range(4)]
+        tasks = [
+            asyncio.ensure_future(self.scan_and_match(queues[0])),
+            asyncio.ensure_future(self.stage(self.read_metadata, queues[0], queues[1])),
+            asyncio.ensure_future(self.stage(self.prepare, queues[1], queues[2])),
+            asyncio.ensure_future(self.stage(self.write, queues[2], queues[3])),
+            asyncio.ensure_future(self.stage(self.move, queues[3], None)),
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    async def stage(self, work, inbox, outbox):
+        # Batches are handled one at a time, in the order they arrive, and
+        # None marks the end of the run
+        while True:
+            batch = await inbox.get()
+            if batch is None:
+                break
+            await work(batch)
+            metrics.progress()
+            if outbox is not None:
+                await outbox.put(batch)
+        if outbox is not None:
+            await outbox.put(None)
+
+    async def scan_and_match(self, outbox):
+        # Matching needs the whole listing, so the batches only start once
+        # every name is known
+        with metrics.timer('scan'):
+            files, matched_files = await asyncio.to_thread(list_input_files, self.directory, self.recursive)
+        if matched_files is None:
+            ambiguous_matches = []
+            with metrics.timer('match'):
+                matched_files = await asyncio.to_thread(create_matched_file_list, files, ambiguous_matches)
+            print_ambiguous_matches(ambiguous_matches)
+
+        # Groups that can't be processed are moved first, without reading anything
+        plan = FilePlan()
+        groups_to_update = await self.on_file_thread(plan_unprocessable_groups, plan, self.directory, matched_files, self.directory, self.name_allocator)
+        if process_google_photos.dedup_mode:
+            # Every file has to be compared before the first batch is processed
+            groups_to_update = await self.on_file_thread(plan_duplicate_groups, plan, self.directory, groups_to_update, self.directory,
+                                                         self.content_index, self.run_state, self.name_allocator, self.workers)
+        await outbox.put(new_batch([], plan))
+
+        for groups in split_group_batches(groups_to_update, pipeline_batch_size):
+            await outbox.put(new_batch(groups))
+        await outbox.put(None)
+
+    async def read_metadata(self, batch):
+        file_paths = group_file_paths(self.directory, batch['groups'])
+        batch['resumed_files'] = await self.on_file_thread(resumed_file_records, self.run_state, file_paths)
+
+        file_metadata, file_paths = await asyncio.to_thread(
+            cached_file_metadata, [f for f in file_paths if f not in batch['resumed_files']])
+        for batch_metadata in await asyncio.gather(*[self.read_chunk(chunk) for chunk in split_batches(file_paths, metadata_batch_size, self.workers)]):
+            file_metadata.update(batch_metadata)
+            await asyncio.to_thread(cache_file_metadata, batch_metadata)
+        batch['file_metadata'] = file_metadata
+
+    async def read_chunk(self, chunk):
+        # JPEG and HEIC headers are read on a thread, exiftool gets the rest
+        entries, exiftool_batch = await self.on_worker_thread(read_native_metadata, chunk)
+        file_metadata = metadata_records([], entries, "")
+        if exiftool_batch:
+            try:
+                with metrics.timer('exiftool-read'):
+                    result = await self.exiftool.run(exiftool_read_command(exiftool_batch), check=False)
+                metrics.count('exiftool-read-files', len(exiftool_batch))
+                entries = json.loads(result.stdout) if result.stdout.strip() else []
+                errors = result.stderr.replace("\n", "").strip()
+            except Exception as e:
+                entries, errors = [], str(e).replace("\n", "").strip()
+            file_metadata.update(metadata_records(exiftool_batch, entries, errors))
+        return file_metadata
+
+    async def prepare(self, batch):
+        sidecars = await asyncio.gather(*[self.on_worker_thread(read_group_sidecar, self.directory, file_group)
+                                          for base_name, file_group in batch['groups']])
+        resolved_times = await self.on_worker_thread(resolve_sidecar_times, [sidecar_metadata for sidecar_path, sidecar_metadata in sidecars])
+        prepared_groups = await asyncio.gather(*[
+            self.on_worker_thread(prepare_group, self.directory, file_group, batch['file_metadata'], batch['resumed_files'], sidecar, resolved_time)
+            for (base_name, file_group), sidecar, resolved_time in zip(batch['groups'], sidecars, resolved_times)])
+        for group, prepared_group in zip(batch['groups'], prepared_groups):
+            plan_prepared_group(batch['write_plan'], batch['pending_files'], group, prepared_group)
+
+    async def write(self, batch):
+        pending_by_path = {pending[3]: pending for pending in batch['pending_files']}
+        for chunk_results in await asyncio.gather(*[self.write_chunk(chunk, pending_by_path) for chunk in split_batches(batch['write_plan'].writes, write_batch_size, self.workers)]):
+            batch['write_results'].update(chunk_results)
+
+    async def write_chunk(self, chunk, pending_by_path):
+        # Native writers first, the files they leave go to exiftool
+        results, exiftool_batch = await self.on_worker_thread(write_natively, chunk)
+        if exiftool_batch:
+            try:
+                with metrics.timer('exiftool-write'):
+                    completed = await self.exiftool.run_many(exiftool_write_commands(exiftool_batch))
+                metrics.count('exiftool-write-files', len(exiftool_batch))
+            except Exception as e:
+                completed = e
+            results.update(exiftool_write_results(exiftool_batch, completed))
+        # Recorded on the file thread as each chunk is done, like a normal run does per batch
+        await self.on_file_thread(record_written_files, pending_by_path, results, self.run_state)
+        return results
+
+    async def move(self, batch):
+        await self.on_file_thread(self.move_batch, batch)
+
+    def move_batch(self, batch):
+        plan_written_files(batch['plan'], batch['pending_files'], batch['write_results'], self.run_state, self.name_allocator, self.directory, self.directory)
+        apply_file_plan(batch['plan'], self.journal, self.run_state, self.missing_files, self.error_files, self.error_renaming_files,
+                        self.extension_modifications, os.path.join(self.directory, "error-renaming"), self.undo_log, self.content_index)
+
+
+def process_directory_async(directory, progress_interval, workers=1, recursive=False, queue_size=default_queue_size):
+    """process_directory run through TakeoutPipeline, returning the same report lists."""
+    return asyncio.run(_process_directory_async(directory, progress_interval, workers, recursive, queue_size))
+
+
+async def _process_directory_async(directory, progress_interval, workers, recursive, queue_size):
+    report_timestamp = datetime.now().strftime(desired_datetime_format)
+    metrics.reset()
+    metrics.progress_interval = progress_interval
+    os.makedirs(os.path.join(directory, "error-missing-sidecar"), exist_ok=True)
+    os.makedirs(os.path.join(directory, "error-renaming"), exist_ok=True)
+    extension_modifications = {}
+
+    journal = ReportJournal(os.path.join(directory, f"report_{report_timestamp}.jsonl"))
+    missing_files = JournaledList(journal, 'error-missing-sidecars')
+    error_files = JournaledList(journal, 'error-processing')
+    error_renaming_files = JournaledList(journal, 'error-renaming')
+    undo_log = UndoLog(os.path.join(directory, f"undo_{report_timestamp}.jsonl"))
+
+    # The run state is opened on the thread that will use it
+    file_thread = ThreadPoolExecutor(max_workers=1)
+    worker_threads = ThreadPoolExecutor(max_workers=workers)
+    loop = asyncio.get_running_loop()
+    run_state = await loop.run_in_executor(file_thread, RunState, os.path.join(directory, run_state_filename))
+    content_index = ContentIndex.for_library(os.path.join(directory, "successfully-processed")) if process_google_photos.dedup_mode else None
+
+    try:
+        await loop.run_in_executor(file_thread, resume_renamed_files, directory, run_state, journal, extension_modifications)
+
+        async with AsyncExifToolPool(size=workers, timeout=60) as exiftool:
+            pipeline = TakeoutPipeline(directory, workers, journal, run_state, missing_files, error_files, error_renaming_files,
+                                       extension_modifications, undo_log, exiftool, file_thread, worker_threads, recursive, queue_size, content_index)
+            await pipeline.run()
+        if process_google_photos.dedup_mode == 'link':
+            await loop.run_in_executor(file_thread, content_index.link_duplicates)
+        await loop.run_in_executor(file_thread, run_state.clear_finished)
+    finally:
+        if content_index:
+            await loop.run_in_executor(file_thread, functools.partial(record_duplicates, journal, content_index, run_over=True))
+            content_index.close()
+        await loop.run_in_executor(file_thread, run_state.close)
+        file_thread.shutdown()
+        worker_threads.shutdown()
+        journal.close()
+        write_run_report(directory, journal.path, report_timestamp)
+
+    return missing_files, error_files, error_renaming_files, extension_modifications
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Process a directory from Google Photos Takeout with the asyncio pipeline")
+    arg_parser.add_argument('directory')
+    arg_parser.add_argument('--workers', type=int, default=1,
+                            help="number of exiftool processes and preparing threads")
+    arg_parser.add_argument('--recursive', action='store_true',
+                            help="also process every folder below the directory, matching sidecars across folders")
+    arg_parser.add_argument('--gpx', metavar='DIRECTORY',
+                            help="place photos without a location in their sidecar using the GPX tracks in this directory")
+    arg_parser.add_argument('--gpx-max-gap', type=float, default=default_max_gap, metavar='SECONDS',
+                            help="longest gap between track points that is interpolated over, and furthest a photo can be from one")
+    arg_parser.add_argument('--dedup', choices=['skip', 'link'],
+                            help="move copies of a file already processed (in this run or the library) to duplicates instead of "
+                                 "processing them again, with link as hard links to the copy that was kept")
+    arg_parser.add_argument('--queue-size', type=int, default=default_queue_size,
+                            help=f"batches of {pipeline_batch_size} files waiting between two stages")
+    arg_parser.add_argument('--profile', metavar='PATH',
+                            help="save a profile of the run: a trace of every stage on every thread for PATH.json "
+                                 "(chrome://tracing, Perfetto), cProfile stats of the event loop thread otherwise")
+    args = arg_parser.parse_args()
+
+    process_google_photos.dedup_mode = args.dedup
+    if args.gpx:
+        process_google_photos.gpx_track_index = GpxTrackIndex.from_directory(args.gpx, args.gpx_max_gap)
+        print(f"{len(process_google_photos.gpx_track_index)} track points loaded from {len(process_google_photos.gpx_track_index.track_names)} GPX files")
+
+    progress_interval = 5
+    missing_files, error_files, error_renaming_files, extension_modifications = run_profiled(
+        args.profile, process_directory_async, args.directory, progress_interval, max(1, args.workers), args.recursive, max(1, args.queue_size))
+    print(f"\n\nCOMPLETE: {args.directory}\n\n")
+    print_report(missing_files, error_files, error_renaming_files, extension_modifications)
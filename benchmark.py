@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+
+#########################################################################
+# File      benchmark.py                                                #
+# Author    Adlai Gordon                                                #
+# Purpose   Measure how fast the scripts get through a Takeout, on      #
+#             synthetic trees of 1k, 100k or 1M files generated the     #
+#             same way every time (same seed, same names and dates)     #
+#           Trees have JPEG/HEIC/MP4 stubs, every sidecar naming        #
+#             variant, live photos, photos with and without a location, #
+#             missing sidecars and broken files                         #
+#           Every run gets a fresh tree and its results (time, files/s, #
+#             peak memory, the run's metrics file) go to a JSON file    #
+#             next to the trees, that --compare checks a later version  #
+#             against                                                   #
+# Usage     ./benchmark.py [--sizes 1k 100k 1m] [--tools ...]           #
+#             [--workers N] [--fake-exiftool [--exiftool-delay S]]      #
+#             [--output PATH] [--compare EARLIER.json]                  #
+#           ./benchmark.py --generate <directory> [--sizes 1k]          #
+#########################################################################
+
+import argparse
+import glob
+import json
+import os
+import platform
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+sizes = {'1k': 1000, '100k': 100_000, '1m': 1_000_000}
+
+script_directory = os.path.dirname(os.path.abspath(__file__))
+
+# Share of groups of each kind in a generated tree
+group_kinds = {
+    'jpg': 30,
+    'jpg-exif-date': 10,
+    'no-extension-sidecar': 8,
+    'supplemental': 8,
+    'supplemental-truncated': 4,
+    'duplicate': 4,
+    'long-name': 3,
+    'edited': 4,
+    'live': 10,
+    'live-letter': 4,
+    'video': 8,
+    'missing-sidecar': 4,
+    'corrupt': 3,
+    'album-copy': 3,
+}
+
+# Share of sidecars with a location, the rest have Takeout's 0,0
+gps_share = 0.6
+
+# Where located photos are, a little spread around each place
+places = [(40.71, -74.0), (51.5, -0.12), (48.86, 2.35), (35.68, 139.69), (-33.87, 151.21),
+          (28.61, 77.21), (37.77, -122.42), (-22.91, -43.17), (55.75, 37.62), (1.35, 103.82)]
+
+# Bytes of image data in every stub
+default_image_size = 4096
+
+# GPX files per takeout file, and the points in each
+gpx_share = 0.01
+gpx_points = 120
+
+takeout_start = int(datetime(2005, 1, 1, tzinfo=timezone.utc).timestamp())
+takeout_end = int(datetime(2024, 12, 31, tzinfo=timezone.utc).timestamp())
+
+
+def tiff_with_date(date_taken):
+    # Little-endian TIFF: IFD0 pointing to an Exif IFD with DateTimeOriginal
+    value = date_taken.encode('ascii') + b'\0'
+    ifd0 = struct.pack('<H', 1) + struct.pack('<HHII', 0x8769, 4, 1, 26) + struct.pack('<I', 0)
+    exif_ifd = struct.pack('<H', 1) + struct.pack('<HHII', 0x9003, 2, len(value), 44) + struct.pack('<I', 0)
+    return b'II*\0' + struct.pack('<I', 8) + ifd0 + exif_ifd + value
+
+
+def image_data(content, image_size):
+    # Different for every content name, so only real copies hash the same
+    label = content.encode('utf-8')[:image_size]
+    return label + bytes(image_size - len(label))
+
+
+def jpeg_stub(image_size, date_taken=None, content=''):
+    parts = [b'\xff\xd8', b'\xff\xe0' + struct.pack('>H', 16) + b'JFIF\0\x01\x01\0\0\x01\0\x01\0\0']
+    if date_taken:
+        payload = b'Exif\0\0' + tiff_with_date(date_taken)
+        parts.append(b'\xff\xe1' + struct.pack('>H', len(payload) + 2) + payload)
+    parts.append(b'\xff\xda' + struct.pack('>H', 8) + b'\x01\x01\0\0\x3f\0')
+    parts.append(image_data(content, image_size))
+    parts.append(b'\xff\xd9')
+    return b''.join(parts)
+
+
+def iso_media_stub(brand, image_size, content=''):
+    # An ftyp box and the image or video data
+    ftyp = struct.pack('>I', 16) + b'ftyp' + brand + struct.pack('>I', 0)
+    return ftyp + struct.pack('>I', image_size + 8) + b'mdat' + image_data(content, image_size)
+
+
+def synthetic_groups(count, seed=0):
+    """The groups of a synthetic Takeout with about count files, without writing anything.
+
+    Each group is a dict with the 'kind', its 'images', the 'sidecar' every
+    image should be matched with (None when it has none) and the sidecar's
+    'timestamp' and 'position' (None for 0,0). An album copy also has
+    'copy_of', the group whose image it is a byte-for-byte copy of. The
+    same count and seed always give the same groups.
+    """
+    rng = random.Random(seed)
+    kinds, weights = list(group_kinds), list(group_kinds.values())
+    groups = []
+    originals = []
+    files = 0
+    number = 0
+    while files < count:
+        number += 1
+        kind = rng.choices(kinds, weights)[0]
+        taken = rng.randrange(takeout_start, takeout_end)
+        when = datetime.fromtimestamp(taken, timezone.utc)
+        if rng.random() < gps_share:
+            latitude, longitude = rng.choice(places)
+            position = (round(latitude + rng.uniform(-0.5, 0.5), 6), round(longitude + rng.uniform(-0.5, 0.5), 6))
+        else:
+            position = None
+
+        name = f"IMG_{number:07d}"
+        copy_of = None
+        if kind == 'album-copy':
+            if originals:
+                # Takeout exports a photo once for every album it's in
+                copy_of = rng.choice(originals)
+                taken, position = copy_of['timestamp'], copy_of['position']
+            else:
+                kind = 'jpg'
+
+        if kind == 'album-copy':
+            group_list = [([name + '.JPG'], name + '.JPG.json')]
+        elif kind in ('jpg', 'jpg-exif-date', 'corrupt'):
+            image = f"{'BAD' if kind == 'corrupt' else 'IMG'}_{number:07d}.JPG"
+            group_list = [([image], image + '.json')]
+        elif kind == 'no-extension-sidecar':
+            group_list = [([name + '.JPG'], name + '.json')]
+        elif kind == 'supplemental':
+            group_list = [([name + '.JPG'], name + '.JPG.supplemental-metadata.json')]
+        elif kind == 'supplemental-truncated':
+            image = f"PXL_{when:%Y%m%d_%H%M%S}{number % 1000:03d}.MP.jpg"
+            group_list = [([image], (image + '.supplemental-metadata')[:46] + '.json')]
+        elif kind == 'duplicate':
+            group_list = [([name + '.JPG'], name + '.JPG.json'), ([name + '(1).JPG'], name + '.JPG(1).json')]
+        elif kind == 'long-name':
+            image = f"Screenshot_{when:%Y%m%d-%H%M%S}_{number:07d} Internet Browser"
+            group_list = [([image + '.jpg'], image[:46] + '.json')]
+        elif kind == 'edited':
+            group_list = [([name + '.JPG'], name + '.JPG.json'), ([name + '-edited.JPG'], name + '.JPG.json')]
+        elif kind == 'live':
+            group_list = [([name + '.HEIC', name + '.MP4'], name + '.HEIC.json')]
+        elif kind == 'live-letter':
+            stem = f"{70759752381 + number}"
+            group_list = [([stem + '.HEIC', stem + 'C.MP4'], stem + '.json')]
+        elif kind == 'video':
+            group_list = [([f"VID_{number:07d}.MP4"], f"VID_{number:07d}.MP4.json")]
+        else:
+            group_list = [([name + '.JPG'], None)]
+
+        for images, sidecar in group_list:
+            group = {'kind': kind, 'images': images, 'sidecar': sidecar, 'timestamp': taken, 'position': position}
+            if copy_of:
+                group['copy_of'] = copy_of
+            elif kind in ('jpg', 'jpg-exif-date'):
+                originals.append(group)
+            groups.append(group)
+        files += sum(len(images) for images, sidecar in group_list)
+        files += len({sidecar for images, sidecar in group_list if sidecar})
+    return groups
+
+
+def image_bytes(kind, image, timestamp, image_size):
+    extension = os.path.splitext(image)[1].lower()
+    if kind == 'corrupt':
+        return b'not a jpeg' + image_data(image, image_size)
+    if extension in ('.jpg', '.jpeg'):
+        date_taken = None
+        if kind == 'jpg-exif-date':
+            date_taken = datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y:%m:%d %H:%M:%S')
+        return jpeg_stub(image_size, date_taken, image)
+    return iso_media_stub(b'heic' if extension == '.heic' else b'isom', image_size, image)
+
+
+def sidecar_json(image, timestamp, position):
+    latitude, longitude = position or (0.0, 0.0)
+    geo_data = {'latitude': latitude, 'longitude': longitude, 'altitude': 0.0,
+                'latitudeSpan': 0.0, 'longitudeSpan': 0.0}
+    return {
+        'title': image,
+        'description': '',
+        'imageViews': '0',
+        'creationTime': {'timestamp': str(timestamp + 86400)},
+        'photoTakenTime': {'timestamp': str(timestamp)},
+        'geoData': geo_data,
+        'geoDataExif': geo_data,
+        'url': 'https://photos.google.com/photo/' + image,
+    }
+
+
+def generate_takeout(directory, count, seed=0, image_size=default_image_size):
+    """Write a synthetic Takeout of about count files into directory, returning the number of files."""
+    os.makedirs(directory, exist_ok=True)
+    written = set()
+    for group in synthetic_groups(count, seed):
+        source = group.get('copy_of', group)
+        for image, source_image in zip(group['images'], source['images']):
+            with open(os.path.join(directory, image), 'wb') as file:
+                file.write(image_bytes(source['kind'], source_image, source['timestamp'], image_size))
+            written.add(image)
+        sidecar = group['sidecar']
+        if sidecar and sidecar not in written:
+            with open(os.path.join(directory, sidecar), 'w') as file:
+                json.dump(sidecar_json(group['images'][0], group['timestamp'], group['position']), file, indent=2)
+            written.add(sidecar)
+    return len(written)
+
+
+def generate_gpx(directory, count, seed=0):
+    """Write count GPX tracks of gpx_points points each, returning count."""
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    for number in range(count):
+        start = rng.randrange(takeout_start, takeout_end)
+        latitude, longitude = rng.choice(places)
+        points = []
+        for point in range(gpx_points):
+            when = datetime.fromtimestamp(start + point * 10, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+            latitude += rng.uniform(-0.0005, 0.0005)
+            longitude += rng.uniform(-0.0005, 0.0005)
+            points.append(f'      <trkpt lat="{latitude:.6f}" lon="{longitude:.6f}"><ele>10.0</ele><time>{when}</time></trkpt>')
+        with open(os.path.join(directory, f"track_{number:06d}.gpx"), 'w') as file:
+            file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                       '<gpx version="1.1" creator="benchmark.py" xmlns="http://www.topografix.com/GPX/1/1">\n'
+                       f'  <trk><name>Track {number}</name><trkseg>\n' + '\n'.join(points) + '\n  </trkseg></trk>\n</gpx>\n')
+    return count
+
+
+def script(name):
+    return os.path.join(script_directory, name)
+
+
+# How each tool is run on a fresh directory
+tool_commands = {
+    'process': lambda directory, workers: [sys.executable, script('process_google_photos.py'), directory, '--workers', str(workers)],
+    'async': lambda directory, workers: [sys.executable, script('async_pipeline.py'), directory, '--workers', str(workers)],
+    'rename-gpx': lambda directory, workers: [sys.executable, script('rename_gpx.py'), directory, '--workers', str(workers)],
+    'rename-images': lambda directory, workers: [sys.executable, script('rename-image-files-with-create-date.py'), directory],
+}
+
+default_tools = ['process', 'rename-gpx', 'rename-images']
+
+
+def fake_exiftool_directory(workdir):
+    # A directory with an "exiftool" that runs fake_exiftool.py, to put first on the PATH
+    bin_directory = os.path.join(workdir, 'bin')
+    os.makedirs(bin_directory, exist_ok=True)
+    wrapper = os.path.join(bin_directory, 'exiftool')
+    with open(wrapper, 'w') as file:
+        file.write(f'#!/bin/sh\nexec "{sys.executable}" "{script("fake_exiftool.py")}" "$@"\n')
+    os.chmod(wrapper, 0o755)
+    return bin_directory
+
+
+def run_tool(tool, directory, workers, env, log_path):
+    """Run one tool to completion, returning (exit code, seconds, peak RSS in KB)."""
+    with open(log_path, 'w') as log:
+        started = time.perf_counter()
+        process = subprocess.Popen(tool_commands[tool](directory, workers), stdout=log, stderr=subprocess.STDOUT, env=env)
+        # wait4 gives the resource usage of this one child
+        pid, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - started
+    process.returncode = os.waitstatus_to_exitcode(status)
+    peak_rss = usage.ru_maxrss if sys.platform != 'darwin' else usage.ru_maxrss // 1024
+    return process.returncode, seconds, peak_rss
+
+
+def run_metrics_file(directory):
+    # The metrics_<timestamp>.json a process_directory run leaves behind
+    paths = sorted(glob.glob(os.path.join(directory, 'metrics_*.json')))
+    if not paths:
+        return None
+    with open(paths[-1]) as file:
+        return json.load(file)
+
+
+def benchmark(size, tool, workers, workdir, env, seed=0, image_size=default_image_size):
+    """Generate a fresh tree for one tool and run it, returning its result entry."""
+    directory = os.path.join(workdir, f"{tool}-{size}")
+    shutil.rmtree(directory, ignore_errors=True)
+
+    started = time.perf_counter()
+    if tool == 'rename-gpx':
+        files = generate_gpx(directory, max(1, int(sizes[size] * gpx_share)), seed)
+    else:
+        files = generate_takeout(directory, sizes[size], seed, image_size)
+    generate_seconds = time.perf_counter() - started
+
+    log_path = directory + '.log'
+    exit_code, seconds, peak_rss = run_tool(tool, directory, workers, env, log_path)
+    result = {
+        'tool': tool,
+        'size': size,
+        'files': files,
+        'workers': workers,
+        'exit-code': exit_code,
+        'seconds': round(seconds, 3),
+        'files-per-second': round(files / seconds, 2) if seconds else None,
+        'peak-rss-kb': peak_rss,
+        'generate-seconds': round(generate_seconds, 3),
+        'metrics': run_metrics_file(directory),
+    }
+    print(f"{tool} {size}: {files} files in {seconds:.2f}s ({result['files-per-second']} files/s, "
+          f"{peak_rss / 1024:.0f} MB peak){'' if exit_code == 0 else f', exit code {exit_code}, see {log_path}'}")
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=script_directory, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(earlier, later):
+    # Lines comparing the runs the two result files have in common
+    earlier_runs = {(result['tool'], result['size'], result['workers']): result for result in earlier['results']}
+    lines = []
+    for result in later['results']:
+        before = earlier_runs.get((result['tool'], result['size'], result['workers']))
+        if not before or not before['seconds'] or not result['seconds']:
+            continue
+        change = (result['seconds'] - before['seconds']) / before['seconds'] * 100
+        lines.append(f"{result['tool']} {result['size']}: {before['seconds']:.2f}s -> {result['seconds']:.2f}s ({change:+.1f}%)")
+    return lines
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Benchmark the Takeout scripts on generated trees")
+    arg_parser.add_argument('--sizes', nargs='+', choices=list(sizes), default=['1k'])
+    arg_parser.add_argument('--tools', nargs='+', choices=list(tool_commands), default=default_tools)
+    arg_parser.add_argument('--workers', type=int, default=1)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--image-size', type=int, default=default_image_size, metavar='BYTES',
+                            help="bytes of image data in every generated photo and video")
+    arg_parser.add_argument('--fake-exiftool', action='store_true',
+                            help="use fake_exiftool.py instead of the installed exiftool, for timings that don't depend on it")
+    arg_parser.add_argument('--exiftool-delay', type=float, default=0, metavar='SECONDS',
+                            help="with --fake-exiftool, time each command takes per file")
+    arg_parser.add_argument('--metadata-cache', action='store_true',
+                            help="let the runs use the metadata cache, in the work directory (off by default)")
+    arg_parser.add_argument('--workdir', help="where the trees are generated, a temporary directory by default")
+    arg_parser.add_argument('--keep', action='store_true', help="keep the generated trees and logs")
+    arg_parser.add_argument('--output', help="results file, benchmark_<timestamp>.json in the work directory"
+                                             " (or the temporary directory without --workdir) by default")
+    arg_parser.add_argument('--compare', metavar='EARLIER', help="compare with the results file of an earlier version")
+    arg_parser.add_argument('--generate', metavar='DIRECTORY',
+                            help="only generate a tree of the first size into DIRECTORY")
+    args = arg_parser.parse_args()
+
+    if args.generate:
+        print(f"{generate_takeout(args.generate, sizes[args.sizes[0]], args.seed, args.image_size)} files written to {args.generate}")
+        sys.exit(0)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='takeout-benchmark-')
+    os.makedirs(workdir, exist_ok=True)
+    env = dict(os.environ)
+    env['FILE_PROCESSING_CACHE'] = os.path.join(workdir, 'metadata.sqlite') if args.metadata_cache else 'off'
+    if args.fake_exiftool:
+        env['PATH'] = fake_exiftool_directory(workdir) + os.pathsep + env.get('PATH', '')
+        env['FAKE_EXIFTOOL_DELAY'] = str(args.exiftool_delay)
+
+    report = {
+        'started': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'exiftool': 'fake' if args.fake_exiftool else shutil.which('exiftool'),
+        'exiftool-delay': args.exiftool_delay if args.fake_exiftool else None,
+        'seed': args.seed,
+        'image-size': args.image_size,
+        'results': [],
+    }
+    try:
+        for size in args.sizes:
+            for tool in args.tools:
+                report['results'].append(benchmark(size, tool, max(1, args.workers), workdir, env, args.seed, args.image_size))
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    # Never in the current directory, which is usually the checkout
+    output = args.output or os.path.join(args.workdir or tempfile.gettempdir(),
+                                         f"benchmark_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json")
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=4)
+    print(output)
+
+    if args.compare:
+        with open(args.compare) as file:
+            for line in compare_results(json.load(file), report):
+                print(line)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+#########################################################################
+# File      content_index.py                                            #
+# Author    Adlai Gordon                                                #
+# Purpose   Find files that are byte-for-byte copies of each other, or  #
+#             of a photo already in the successfully-processed library  #
+#           Sizes are compared first, then a hash of the first and last #
+#             64 KB, and only files still alike get a full hash (mmap,  #
+#             on a thread pool). The original hashes of every file that #
+#             goes into the library are kept in a SQLite index there,   #
+#             so later Takeout parts and exports can be checked too     #
+# Usage     ./content_index.py <library directory> [--prune]            #
+#########################################################################
+
+import argparse
+import hashlib
+import mmap
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Kept inside the library it describes, hidden so it's never scanned as a photo
+index_filename = '.content-index.sqlite'
+
+# Bytes hashed from each end of a file before a full hash
+hash_chunk_size = 65536
+
+# Sizes and hashes looked up per query
+query_batch_size = 500
+
+
+def head_tail_hash(file_path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        digest.update(f.read(hash_chunk_size))
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size > hash_chunk_size:
+            f.seek(max(hash_chunk_size, size - hash_chunk_size))
+            digest.update(f.read(hash_chunk_size))
+    return digest.hexdigest()
+
+
+def full_hash(file_path):
+    # hashlib releases the GIL on large buffers, so threads hash in parallel
+    digest = hashlib.blake2b(digest_size=32)
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                digest.update(data)
+    return digest.hexdigest()
+
+
+class ContentIndex:
+    """Size, head/tail hash and full hash of the original bytes of every library file.
+
+    Files are hashed before their metadata is written, so the index
+    recognises a later copy of the same Takeout file even though the
+    library copy has changed since. Safe to share between threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS content ('
+            ' path TEXT PRIMARY KEY,'
+            ' size INTEGER,'
+            ' head_tail_hash TEXT,'
+            ' full_hash TEXT)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS content_size ON content (size, head_tail_hash)')
+        self.connection.commit()
+
+        # Hashes of files this run will process, recorded once they're moved in
+        self.pending = {}
+        # Where each of those files ended up in the library
+        self.final_paths = {}
+        # (duplicate, original, hashes of an original from this run) to link once the run is over
+        self.links = []
+        # Report entries of duplicates whose original hasn't been moved yet
+        self.duplicates = []
+
+    @classmethod
+    def for_library(cls, library_directory):
+        return cls(os.path.join(library_directory, index_filename))
+
+    def _select(self, query, values):
+        # Rows for values, queried in batches to stay under SQLite's limit
+        rows = []
+        values = list(values)
+        with self._lock:
+            for start in range(0, len(values), query_batch_size):
+                batch = values[start:start + query_batch_size]
+                placeholders = ','.join('?' * len(batch))
+                rows.extend(self.connection.execute(query.format(placeholders), batch).fetchall())
+        return rows
+
+    def known_sizes(self, sizes):
+        return {size for size, in self._select('SELECT DISTINCT size FROM content WHERE size IN ({})', set(sizes))}
+
+    def known_head_tail_hashes(self, hashes):
+        return {value for value, in self._select('SELECT DISTINCT head_tail_hash FROM content WHERE head_tail_hash IN ({})', set(hashes))}
+
+    def find(self, size, content_hash):
+        """Path of a library file whose original had this size and full hash, or None."""
+        with self._lock:
+            rows = self.connection.execute('SELECT path FROM content WHERE size = ? AND full_hash = ?', (size, content_hash)).fetchall()
+        for path, in rows:
+            if os.path.exists(path):
+                return path
+        return None
+
+    def remember(self, file_path, hashes):
+        self.pending[file_path] = hashes
+
+    def record_moves(self, moves):
+        """Add the files of (source, target) moves to the index, with the hashes remembered for each source."""
+        rows = []
+        for source, target in moves:
+            hashes = self.pending.pop(source, None)
+            if hashes:
+                self.final_paths[source] = os.path.abspath(target)
+                rows.append((os.path.abspath(target),) + hashes)
+        if rows:
+            with self._lock:
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO content (path, size, head_tail_hash, full_hash) VALUES (?, ?, ?, ?)', rows)
+                self.connection.commit()
+
+    def link_duplicates(self):
+        """Replace every duplicate in self.links with a hard link to where its original ended up."""
+        linked = 0
+        for duplicate_path, original_path, original_hashes in self.links:
+            if original_hashes:
+                original_path = self.find(original_hashes[0], original_hashes[2])
+            if not original_path or not os.path.exists(duplicate_path):
+                continue
+            error = link_to_original(duplicate_path, original_path)
+            if error:
+                print(f"Error linking {duplicate_path} to {original_path}: {error}")
+            else:
+                linked += 1
+        self.links = []
+        return linked
+
+    def prune(self):
+        # Forget library files that were deleted or moved away, returns how many
+        with self._lock:
+            missing = [(path,) for path, in self.connection.execute('SELECT path FROM content') if not os.path.exists(path)]
+            self.connection.executemany('DELETE FROM content WHERE path = ?', missing)
+            self.connection.commit()
+        return len(missing)
+
+    def stats(self):
+        with self._lock:
+            files, size = self.connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM content').fetchone()
+        return {'files': files, 'bytes': size}
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+
+def find_duplicates(file_paths, index=None, workers=1):
+    """Return ({duplicate path: path of the copy kept}, {kept path: (size, head/tail hash, full hash)}).
+
+    The shortest path of several identical files is kept, unless the index
+    already has a copy in the library. With an index every kept file gets its full
+    hash, it's needed to recognise a later copy. Unreadable files are left
+    out of both.
+    """
+    def stat_size(file_path):
+        try:
+            return os.path.getsize(file_path)
+        except OSError:
+            return None
+
+    def hash_or_none(hash_function, file_path):
+        try:
+            return hash_function(file_path)
+        except (OSError, ValueError):
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        sizes = dict(zip(file_paths, executor.map(stat_size, file_paths)))
+        sizes = {file_path: size for file_path, size in sizes.items() if size is not None}
+
+        # Only a size shared with another file or a library file can be a copy
+        size_counts = {}
+        for size in sizes.values():
+            size_counts[size] = size_counts.get(size, 0) + 1
+        library_sizes = index.known_sizes(size_counts) if index else set()
+        candidates = [file_path for file_path, size in sizes.items() if size_counts[size] > 1 or size in library_sizes]
+
+        head_tail_hashes = dict(zip(candidates, executor.map(lambda file_path: hash_or_none(head_tail_hash, file_path), candidates)))
+        key_counts = {}
+        for file_path, value in head_tail_hashes.items():
+            key_counts[(sizes[file_path], value)] = key_counts.get((sizes[file_path], value), 0) + 1
+        library_hashes = index.known_head_tail_hashes(value for value in head_tail_hashes.values() if value) if index else set()
+        suspects = [file_path for file_path, value in head_tail_hashes.items()
+                    if value and (key_counts[(sizes[file_path], value)] > 1 or value in library_hashes)]
+
+        full_hashes = dict(zip(suspects, executor.map(lambda file_path: hash_or_none(full_hash, file_path), suspects)))
+
+        # The shortest path of identical files is kept, so IMG_0001.JPG
+        # rather than IMG_0001(1).JPG or a longer album path
+        duplicates = {}
+        kept = {}
+        for file_path in sorted(full_hashes, key=lambda file_path: (len(file_path), file_path)):
+            content_hash = full_hashes[file_path]
+            if content_hash:
+                original = kept.get((sizes[file_path], content_hash)) or (index.find(sizes[file_path], content_hash) if index else None)
+                if original:
+                    duplicates[file_path] = original
+                    continue
+                kept[(sizes[file_path], content_hash)] = file_path
+
+        # The index needs the full hash of everything that goes into the library
+        hashes = {}
+        kept_paths = [file_path for file_path in file_paths if file_path in sizes and file_path not in duplicates] if index else []
+        missing_head_tail = [file_path for file_path in kept_paths if file_path not in head_tail_hashes]
+        missing_full = [file_path for file_path in kept_paths if file_path not in full_hashes]
+        head_tail_hashes.update(zip(missing_head_tail, executor.map(lambda file_path: hash_or_none(head_tail_hash, file_path), missing_head_tail)))
+        full_hashes.update(zip(missing_full, executor.map(lambda file_path: hash_or_none(full_hash, file_path), missing_full)))
+        for file_path in kept_paths:
+            if head_tail_hashes.get(file_path) and full_hashes.get(file_path):
+                hashes[file_path] = (sizes[file_path], head_tail_hashes[file_path], full_hashes[file_path])
+
+    return duplicates, hashes
+
+
+def link_to_original(duplicate_path, original_path):
+    """Replace a duplicate with a hard link to the copy that was kept, returns an error or None."""
+    temporary_path = duplicate_path + '.link'
+    try:
+        os.link(original_path, temporary_path)
+        os.replace(temporary_path, duplicate_path)
+    except OSError as e:
+        try:
+            os.remove(temporary_path)
+        except OSError:
+            pass
+        return str(e)
+    return None
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Show or tidy the content index of a successfully-processed library")
+    arg_parser.add_argument('library')
+    arg_parser.add_argument('--prune', action='store_true', help="forget files no longer in the library")
+    args = arg_parser.parse_args()
+
+    index = ContentIndex.for_library(args.library)
+    if args.prune:
+        print(f"{index.prune()} missing files forgotten")
+    print(index.stats())
+    index.close()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+#########################################################################
+# File      directory_watcher.py                                        #
+# Author    Adlai Gordon                                                #
+# Purpose   Report the entries of a directory that were added, changed  #
+#             or removed, waiting for the next change                   #
+#           Uses inotify on Linux (through libc, nothing to install)    #
+#             and falls back to comparing listings every few seconds,   #
+#             which also works on network shares                        #
+#########################################################################
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _libc.inotify_init1
+    _libc.inotify_add_watch
+except (OSError, AttributeError, TypeError):
+    _libc = None
+
+# inotify event flags, from <sys/inotify.h>
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+
+watch_mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# struct inotify_event without its name
+event_header = struct.Struct('iIII')
+
+# Seconds between two listings when polling
+default_poll_interval = 2
+
+
+class InotifyWatcher:
+    """Changes to the entries of one directory (not below it), from inotify."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        if _libc.inotify_add_watch(self.fd, os.fsencode(directory), watch_mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, os.strerror(error), directory)
+
+    def wait(self, timeout):
+        """Names of the entries that changed, waiting up to timeout seconds for the first change."""
+        changed = set()
+        readable = select.select([self.fd], [], [], timeout)[0]
+        while readable:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                watch, mask, cookie, length = event_header.unpack_from(data, offset)
+                name = data[offset + event_header.size:offset + event_header.size + length].rstrip(b'\0')
+                offset += event_header.size + length
+                if mask & IN_Q_OVERFLOW:
+                    # Events were dropped, anything could have changed
+                    changed.update(os.listdir(self.directory))
+                elif name:
+                    changed.add(os.fsdecode(name))
+            readable = select.select([self.fd], [], [], 0)[0]
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Changes to the entries of one directory, found by comparing sizes and modification times."""
+
+    def __init__(self, directory, interval=default_poll_interval):
+        self.directory = directory
+        self.interval = interval
+        self.listing = self._listing()
+
+    def _listing(self):
+        listing = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                listing[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        return listing
+
+    def wait(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            time.sleep(max(0, min(self.interval, deadline - time.monotonic())))
+            listing = self._listing()
+            changed = {name for name in listing.keys() | self.listing.keys() if listing.get(name) != self.listing.get(name)}
+            self.listing = listing
+            if changed or time.monotonic() >= deadline:
+                return changed
+
+    def close(self):
+        pass
+
+
+def open_watcher(directory, poll_interval=None):
+    """An InotifyWatcher where inotify works, otherwise (or with a poll_interval) a PollingWatcher."""
+    if poll_interval is None and _libc is not None:
+        try:
+            return InotifyWatcher(directory)
+        except OSError as e:
+            print(f"inotify unavailable for {directory} ({e}), polling instead")
+    return PollingWatcher(directory, poll_interval or default_poll_interval)
@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+
+#########################################################################
+# File      exif_reader.py                                              #
+# Author    Adlai Gordon                                                #
+# Purpose   Read the few tags the scripts need (dates, Description and  #
+#             GPS) straight from the headers of JPEG and HEIC files     #
+#           Only the APP1 Exif/XMP segments or the HEIF Exif/XMP items  #
+#             are read, through mmap, instead of starting exiftool or   #
+#             decoding the image                                        #
+#           Returns None for anything it can't read with certainty, so  #
+#             the caller falls back to exiftool                         #
+# Usage     ./exif_reader.py <file> [file ...]                          #
+#########################################################################
+
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import xml.etree.ElementTree as ET
+
+# Tags read by default, named the way exiftool names them
+default_tags = ['DateTimeOriginal', 'CreateDate', 'ModifyDate', 'DateCreated', 'Description',
+                'GPSLatitude', 'GPSLongitude', 'GPSAltitude']
+
+# APP1 segments start with one of these
+exif_header = b'Exif\x00\x00'
+xmp_header = b'http://ns.adobe.com/xap/1.0/\x00'
+
+heif_brands = {b'heic', b'heix', b'heim', b'heis', b'hevc', b'hevx', b'mif1', b'msf1', b'avif'}
+
+exif_ifd_tags = {0x0132: 'ModifyDate', 0x9003: 'DateTimeOriginal', 0x9004: 'CreateDate'}
+exif_ifd_pointer = 0x8769
+gps_ifd_pointer = 0x8825
+
+xmp_namespaces = {
+    'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+    'dc': 'http://purl.org/dc/elements/1.1/',
+    'xmp': 'http://ns.adobe.com/xap/1.0/',
+    'exif': 'http://ns.adobe.com/exif/1.0/',
+    'photoshop': 'http://ns.adobe.com/photoshop/1.0/',
+}
+# exiftool tag name -> (namespace, XMP property)
+xmp_tags = {
+    'Description': ('dc', 'description'),
+    'CreateDate': ('xmp', 'CreateDate'),
+    'ModifyDate': ('xmp', 'ModifyDate'),
+    'DateTimeOriginal': ('exif', 'DateTimeOriginal'),
+    'DateCreated': ('photoshop', 'DateCreated'),
+}
+
+# Size in bytes of each TIFF field type
+tiff_type_sizes = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+
+
+class UnsupportedFile(Exception):
+    pass
+
+
+def read_tags(file_path, tags=None):
+    """Return {'SourceFile': file_path, tag: value, ...} like one exiftool -json entry.
+
+    Tags the file doesn't have are left out. Dates use exiftool's
+    "YYYY:MM:DD HH:MM:SS" form, GPS values are signed decimals (as with
+    exiftool -n). Returns None when the file isn't a JPEG or HEIF image
+    this reader fully understands.
+    """
+    tags = default_tags if tags is None else tags
+    try:
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < 12:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if data[:2] == b'\xff\xd8':
+                    exif, xmp = _jpeg_segments(data)
+                elif data[4:8] == b'ftyp':
+                    exif, xmp = _heif_items(data)
+                else:
+                    return None
+                values = {}
+                if exif is not None:
+                    values.update(_parse_tiff(exif))
+    except (OSError, ValueError, IndexError, struct.error, UnsupportedFile):
+        return None
+
+    # EXIF takes priority over XMP, the same as exiftool
+    if xmp is not None:
+        try:
+            for tag, value in _parse_xmp(xmp).items():
+                values.setdefault(tag, value)
+        except ET.ParseError:
+            return None
+
+    entry = {'SourceFile': file_path}
+    for tag in tags:
+        if tag in values:
+            entry[tag] = values[tag]
+    return entry
+
+
+def jpeg_header_segments(data):
+    """Return ([(marker, start, end), ...], header_end) for the segments before the image data.
+
+    start is the 0xFF of the marker, end is just past the segment, and
+    header_end is where the start of scan (or end of image) marker begins.
+    """
+    segments = []
+    position = 2
+    while position + 4 <= len(data):
+        if data[position] != 0xFF:
+            raise UnsupportedFile("bad JPEG marker")
+        marker = data[position + 1]
+        if marker == 0xFF:
+            position += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            position += 2
+            continue
+        if marker in (0xDA, 0xD9):  # Start of scan / end of image
+            return segments, position
+
+        length = struct.unpack('>H', data[position + 2:position + 4])[0]
+        if length < 2 or position + 2 + length > len(data):
+            raise UnsupportedFile("bad JPEG segment length")
+        segments.append((marker, position, position + 2 + length))
+        position += 2 + length
+    raise UnsupportedFile("no JPEG image data")
+
+
+def _jpeg_segments(data):
+    # The Exif and XMP payloads of a JPEG
+    exif = xmp = None
+    for marker, start, end in jpeg_header_segments(data)[0]:
+        segment = data[start + 4:end]
+        if marker == 0xE1:
+            if segment.startswith(exif_header) and exif is None:
+                exif = segment[len(exif_header):]
+            elif segment.startswith(xmp_header) and xmp is None:
+                xmp = segment[len(xmp_header):]
+        elif marker == 0xED and segment.startswith(b'Photoshop 3.0'):
+            # IPTC dates need exiftool's rules for combining them
+            raise UnsupportedFile("IPTC data")
+    return exif, xmp
+
+
+def _boxes(data, start, end):
+    # (type, payload start, payload end) of each ISO BMFF box in data[start:end]
+    position = start
+    while position + 8 <= end:
+        size, box_type = struct.unpack('>I4s', data[position:position + 8])
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', data[position + 8:position + 16])[0]
+            header = 16
+        elif size == 0:
+            size = end - position
+        if size < header or position + size > end:
+            raise UnsupportedFile("bad box size")
+        yield box_type, position + header, position + size
+        position += size
+
+
+def _heif_items(data):
+    # Find the Exif and XMP items in the meta box of a HEIF file
+    boxes = {box_type: (start, end) for box_type, start, end in _boxes(data, 0, len(data))}
+    if b'ftyp' not in boxes or b'meta' not in boxes:
+        raise UnsupportedFile("not a HEIF image")
+    start, end = boxes[b'ftyp']
+    brands = {data[start:start + 4]} | {data[i:i + 4] for i in range(start + 8, end, 4)}
+    if not brands & heif_brands:
+        raise UnsupportedFile("not a HEIF image")
+
+    start, end = boxes[b'meta']
+    meta = {box_type: (box_start, box_end) for box_type, box_start, box_end in _boxes(data, start + 4, end)}
+    if b'iinf' not in meta or b'iloc' not in meta:
+        return None, None
+
+    exif_id = xmp_id = None
+    for item_id, item_type, content_type in _item_infos(data, *meta[b'iinf']):
+        if item_type == b'Exif' and exif_id is None:
+            exif_id = item_id
+        elif item_type == b'mime' and content_type == b'application/rdf+xml' and xmp_id is None:
+            xmp_id = item_id
+
+    locations = _item_locations(data, *meta[b'iloc'])
+    idat_start = meta[b'idat'][0] if b'idat' in meta else None
+
+    def item_data(item_id):
+        if item_id not in locations:
+            return None
+        construction_method, extents = locations[item_id]
+        if construction_method == 1 and idat_start is None or construction_method not in (0, 1):
+            raise UnsupportedFile("unsupported item construction")
+        base = idat_start if construction_method == 1 else 0
+        return b''.join(data[base + offset:base + offset + length] for offset, length in extents)
+
+    exif = item_data(exif_id) if exif_id is not None else None
+    if exif is not None:
+        # The payload starts with the offset of the TIFF header
+        exif = exif[4 + struct.unpack('>I', exif[:4])[0]:]
+    xmp = item_data(xmp_id) if xmp_id is not None else None
+    return exif, xmp
+
+
+def _item_infos(data, start, end):
+    version = data[start]
+    position = start + 4
+    position += 2 if version == 0 else 4
+    for box_type, box_start, box_end in _boxes(data, position, end):
+        if box_type != b'infe' or data[box_start] < 2:
+            continue
+        infe_version = data[box_start]
+        position = box_start + 4
+        if infe_version == 2:
+            item_id = struct.unpack('>H', data[position:position + 2])[0]
+            position += 2
+        else:
+            item_id = struct.unpack('>I', data[position:position + 4])[0]
+            position += 4
+        position += 2  # item_protection_index
+        item_type = data[position:position + 4]
+        position += 4
+        name_end = data.find(b'\x00', position, box_end)
+        content_type = None
+        if item_type == b'mime' and name_end >= 0:
+            content_end = data.find(b'\x00', name_end + 1, box_end)
+            content_type = data[name_end + 1:content_end if content_end >= 0 else box_end]
+        yield item_id, item_type, content_type
+
+
+def _item_locations(data, start, end):
+    # {item_id: (construction_method, [(offset, length), ...])}
+    version = data[start]
+    position = start + 4
+    offset_size, length_size = data[position] >> 4, data[position] & 0x0F
+    base_offset_size, index_size = data[position + 1] >> 4, data[position + 1] & 0x0F
+    position += 2
+
+    def read(size):
+        nonlocal position
+        value = int.from_bytes(data[position:position + size], 'big') if size else 0
+        position += size
+        return value
+
+    item_count = read(4 if version == 2 else 2)
+    locations = {}
+    for _ in range(item_count):
+        item_id = read(4 if version == 2 else 2)
+        construction_method = read(2) & 0x0F if version in (1, 2) else 0
+        read(2)  # data_reference_index
+        base_offset = read(base_offset_size)
+        extents = []
+        for _ in range(read(2)):
+            if version in (1, 2):
+                read(index_size)
+            extent_offset = read(offset_size)
+            extents.append((base_offset + extent_offset, read(length_size)))
+        locations[item_id] = (construction_method, extents)
+    if position > end:
+        raise UnsupportedFile("bad iloc box")
+    return locations
+
+
+def _parse_tiff(tiff):
+    byte_order = {b'II': '<', b'MM': '>'}.get(bytes(tiff[:2]))
+    if byte_order is None or struct.unpack(byte_order + 'H', tiff[2:4])[0] != 42:
+        raise UnsupportedFile("bad TIFF header")
+
+    values = {}
+    ifd0 = _read_ifd(tiff, byte_order, struct.unpack(byte_order + 'I', tiff[4:8])[0])
+    for ifd in (ifd0, _read_ifd(tiff, byte_order, ifd0.get(exif_ifd_pointer, 0))):
+        for tag_id, name in exif_ifd_tags.items():
+            if isinstance(ifd.get(tag_id), str) and ifd[tag_id]:
+                values.setdefault(name, ifd[tag_id])
+
+    gps = _read_ifd(tiff, byte_order, ifd0.get(gps_ifd_pointer, 0))
+    for name, ref_tag, value_tag, negative in (('GPSLatitude', 1, 2, 'S'), ('GPSLongitude', 3, 4, 'W')):
+        if isinstance(gps.get(value_tag), tuple) and len(gps[value_tag]) == 3:
+            degrees, minutes, seconds = gps[value_tag]
+            value = degrees + minutes / 60 + seconds / 3600
+            values[name] = -value if gps.get(ref_tag) == negative else value
+    if isinstance(gps.get(6), tuple) and gps[6]:
+        altitude = gps[6][0]
+        values['GPSAltitude'] = -altitude if gps.get(5) == 1 else altitude
+    return values
+
+
+def _read_ifd(tiff, byte_order, offset):
+    # {tag: value} for the entries of one IFD, strings and numbers only
+    entries = {}
+    if not offset or offset + 2 > len(tiff):
+        return entries
+    count = struct.unpack(byte_order + 'H', tiff[offset:offset + 2])[0]
+    for index in range(count):
+        entry = offset + 2 + index * 12
+        tag, field_type, value_count = struct.unpack(byte_order + 'HHI', tiff[entry:entry + 8])
+        size = tiff_type_sizes.get(field_type, 0) * value_count
+        if not size:
+            continue
+        value_offset = entry + 8 if size <= 4 else struct.unpack(byte_order + 'I', tiff[entry + 8:entry + 12])[0]
+        raw = tiff[value_offset:value_offset + size]
+        if len(raw) < size:
+            continue
+
+        if field_type == 2:
+            entries[tag] = bytes(raw).split(b'\x00', 1)[0].decode('utf-8', errors='replace').strip()
+        elif field_type in (5, 10):
+            code = 'I' if field_type == 5 else 'i'
+            numbers = struct.unpack(f"{byte_order}{2 * value_count}{code}", raw)
+            entries[tag] = tuple(n / d if d else 0.0 for n, d in zip(numbers[::2], numbers[1::2]))
+        elif field_type in (3, 4, 9):
+            code = {3: 'H', 4: 'I', 9: 'i'}[field_type]
+            numbers = struct.unpack(f"{byte_order}{value_count}{code}", raw)
+            entries[tag] = numbers[0] if value_count == 1 else numbers
+        elif field_type in (1, 7) and value_count == 1:
+            entries[tag] = raw[0]
+    return entries
+
+
+def _parse_xmp(xmp):
+    root = ET.fromstring(bytes(xmp).rstrip(b'\x00 \r\n\t'))
+    rdf = xmp_namespaces['rdf']
+    values = {}
+    for description in root.iter(f"{{{rdf}}}Description"):
+        for tag, (prefix, prop) in xmp_tags.items():
+            name = f"{{{xmp_namespaces[prefix]}}}{prop}"
+            value = description.get(name)
+            if value is None:
+                element = description.find(name)
+                if element is None:
+                    continue
+                value = _xmp_text(element, rdf)
+            if value is not None and tag not in values:
+                values[tag] = value if tag == 'Description' else _xmp_date(value)
+    return values
+
+
+def _xmp_text(element, rdf):
+    # Plain text, or the x-default (else first) entry of an rdf:Alt/Seq/Bag
+    items = element.findall(f"./*/{{{rdf}}}li")
+    if not items:
+        return element.text.strip() if element.text and element.text.strip() else None
+    for item in items:
+        if item.get('{http://www.w3.org/XML/1998/namespace}lang') == 'x-default':
+            return item.text or ''
+    return items[0].text or ''
+
+
+def _xmp_date(value):
+    # 2020-01-02T03:04:05-05:00 -> 2020:01:02 03:04:05-05:00, as exiftool prints it
+    match = re.match(r'^(\d{4})-(\d{2})-(\d{2})(?:T(.*))?$', value.strip())
+    if not match:
+        return value
+    year, month, day, rest = match.groups()
+    return f"{year}:{month}:{day} {rest}" if rest else f"{year}:{month}:{day}"
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} <file> [file ...]")
+        sys.exit(1)
+    print(json.dumps([read_tags(path) or {'SourceFile': path, 'error': 'needs exiftool'} for path in sys.argv[1:]], indent=4))
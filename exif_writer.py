@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+#########################################################################
+# File      exif_writer.py                                              #
+# Author    Adlai Gordon                                                #
+# Purpose   Write Description and GPS to JPEG files without exiftool    #
+#           The Exif and XMP APP1 segments are rebuilt in memory and    #
+#             the image data after them is streamed over unchanged      #
+#           Takes the same tag arguments as exiftool and returns None   #
+#             for anything it can't write the way exiftool would, so    #
+#             those files still go to exiftool                          #
+#########################################################################
+
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from xml.sax.saxutils import escape
+
+from exif_reader import UnsupportedFile, exif_header, jpeg_header_segments, xmp_header
+
+# Tags this writer handles, everything else goes to exiftool
+supported_tags = ('Description', 'GPSLatitude', 'GPSLongitude')
+
+gps_ifd_pointer = 0x8825
+gps_version_id = 0x0000
+gps_latitude_ref, gps_latitude = 0x0001, 0x0002
+gps_longitude_ref, gps_longitude = 0x0003, 0x0004
+
+tiff_ascii, tiff_byte, tiff_long, tiff_rational = 2, 1, 4, 5
+
+# Denominator used for GPS seconds, about 3 cm of precision
+gps_seconds_denominator = 10000
+
+# Segments can't be larger than this (the length field includes itself)
+max_segment_size = 65533
+
+# Whitespace left in a new XMP packet so it can grow in place, like exiftool does
+xmp_padding = (' ' * 99 + '\n') * 24
+
+# Escaped in XMP text on top of &, < and >
+xml_entities = {'"': '&quot;'}
+
+# Output for one written file, the same line exiftool prints
+written_output = "    1 image files updated"
+
+
+def parse_tag_args(tag_args):
+    # ['-Description=x', '-GPSLatitude=1.5'] -> {'Description': 'x', 'GPSLatitude': '1.5'}
+    tags = {}
+    for arg in tag_args:
+        if not arg.startswith('-') or '=' not in arg:
+            return None
+        name, value = arg[1:].split('=', 1)
+        if name not in supported_tags:
+            return None
+        tags[name] = value
+    return tags
+
+
+def write_jpeg_tags(file_path, tag_args):
+    """Write exiftool-style tag arguments to a JPEG, replacing the file like -overwrite_original.
+
+    Returns (succeeded, output), or None when the file or a tag has to be
+    left to exiftool (not a JPEG, an existing XMP packet, unknown tags...).
+    """
+    tags = parse_tag_args(tag_args)
+    if not tags or ('GPSLatitude' in tags) != ('GPSLongitude' in tags):
+        return None
+
+    try:
+        with open(file_path, 'rb') as source:
+            if os.fstat(source.fileno()).st_size < 4:
+                return None
+            with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if data[:2] != b'\xff\xd8':
+                    return None
+                rebuilt = _rebuild_header(data, tags)
+            if rebuilt is None:
+                return None
+            header, header_end = rebuilt
+            _replace_file(file_path, source, header, header_end)
+    except (UnsupportedFile, ValueError, struct.error):
+        return None
+    except OSError as e:
+        return False, str(e)
+    return True, written_output
+
+
+def _rebuild_header(data, tags):
+    # (new segments before the image data, offset where the image data starts)
+    segments, header_end = jpeg_header_segments(data)
+
+    exif_index = xmp_index = None
+    for index, (marker, start, end) in enumerate(segments):
+        if marker == 0xE1 and data[start + 4:end].startswith(exif_header) and exif_index is None:
+            exif_index = index
+        elif marker == 0xE1 and data[start + 4:end].startswith(xmp_header):
+            xmp_index = index
+        elif marker == 0xED:
+            return None
+
+    # Merging into an existing XMP packet is left to exiftool
+    if 'Description' in tags and xmp_index is not None:
+        return None
+
+    parts = [bytes(data[start:end]) for marker, start, end in segments]
+
+    # New segments go after the JFIF APP0, Exif first and XMP after it
+    exif_position = exif_index
+    if 'GPSLatitude' in tags:
+        tiff = None
+        if exif_index is not None:
+            start, end = segments[exif_index][1:]
+            tiff = bytes(data[start + 4 + len(exif_header):end])
+        exif_segment = _app1(exif_header + _tiff_with_gps(tiff, float(tags['GPSLatitude']), float(tags['GPSLongitude'])))
+        if exif_index is not None:
+            parts[exif_index] = exif_segment
+        else:
+            exif_position = 0
+            while exif_position < len(segments) and segments[exif_position][0] == 0xE0:
+                exif_position += 1
+            parts.insert(exif_position, exif_segment)
+
+    if 'Description' in tags:
+        xmp_position = exif_position + 1 if exif_position is not None else 0
+        if exif_position is None:
+            while xmp_position < len(segments) and segments[xmp_position][0] == 0xE0:
+                xmp_position += 1
+        parts.insert(xmp_position, _app1(xmp_header + _xmp_packet(tags['Description'])))
+
+    return [b'\xff\xd8'] + parts, header_end
+
+
+def _app1(payload):
+    if len(payload) + 2 > max_segment_size:
+        raise UnsupportedFile("segment too large")
+    return b'\xff\xe1' + struct.pack('>H', len(payload) + 2) + payload
+
+
+def _xmp_packet(description):
+    # Laid out the way exiftool writes a new packet
+    return (
+        "<?xpacket begin='\ufeff' id='W5M0MpCehiHzreSzNTczkc9d'?>\n"
+        "<x:xmpmeta xmlns:x='adobe:ns:meta/'>\n"
+        "<rdf:RDF xmlns:rdf='http://www.w3.org/1999/02/22-rdf-syntax-ns#'>\n"
+        "\n"
+        " <rdf:Description rdf:about=''\n"
+        "  xmlns:dc='http://purl.org/dc/elements/1.1/'>\n"
+        "  <dc:description>\n"
+        "   <rdf:Alt>\n"
+        f"    <rdf:li xml:lang='x-default'>{escape(description, xml_entities)}</rdf:li>\n"
+        "   </rdf:Alt>\n"
+        "  </dc:description>\n"
+        " </rdf:Description>\n"
+        "</rdf:RDF>\n"
+        "</x:xmpmeta>\n"
+        f"{xmp_padding}"
+        "<?xpacket end='w'?>"
+    ).encode('utf-8')
+
+
+def _tiff_with_gps(tiff, latitude, longitude):
+    """Return the TIFF block with GPS latitude/longitude set.
+
+    Nothing already in the block moves: the GPS IFD and IFD0 are rewritten
+    at the end and the header points at the new IFD0, so offsets used by
+    other IFDs and maker notes stay valid.
+    """
+    if tiff is None:
+        tiff = b'MM\x00\x2a' + struct.pack('>I', 0)
+    byte_order = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+    if byte_order is None or struct.unpack(byte_order + 'H', tiff[2:4])[0] != 42:
+        raise UnsupportedFile("bad TIFF header")
+    block = bytearray(tiff)
+
+    def append(payload):
+        if len(block) % 2:
+            block.append(0)
+        offset = len(block)
+        block.extend(payload)
+        return offset
+
+    ifd0_offset = struct.unpack(byte_order + 'I', tiff[4:8])[0]
+    ifd0_entries, ifd0_next = _ifd_entries(tiff, byte_order, ifd0_offset)
+    gps_offset = 0
+    if gps_ifd_pointer in ifd0_entries:
+        gps_offset = struct.unpack(byte_order + 'I', ifd0_entries[gps_ifd_pointer][8:12])[0]
+    gps_entries, gps_next = _ifd_entries(tiff, byte_order, gps_offset)
+
+    updates = {
+        gps_latitude_ref: (tiff_ascii, 2, b'S\x00' if latitude < 0 else b'N\x00'),
+        gps_latitude: (tiff_rational, 3, _dms_rationals(abs(latitude), byte_order)),
+        gps_longitude_ref: (tiff_ascii, 2, b'W\x00' if longitude < 0 else b'E\x00'),
+        gps_longitude: (tiff_rational, 3, _dms_rationals(abs(longitude), byte_order)),
+    }
+    if gps_version_id not in gps_entries:
+        updates[gps_version_id] = (tiff_byte, 4, b'\x02\x03\x00\x00')
+
+    gps_position = append(_build_ifd(gps_entries, gps_next, updates, byte_order, append))
+    ifd0 = _build_ifd(ifd0_entries, ifd0_next,
+                      {gps_ifd_pointer: (tiff_long, 1, struct.pack(byte_order + 'I', gps_position))}, byte_order, append)
+    block[4:8] = struct.pack(byte_order + 'I', append(ifd0))
+    return bytes(block)
+
+
+def _ifd_entries(tiff, byte_order, offset):
+    # ({tag: raw 12 byte entry}, next IFD offset)
+    if not offset:
+        return {}, 0
+    count = struct.unpack(byte_order + 'H', tiff[offset:offset + 2])[0]
+    end = offset + 2 + count * 12
+    if end + 4 > len(tiff):
+        raise UnsupportedFile("IFD outside the Exif block")
+    entries = {}
+    for index in range(count):
+        entry = tiff[offset + 2 + index * 12:offset + 14 + index * 12]
+        entries[struct.unpack(byte_order + 'H', entry[:2])[0]] = entry
+    return entries, struct.unpack(byte_order + 'I', tiff[end:end + 4])[0]
+
+
+def _build_ifd(entries, next_offset, updates, byte_order, append):
+    # Values too big for the entry itself are appended to the block first
+    entries = dict(entries)
+    for tag, (field_type, count, value) in updates.items():
+        if len(value) <= 4:
+            field = value.ljust(4, b'\x00')
+        else:
+            field = struct.pack(byte_order + 'I', append(value))
+        entries[tag] = struct.pack(byte_order + 'HHI', tag, field_type, count) + field
+
+    ifd = bytearray(struct.pack(byte_order + 'H', len(entries)))
+    for tag in sorted(entries):
+        ifd.extend(entries[tag])
+    ifd.extend(struct.pack(byte_order + 'I', next_offset))
+    return bytes(ifd)
+
+
+def _dms_rationals(value, byte_order):
+    degrees = int(value)
+    minutes = int((value - degrees) * 60)
+    seconds = round((value - degrees - minutes / 60) * 3600 * gps_seconds_denominator)
+    if seconds >= 60 * gps_seconds_denominator:
+        minutes, seconds = minutes + 1, seconds - 60 * gps_seconds_denominator
+    if minutes >= 60:
+        degrees, minutes = degrees + 1, minutes - 60
+    return struct.pack(byte_order + '6I', degrees, 1, minutes, 1, seconds, gps_seconds_denominator)
+
+
+def _replace_file(file_path, source, header, header_end):
+    # Write next to the original and rename over it, like -overwrite_original
+    directory, name = os.path.split(os.path.abspath(file_path))
+    descriptor, temporary_path = tempfile.mkstemp(prefix=f".{name}.", suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(descriptor, 'wb') as destination:
+            for part in header:
+                destination.write(part)
+            source.seek(header_end)
+            shutil.copyfileobj(source, destination, 1024 * 1024)
+        shutil.copymode(file_path, temporary_path)
+        os.replace(temporary_path, file_path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
@@ -0,0 +1,484 @@
+#!/usr/bin/env python3
+
+#########################################################################
+# File      exiftool_pool.py                                            #
+# Author    Adlai Gordon                                                #
+# Purpose   Keep long-lived exiftool processes around so that each      #
+#             read/write doesn't pay for starting a Perl interpreter    #
+#             Uses exiftool's "-stay_open True -@ -" mode               #
+#           AsyncExifToolPool does the same for asyncio code, with the  #
+#             processes started by asyncio.create_subprocess_exec       #
+# Dependencies                                                          #
+#           exiftool                                                    #
+#########################################################################
+
+import asyncio
+import os
+import selectors
+import subprocess
+import threading
+import time
+
+
+class ExifToolError(Exception):
+    pass
+
+
+class ExifToolWorker:
+    """A single exiftool process taking commands over stdin."""
+
+    def __init__(self, executable='exiftool'):
+        self.executable = executable
+        self.process = None
+        self.buffers = {}
+        self.sequence = 0
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [self.executable, '-stay_open', 'True', '-@', '-'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.buffers = {self.process.stdout: b'', self.process.stderr: b''}
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def execute(self, args, timeout=None):
+        return self.execute_many([args], timeout)[0]
+
+    def execute_many(self, commands, timeout=None):
+        """Send several commands at once, each ending in its own -execute.
+
+        exiftool works through them in order while the rest are still being
+        written, which saves a round trip per command. The timeout applies to
+        each command separately.
+        """
+        if not self.is_alive():
+            self.start()
+
+        markers, data = _encode_commands(self, commands)
+
+        # Write from a separate thread so a long batch can't fill the pipe
+        # while exiftool is blocked writing output we haven't read yet
+        write_errors = []
+        writer = threading.Thread(target=self._write, args=(data, write_errors), daemon=True)
+        writer.start()
+
+        results = []
+        try:
+            for args, ready in zip(commands, markers):
+                stdout, stderr = self._read_until(ready.encode('utf-8'), timeout, args)
+                results.append(subprocess.CompletedProcess(
+                    ['exiftool'] + list(args),
+                    1 if _has_error(stderr) else 0,
+                    stdout, stderr))
+        except ExifToolError:
+            if write_errors:
+                raise ExifToolError(f"exiftool worker died: {write_errors[0]}")
+            raise
+        finally:
+            writer.join()
+        return results
+
+    def _write(self, data, write_errors):
+        try:
+            self.process.stdin.write(data)
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError, ValueError) as e:
+            write_errors.append(e)
+
+    def _read_until(self, ready, timeout, args):
+        deadline = time.monotonic() + timeout if timeout else None
+        streams = (self.process.stdout, self.process.stderr)
+        output = {}
+        selector = selectors.DefaultSelector()
+
+        # Output that arrived with the previous command's marker may already
+        # contain this one's
+        for stream in streams:
+            if not self._take(stream, ready, output):
+                selector.register(stream, selectors.EVENT_READ)
+
+        try:
+            while selector.get_map():
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.kill()
+                        raise subprocess.TimeoutExpired(['exiftool'] + list(args), timeout)
+
+                for key, _ in selector.select(remaining):
+                    chunk = os.read(key.fileobj.fileno(), 65536)
+                    if not chunk:
+                        self.kill()
+                        raise ExifToolError("exiftool worker exited unexpectedly")
+                    self.buffers[key.fileobj] += chunk
+                    if self._take(key.fileobj, ready, output):
+                        selector.unregister(key.fileobj)
+        finally:
+            selector.close()
+
+        return tuple(output[stream].decode('utf-8', errors='replace') for stream in streams)
+
+    def _take(self, stream, ready, output):
+        # Split the buffered output at the "{readyN}" line, keeping the rest
+        buffer = self.buffers[stream]
+        index = buffer.find(ready)
+        if index < 0:
+            return False
+        rest = buffer[index + len(ready):]
+        if rest.startswith(b'\r'):
+            rest = rest[1:]
+        if rest.startswith(b'\n'):
+            rest = rest[1:]
+        output[stream] = buffer[:index]
+        self.buffers[stream] = rest
+        return True
+
+    def close(self, timeout=5):
+        if not self.is_alive():
+            return
+        try:
+            self.process.stdin.write(b'-stay_open\nFalse\n')
+            self.process.stdin.flush()
+            self.process.wait(timeout=timeout)
+        except (BrokenPipeError, OSError, subprocess.TimeoutExpired):
+            self.kill()
+        self._close_pipes()
+
+    def kill(self):
+        if self.process is None:
+            return
+        try:
+            self.process.kill()
+            self.process.wait()
+        except OSError:
+            pass
+        self._close_pipes()
+
+    def _close_pipes(self):
+        for stream in (self.process.stdin, self.process.stdout, self.process.stderr):
+            try:
+                stream.close()
+            except OSError:
+                pass
+
+
+def _encode_commands(worker, commands):
+    # (the "{readyN}" marker of each command, everything to write to stdin)
+    markers = []
+    lines = []
+    for args in commands:
+        worker.sequence += 1
+        ready = f"{{ready{worker.sequence}}}"
+        markers.append(ready)
+        # One argument per line, then ask exiftool to echo the same marker
+        # to stderr so we know when both streams are complete
+        lines.extend(list(args) + ['-echo4', ready, f"-execute{worker.sequence}"])
+    return markers, ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def _has_error(stderr):
+    # exiftool doesn't report a status in stay_open mode, so treat any
+    # "Error" line the same way the exit code would
+    return any(line.startswith('Error') for line in stderr.splitlines())
+
+
+class ExifToolPool:
+    """Up to `size` exiftool workers, started lazily and shared between threads."""
+
+    def __init__(self, size=1, timeout=60, executable='exiftool', retries=1):
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.executable = executable
+        self.retries = retries
+        self._workers = []
+        self._idle = []
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def resize(self, size):
+        # Extra workers are started lazily. Surplus idle workers are stopped
+        # now, busy ones when they're released
+        with self._condition:
+            self.size = max(1, size)
+            retired = []
+            while len(self._workers) > self.size and self._idle:
+                retired.append(self._idle.pop())
+                self._workers.remove(retired[-1])
+            self._condition.notify_all()
+        for worker in retired:
+            worker.close()
+
+    def warm(self):
+        # Start every worker now rather than on first use, for callers that wait between runs
+        with self._condition:
+            while len(self._workers) < self.size and not self._closed:
+                worker = ExifToolWorker(self.executable)
+                worker.start()
+                self._workers.append(worker)
+                self._idle.append(worker)
+            self._condition.notify_all()
+
+    def _acquire(self):
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise ExifToolError("exiftool pool is closed")
+                if self._idle:
+                    return self._idle.pop()
+                if len(self._workers) < self.size:
+                    worker = ExifToolWorker(self.executable)
+                    self._workers.append(worker)
+                    return worker
+                self._condition.wait()
+
+    def _release(self, worker):
+        with self._condition:
+            if self._closed or len(self._workers) > self.size:
+                if worker in self._workers:
+                    self._workers.remove(worker)
+                worker.close()
+            else:
+                self._idle.append(worker)
+            self._condition.notify_all()
+
+    def run(self, args, timeout=None, check=True):
+        """Run one exiftool command (without the leading 'exiftool').
+
+        Returns a CompletedProcess like subprocess.run(text=True) would and
+        raises CalledProcessError when check is set and exiftool reported an
+        error. A worker that crashes is restarted and the command retried.
+        """
+        result = self.run_many([args], timeout)[0]
+        if check and result.returncode:
+            raise subprocess.CalledProcessError(result.returncode, result.args, result.stdout, result.stderr)
+        return result
+
+    def run_many(self, commands, timeout=None):
+        """Run a batch of commands on one worker, returning a CompletedProcess for each.
+
+        Failures of individual commands are left in their returncode. If the
+        worker crashes the whole batch is run again, so only pass commands
+        that are safe to repeat.
+        """
+        timeout = timeout or self.timeout
+        attempts = 0
+        while True:
+            worker = self._acquire()
+            try:
+                return worker.execute_many(commands, timeout)
+            except ExifToolError:
+                attempts += 1
+                if attempts > self.retries:
+                    raise
+            finally:
+                self._release(worker)
+
+    def close(self, timeout=None):
+        """Stop every worker.
+
+        Busy workers get timeout seconds (the pool's timeout by default) to
+        finish their command and are killed after that.
+        """
+        with self._condition:
+            self._closed = True
+            workers = self._idle
+            self._idle = []
+            for worker in workers:
+                self._workers.remove(worker)
+            self._condition.notify_all()
+        for worker in workers:
+            worker.close()
+
+        # Busy workers are closed when they are released
+        with self._condition:
+            deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+            while self._workers and time.monotonic() < deadline:
+                self._condition.wait(deadline - time.monotonic())
+            busy = list(self._workers)
+        for worker in busy:
+            # The thread using it sees the pipes close, cleans up and releases it
+            if worker.process is not None:
+                try:
+                    worker.process.kill()
+                except OSError:
+                    pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Largest output of one command the asyncio workers will buffer
+async_stream_limit = 64 * 1024 * 1024
+
+
+class AsyncExifToolWorker:
+    """ExifToolWorker for asyncio, reading both pipes without threads or selectors."""
+
+    def __init__(self, executable='exiftool'):
+        self.executable = executable
+        self.process = None
+        self.sequence = 0
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(
+            self.executable, '-stay_open', 'True', '-@', '-',
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            limit=async_stream_limit)
+
+    def is_alive(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def execute_many(self, commands, timeout=None):
+        """Same as ExifToolWorker.execute_many, awaiting the output instead of blocking."""
+        if not self.is_alive():
+            await self.start()
+
+        markers, data = _encode_commands(self, commands)
+
+        # Written while the output is read, so neither pipe can fill up
+        writer = asyncio.ensure_future(self._write(data))
+
+        results = []
+        try:
+            for args, ready in zip(commands, markers):
+                ready = ready.encode('utf-8')
+                try:
+                    stdout, stderr = await asyncio.wait_for(asyncio.gather(
+                        self._read_until(self.process.stdout, ready),
+                        self._read_until(self.process.stderr, ready)), timeout)
+                except asyncio.TimeoutError:
+                    await self.kill()
+                    raise subprocess.TimeoutExpired(['exiftool'] + list(args), timeout)
+                results.append(subprocess.CompletedProcess(
+                    ['exiftool'] + list(args),
+                    1 if _has_error(stderr) else 0,
+                    stdout, stderr))
+        except ExifToolError:
+            write_error = await writer
+            if write_error:
+                raise ExifToolError(f"exiftool worker died: {write_error}")
+            raise
+        except BaseException:
+            writer.cancel()
+            raise
+        await writer
+        return results
+
+    async def _write(self, data):
+        try:
+            self.process.stdin.write(data)
+            await self.process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError, OSError) as e:
+            return e
+        return None
+
+    async def _read_until(self, stream, ready):
+        try:
+            output = await stream.readuntil(ready)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            await self.kill()
+            raise ExifToolError("exiftool worker exited unexpectedly")
+        # The line break after the previous command's marker comes first
+        if output.startswith(b'\r'):
+            output = output[1:]
+        if output.startswith(b'\n'):
+            output = output[1:]
+        return output[:-len(ready)].decode('utf-8', errors='replace')
+
+    async def close(self, timeout=5):
+        if not self.is_alive():
+            return
+        try:
+            self.process.stdin.write(b'-stay_open\nFalse\n')
+            await self.process.stdin.drain()
+            await asyncio.wait_for(self.process.wait(), timeout)
+        except (BrokenPipeError, ConnectionResetError, OSError, asyncio.TimeoutError):
+            await self.kill()
+
+    async def kill(self):
+        if self.process is None or self.process.returncode is not None:
+            return
+        try:
+            self.process.kill()
+        except ProcessLookupError:
+            pass
+        await self.process.wait()
+
+
+class AsyncExifToolPool:
+    """Up to `size` AsyncExifToolWorkers, started lazily and shared between tasks.
+
+    Create, use and close it inside one event loop.
+    """
+
+    def __init__(self, size=1, timeout=60, executable='exiftool', retries=1):
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.executable = executable
+        self.retries = retries
+        self._workers = []
+        self._idle = []
+        self._condition = asyncio.Condition()
+        self._closed = False
+
+    async def _acquire(self):
+        async with self._condition:
+            while True:
+                if self._closed:
+                    raise ExifToolError("exiftool pool is closed")
+                if self._idle:
+                    return self._idle.pop()
+                if len(self._workers) < self.size:
+                    worker = AsyncExifToolWorker(self.executable)
+                    self._workers.append(worker)
+                    return worker
+                await self._condition.wait()
+
+    async def _release(self, worker):
+        async with self._condition:
+            if self._closed:
+                await worker.close()
+            else:
+                self._idle.append(worker)
+            self._condition.notify()
+
+    async def run(self, args, timeout=None, check=True):
+        result = (await self.run_many([args], timeout))[0]
+        if check and result.returncode:
+            raise subprocess.CalledProcessError(result.returncode, result.args, result.stdout, result.stderr)
+        return result
+
+    async def run_many(self, commands, timeout=None):
+        """Run a batch of commands on one worker, see ExifToolPool.run_many."""
+        timeout = timeout or self.timeout
+        attempts = 0
+        while True:
+            worker = await self._acquire()
+            try:
+                return await worker.execute_many(commands, timeout)
+            except ExifToolError:
+                attempts += 1
+                if attempts > self.retries:
+                    raise
+            finally:
+                await self._release(worker)
+
+    async def close(self):
+        async with self._condition:
+            self._closed = True
+            workers = self._idle
+            self._idle = []
+            self._condition.notify_all()
+        for worker in workers:
+            await worker.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
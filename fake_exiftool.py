@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+#########################################################################
+# File      fake_exiftool.py                                            #
+# Author    Adlai Gordon                                                #
+# Purpose   Stand-in for exiftool when benchmarking, so timings don't   #
+#             depend on the installed exiftool version                  #
+#           Understands what these scripts send: -json reads,           #
+#             -TAG=value writes and the -stay_open protocol. Written    #
+#             tags are kept in a trailer at the end of the file itself, #
+#             so they move with it. FAKE_EXIFTOOL_DELAY adds a fixed    #
+#             number of seconds per file to every command               #
+# Usage     benchmark.py puts it on the PATH as "exiftool"              #
+#########################################################################
+
+import json
+import os
+import re
+import shutil
+import sys
+import time
+
+trailer_start = b'\n<fake-exiftool>'
+trailer_end = b'</fake-exiftool>\n'
+
+# Bytes read from the end of a file to find the trailer
+trailer_search_size = 65536
+
+# Options that change nothing here
+ignored_options = {'-overwrite_original', '-n', '-q', '-G', '-a', '-s', '-fast', '-fast2'}
+
+
+def read_trailer(file_path):
+    # (tags from the trailer, offset where the trailer starts or None)
+    with open(file_path, 'rb') as file:
+        size = file.seek(0, os.SEEK_END)
+        start = max(0, size - trailer_search_size)
+        file.seek(start)
+        tail = file.read()
+    if not tail.endswith(trailer_end):
+        return {}, None
+    position = tail.rfind(trailer_start)
+    if position < 0:
+        return {}, None
+    return json.loads(tail[position + len(trailer_start):-len(trailer_end)]), start + position
+
+
+def write_trailer(file_path, tags):
+    existing, offset = read_trailer(file_path)
+    existing.update(tags)
+    # A new file renamed over the old one, like -overwrite_original
+    temporary_path = file_path + '_exiftool_tmp'
+    with open(file_path, 'rb') as source, open(temporary_path, 'wb') as file:
+        file.write(source.read() if offset is None else source.read(offset))
+        file.write(trailer_start + json.dumps(existing, sort_keys=True).encode('utf-8') + trailer_end)
+    shutil.copymode(file_path, temporary_path)
+    os.replace(temporary_path, file_path)
+
+
+def unreadable(file_path):
+    # Files pretending to be a JPEG without the JPEG header fail, like they would with exiftool
+    if os.path.splitext(file_path)[1].lower() in ('.jpg', '.jpeg'):
+        with open(file_path, 'rb') as file:
+            return file.read(2) != b'\xff\xd8'
+    return False
+
+
+def run(args, out, err):
+    as_json = False
+    tags, writes, files = [], {}, []
+    for arg in args:
+        if arg == '-json':
+            as_json = True
+        elif arg in ignored_options:
+            continue
+        elif arg.startswith('-') and '=' in arg:
+            name, value = arg[1:].split('=', 1)
+            writes[name] = value
+        elif arg.startswith('-'):
+            tags.append(arg[1:])
+        else:
+            files.append(arg)
+
+    delay = float(os.environ.get('FAKE_EXIFTOOL_DELAY') or 0)
+    if delay:
+        time.sleep(delay * len(files))
+
+    status = 0
+    if writes:
+        updated = 0
+        for file_path in files:
+            if not os.path.isfile(file_path):
+                err.write(f"Error: File not found - {file_path}\n")
+                status = 1
+            elif unreadable(file_path):
+                err.write(f"Error: Not a valid JPG - {file_path}\n")
+                status = 1
+            else:
+                write_trailer(file_path, writes)
+                updated += 1
+        if updated:
+            out.write(f"    {updated} image files updated\n")
+        if updated < len(files):
+            out.write(f"    {len(files) - updated} files weren't updated due to errors\n")
+        return status
+
+    records = []
+    for file_path in files:
+        if not os.path.isfile(file_path):
+            err.write(f"Error: File not found - {file_path}\n")
+            status = 1
+            continue
+        stored = read_trailer(file_path)[0]
+        if as_json:
+            record = {'SourceFile': file_path}
+            record.update((tag, stored[tag]) for tag in tags if tag in stored)
+            records.append(record)
+        else:
+            for tag in tags:
+                if tag in stored:
+                    out.write(f"{tag:<32}: {stored[tag]}\n")
+    if records:
+        out.write(json.dumps(records, indent=2) + "\n")
+    return status
+
+
+def stay_open():
+    # One argument per line, each command ends with -execute[N]
+    args = []
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            return 0
+        line = line.rstrip('\n')
+        execute = re.fullmatch(r'-execute(\d*)', line)
+        if execute:
+            echo = None
+            if '-echo4' in args:
+                index = args.index('-echo4')
+                echo = args[index + 1]
+                del args[index:index + 2]
+            run(args, sys.stdout, sys.stderr)
+            sys.stdout.write('{ready' + execute.group(1) + '}\n')
+            sys.stdout.flush()
+            if echo is not None:
+                sys.stderr.write(echo + '\n')
+            sys.stderr.flush()
+            args = []
+        elif args[-1:] == ['-stay_open'] and line == 'False':
+            return 0
+        else:
+            args.append(line)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:5] == ['-stay_open', 'True', '-@', '-']:
+        sys.exit(stay_open())
+    if sys.argv[1:] == ['-ver']:
+        print("fake")
+        sys.exit(0)
+    sys.exit(run(sys.argv[1:], sys.stdout, sys.stderr))
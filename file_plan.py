@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+
+#########################################################################
+# File      file_plan.py                                                #
+# Author    Adlai Gordon                                                #
+# Purpose   Plan every rename / move of a run before touching any file, #
+#             then apply the moves in bulk, one destination folder at a #
+#             time, keeping an undo log so a run can be rolled back     #
+#           Files can also be placed as a hard link, reflink or copy,   #
+#             leaving the original where it is                          #
+# Usage     ./file_plan.py --show <plan.json>                           #
+#           ./file_plan.py --undo <undo_<timestamp>.jsonl>              #
+#########################################################################
+
+import errno
+import json
+import os
+import shutil
+import sys
+from contextlib import nullcontext
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# How a file can be put at its target, see place_file
+output_modes = ['move', 'hardlink', 'reflink', 'copy']
+
+# ioctl from <linux/fs.h> making a file share the blocks of another (btrfs, XFS, bcachefs)
+FICLONE = 0x40049409
+
+# Bytes per copy_file_range, sendfile or read call
+copy_chunk_size = 8 * 1024 * 1024
+
+# Errors meaning a way of copying doesn't work between these two files, not that the copy failed
+unsupported_errors = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTTY,
+                      errno.EPERM, errno.EMLINK, errno.ENOTSOCK}
+
+
+class FilePlan:
+    """The metadata writes and file moves of a run, in the order they were planned.
+
+    Each operation is a plain dict so the plan can be saved and reviewed:
+    source and target paths (no target means the file stays where it is),
+    an optional mtime to set first, and whatever the caller needs to report
+    the result (section, entry, ...). An operation listing `requires` is
+    skipped when every one of those sources failed to move.
+    """
+
+    def __init__(self, writes=None, operations=None):
+        self.writes = writes or []
+        self.operations = operations or []
+
+    def add_write(self, file_path, tag_args):
+        self.writes.append({'file': file_path, 'args': list(tag_args)})
+
+    def add_move(self, source, target, mtime=None, **details):
+        operation = {'source': source, 'target': target, 'mtime': mtime}
+        operation.update(details)
+        self.operations.append(operation)
+        return operation
+
+    def save(self, path):
+        with open(path, 'w') as plan_file:
+            json.dump({'writes': self.writes, 'operations': self.operations}, plan_file, indent=4, default=str)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as plan_file:
+            data = json.load(plan_file)
+        return cls(data.get('writes'), data.get('operations'))
+
+    def describe(self):
+        # One line per move, relative to the folder the file came from
+        lines = []
+        for operation in self.operations:
+            if operation['target'] is None:
+                lines.append(f"{operation['source']} (unchanged)")
+            else:
+                target = os.path.relpath(operation['target'], os.path.dirname(operation['source']))
+                lines.append(f"{operation['source']} -> {target}")
+        return lines
+
+
+class UndoLog:
+    """Append-only JSON Lines list of the moves applied, written before each batch.
+
+    mode is the output mode of the run. Outside move mode every target is
+    a copy of a file that stayed where it was, so undo deletes it.
+    """
+
+    def __init__(self, path, mode='move'):
+        self.path = path
+        self.mode = mode
+
+    def record(self, operations):
+        # Absolute paths, so the log can be undone from any folder
+        entries = []
+        for operation in operations:
+            entry = {'source': os.path.abspath(operation['source']), 'target': os.path.abspath(operation['target'])}
+            if self.mode != 'move':
+                entry['mode'] = self.mode
+            if operation.get('mtime') is not None:
+                try:
+                    entry['previous_mtime'] = os.stat(operation['source']).st_mtime
+                except OSError:
+                    pass
+            entries.append(json.dumps(entry))
+
+        # Flushed to disk before the batch runs, so a crash can still be undone
+        with open(self.path, 'a') as undo_file:
+            if entries:
+                undo_file.write('\n'.join(entries) + '\n')
+                undo_file.flush()
+                os.fsync(undo_file.fileno())
+
+
+def apply_operations(operations, undo_log=None, before=None, after=None, transaction=nullcontext):
+    """Apply the moves, returning the error (or None) of each operation in order.
+
+    Operations are run one destination folder at a time, in the order the
+    folders first appear, so each folder is created once and its undo
+    entries are written together. before(operation) runs for every operation
+    of a folder ahead of its moves, after(operation) for each that moved once
+    they're done. Each of those two rounds is run inside transaction().
+    """
+    batches = {}
+    for index, operation in enumerate(operations):
+        if operation['target'] is not None:
+            batches.setdefault(os.path.dirname(operation['target']), []).append(index)
+
+    errors = [None] * len(operations)
+    failed_sources = set()
+    for target_directory, indexes in batches.items():
+        batch = []
+        for index in indexes:
+            operation = operations[index]
+            required = operation.get('requires')
+            if required and all(source in failed_sources for source in required):
+                errors[index] = 'skipped'
+            else:
+                batch.append(index)
+
+        os.makedirs(target_directory, exist_ok=True)
+        if undo_log:
+            undo_log.record([operations[index] for index in batch])
+
+        ready = []
+        with transaction():
+            for index in batch:
+                try:
+                    if before:
+                        before(operations[index])
+                    ready.append(index)
+                except Exception as e:
+                    errors[index] = str(e)
+                    failed_sources.add(operations[index]['source'])
+
+        moved = []
+        for index in ready:
+            operation = operations[index]
+            try:
+                if operation.get('mtime') is not None:
+                    # Set before the move so the file never sits in the
+                    # target folder with the wrong time
+                    try:
+                        os.utime(operation['source'], (operation['mtime'], operation['mtime']))
+                        operation['mtime_updated'] = True
+                    except OSError as e:
+                        operation['mtime_updated'] = False
+                        print(f"Error setting the time of {operation['source']}: {e}")
+                move_file(operation['source'], operation['target'])
+                moved.append(operation)
+            except Exception as e:
+                errors[index] = str(e)
+                failed_sources.add(operation['source'])
+
+        if after:
+            with transaction():
+                for operation in moved:
+                    after(operation)
+    return errors
+
+
+def move_file(source, target):
+    # A link and unlink when both are on the same filesystem, a copy
+    # otherwise. Unlike a rename this never replaces an existing target,
+    # the move fails with FileExistsError instead
+    try:
+        os.link(source, target, follow_symlinks=False)
+    except FileExistsError:
+        raise
+    except OSError as e:
+        if e.errno not in unsupported_errors:
+            raise
+        # Another filesystem, or one without hard links
+        if os.path.lexists(target):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), target)
+        if e.errno == errno.EXDEV:
+            copy_file(source, target)
+            os.remove(source)
+        else:
+            os.rename(source, target)
+    else:
+        os.unlink(source)
+
+
+def place_file(source, target, mode='move'):
+    """Put source at target, one of output_modes.
+
+    Every mode but move leaves source as it is. A hard link or reflink
+    that isn't possible (another filesystem, no reflink support) becomes
+    a copy.
+    """
+    if mode == 'move':
+        move_file(source, target)
+    elif mode == 'hardlink':
+        link_file(source, target)
+    elif mode == 'reflink':
+        clone_file(source, target)
+    else:
+        copy_file(source, target)
+
+
+def link_file(source, target):
+    try:
+        os.link(source, target)
+    except OSError as e:
+        if e.errno not in unsupported_errors:
+            raise
+        copy_file(source, target)
+
+
+def clone_file(source, target):
+    # The copy shares the original's blocks until either is changed
+    if fcntl is not None:
+        try:
+            with open(source, 'rb') as source_file, open(target, 'wb') as target_file:
+                fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+            shutil.copystat(source, target)
+            return
+        except OSError as e:
+            if e.errno not in unsupported_errors:
+                raise
+    copy_file(source, target)
+
+
+def copy_file(source, target):
+    """Copy source to target with its mode and times, inside the kernel where possible.
+
+    copy_file_range lets the filesystem share blocks or copy on the server
+    (NFS, SMB), sendfile still avoids copying through Python, and large
+    reads are the last resort.
+    """
+    with open(source, 'rb', buffering=0) as source_file, open(target, 'wb', buffering=0) as target_file:
+        source_fd, target_fd = source_file.fileno(), target_file.fileno()
+        remaining = os.fstat(source_fd).st_size
+        # Both use and move on the file positions, so one can carry on where another stopped
+        kernel_copies = []
+        if hasattr(os, 'copy_file_range'):
+            kernel_copies.append(lambda count: os.copy_file_range(source_fd, target_fd, count))
+        if hasattr(os, 'sendfile'):
+            kernel_copies.append(lambda count: os.sendfile(target_fd, source_fd, None, count))
+        for kernel_copy in kernel_copies:
+            try:
+                while remaining > 0:
+                    copied = kernel_copy(min(copy_chunk_size, remaining))
+                    if not copied:
+                        break
+                    remaining -= copied
+            except OSError as e:
+                if e.errno not in unsupported_errors:
+                    raise
+            if remaining <= 0:
+                break
+        if remaining > 0:
+            shutil.copyfileobj(source_file, target_file, copy_chunk_size)
+    shutil.copystat(source, target)
+
+
+def break_hard_link(file_path):
+    # Gives a file with other hard links its own copy, so changing its time leaves theirs alone
+    if os.stat(file_path).st_nlink > 1:
+        temporary_path = file_path + '.unlink'
+        clone_file(file_path, temporary_path)
+        os.replace(temporary_path, file_path)
+
+
+def undo(undo_log_path):
+    """Move every file in an undo log back, newest first. Returns how many were undone.
+
+    Only the moves are undone, metadata written to the files stays. Copies
+    and links placed by the other output modes are deleted instead.
+    """
+    with open(undo_log_path, 'r') as undo_file:
+        entries = []
+        for line in undo_file:
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+
+    restored = 0
+    for entry in reversed(entries):
+        source, target = entry['source'], entry['target']
+        if entry.get('mode', 'move') != 'move':
+            try:
+                os.remove(target)
+                restored += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Error undoing {target}: {e}")
+            continue
+        if not os.path.exists(target) or os.path.exists(source):
+            continue
+        try:
+            os.makedirs(os.path.dirname(source), exist_ok=True)
+            move_file(target, source)
+            if 'previous_mtime' in entry:
+                os.utime(source, (entry['previous_mtime'], entry['previous_mtime']))
+            restored += 1
+        except OSError as e:
+            print(f"Error undoing {target}: {e}")
+    return restored
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] not in ('--show', '--undo'):
+        print(f"Usage: {sys.argv[0]} --show <plan.json> | --undo <undo log>")
+        sys.exit(1)
+
+    if sys.argv[1] == '--show':
+        for line in FilePlan.load(sys.argv[2]).describe():
+            print(line)
+    else:
+        print(f"{undo(sys.argv[2])} files moved back or removed")
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+#########################################################################
+# File      gpx_track_index.py                                          #
+# Author    Adlai Gordon                                                #
+# Purpose   Find where a photo was taken from a directory of GPX tracks #
+#           Every track point is loaded into one time-sorted index and  #
+#             positions are interpolated between the fixes around each  #
+#             photo, as long as they are no more than max_gap apart     #
+# Usage     ./gpx_track_index.py <gpx directory> <takeout directory>    #
+#             [--max-gap SECONDS]                                       #
+# Dependencies                                                          #
+#           numpy (optional, lookups fall back to bisect without it)    #
+#########################################################################
+
+import argparse
+import bisect
+import json
+import os
+import xml.etree.ElementTree as ET
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Longest time between two fixes that is still interpolated, and the
+# furthest a photo can be from the nearest fix, the same default as
+# exiftool's GeoMaxIntSecs
+default_max_gap = 1800
+
+# Decimal places kept in an interpolated position, about 10 cm
+position_decimals = 6
+
+
+def local_name(tag):
+    return tag.rpartition('}')[2]
+
+
+def parse_gpx_time(text):
+    # '2024-06-01T08:00:00Z' -> seconds since the epoch, times without an offset are UTC
+    when = datetime.fromisoformat(text.strip().replace('Z', '+00:00'))
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when.timestamp()
+
+
+def utc_epoch(when):
+    # Naive datetimes (like get_photo_taken_time's) are UTC
+    if isinstance(when, datetime):
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)
+        return when.timestamp()
+    return float(when)
+
+
+def read_track_points(filepath):
+    """Return (times, latitudes, longitudes) arrays of every timed trkpt in a GPX file.
+
+    The file is streamed and finished points are dropped as it goes, so
+    memory only grows with the arrays.
+    """
+    times, latitudes, longitudes = array('d'), array('d'), array('d')
+    parents = []
+    point = None
+    with open(filepath, 'rb') as gpx_file:
+        for event, elem in ET.iterparse(gpx_file, events=('start', 'end')):
+            if event == 'start':
+                if local_name(elem.tag) == 'trkpt':
+                    point = elem
+                parents.append(elem)
+                continue
+
+            parents.pop()
+            if elem is point:
+                time_text = None
+                for child in elem:
+                    if local_name(child.tag) == 'time':
+                        time_text = child.text
+                # A point without a usable time or position is skipped
+                try:
+                    fix = parse_gpx_time(time_text), float(elem.get('lat')), float(elem.get('lon'))
+                except (AttributeError, TypeError, ValueError):
+                    fix = None
+                if fix:
+                    times.append(fix[0])
+                    latitudes.append(fix[1])
+                    longitudes.append(fix[2])
+                point = None
+            if parents and point is None:
+                del parents[-1][:]
+    return times, latitudes, longitudes
+
+
+class GpxTrackIndex:
+    """Every track point of a set of GPX files, sorted by time.
+
+    Stored as parallel arrays (NumPy when it's installed) so a whole
+    library of photos can be located with one searchsorted call.
+    """
+
+    def __init__(self, times, latitudes, longitudes, tracks, track_names, max_gap=default_max_gap):
+        self.max_gap = max_gap
+        self.track_names = list(track_names)
+
+        if np is not None:
+            times = np.frombuffer(times, dtype=np.float64) if isinstance(times, array) else np.asarray(times, dtype=np.float64)
+            order = np.argsort(times, kind='stable')
+            self.times = times[order]
+            self.latitudes = np.asarray(latitudes, dtype=np.float64)[order]
+            self.longitudes = np.asarray(longitudes, dtype=np.float64)[order]
+            self.tracks = np.asarray(tracks, dtype=np.int32)[order]
+        else:
+            order = sorted(range(len(times)), key=times.__getitem__)
+            self.times = array('d', (times[i] for i in order))
+            self.latitudes = array('d', (latitudes[i] for i in order))
+            self.longitudes = array('d', (longitudes[i] for i in order))
+            self.tracks = array('i', (tracks[i] for i in order))
+
+    @classmethod
+    def from_directory(cls, directory, max_gap=default_max_gap, workers=4):
+        """Load every .gpx file below a directory, unreadable files are reported and skipped."""
+        paths = sorted(os.path.join(root, name)
+                       for root, dirs, names in os.walk(directory)
+                       for name in names if name.lower().endswith('.gpx'))
+
+        def read(path):
+            try:
+                return read_track_points(path)
+            except (ET.ParseError, OSError) as e:
+                print(f"Error reading GPX track {path}: {e}")
+                return array('d'), array('d'), array('d')
+
+        times, latitudes, longitudes, tracks = array('d'), array('d'), array('d'), array('i')
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for track, (track_times, track_latitudes, track_longitudes) in enumerate(executor.map(read, paths)):
+                times.extend(track_times)
+                latitudes.extend(track_latitudes)
+                longitudes.extend(track_longitudes)
+                tracks.extend([track] * len(track_times))
+        return cls(times, latitudes, longitudes, tracks, [os.path.relpath(path, directory) for path in paths], max_gap)
+
+    def __len__(self):
+        return len(self.times)
+
+    def locate(self, when):
+        """Return (latitude, longitude, track name) at `when`, or None if no fix is close enough."""
+        return self.locate_many([when])[0]
+
+    def locate_many(self, whens):
+        """locate() for a whole list of times at once."""
+        if not len(self.times):
+            return [None] * len(whens)
+        epochs = [utc_epoch(when) for when in whens]
+        if np is not None:
+            return self._locate_numpy(np.asarray(epochs, dtype=np.float64))
+        return [self._locate_one(epoch) for epoch in epochs]
+
+    def _locate_numpy(self, epochs):
+        count = len(self.times)
+        after = np.searchsorted(self.times, epochs, side='left')
+        before = after - 1
+        has_before, has_after = before >= 0, after < count
+        before_index, after_index = np.clip(before, 0, count - 1), np.clip(after, 0, count - 1)
+        before_time, after_time = self.times[before_index], self.times[after_index]
+
+        # Between two fixes close enough together: interpolate
+        bracketed = has_before & has_after & (after_time - before_time <= self.max_gap)
+        span = np.where(bracketed & (after_time > before_time), after_time - before_time, 1.0)
+        fraction = np.where(bracketed, (epochs - before_time) / span, 0.0)
+        latitudes = self.latitudes[before_index] + (self.latitudes[after_index] - self.latitudes[before_index]) * fraction
+        longitudes = self.longitudes[before_index] + (self.longitudes[after_index] - self.longitudes[before_index]) * fraction
+
+        # Otherwise the nearest fix, if it's within max_gap
+        before_distance = np.where(has_before, epochs - before_time, np.inf)
+        after_distance = np.where(has_after, after_time - epochs, np.inf)
+        nearest = np.where(before_distance <= after_distance, before_index, after_index)
+        use_nearest = ~bracketed & (np.minimum(before_distance, after_distance) <= self.max_gap)
+        latitudes = np.where(use_nearest, self.latitudes[nearest], latitudes)
+        longitudes = np.where(use_nearest, self.longitudes[nearest], longitudes)
+        tracks = np.where(use_nearest, self.tracks[nearest], self.tracks[before_index])
+
+        found = bracketed | use_nearest
+        return [(round(float(latitude), position_decimals), round(float(longitude), position_decimals), self.track_names[track]) if ok else None
+                for ok, latitude, longitude, track in zip(found.tolist(), latitudes.tolist(), longitudes.tolist(), tracks.tolist())]
+
+    def _locate_one(self, epoch):
+        after = bisect.bisect_left(self.times, epoch)
+        before = after - 1
+        has_before, has_after = before >= 0, after < len(self.times)
+
+        if has_before and has_after and self.times[after] - self.times[before] <= self.max_gap:
+            span = self.times[after] - self.times[before]
+            fraction = (epoch - self.times[before]) / span if span else 0.0
+            latitude = self.latitudes[before] + (self.latitudes[after] - self.latitudes[before]) * fraction
+            longitude = self.longitudes[before] + (self.longitudes[after] - self.longitudes[before]) * fraction
+            return round(latitude, position_decimals), round(longitude, position_decimals), self.track_names[self.tracks[before]]
+
+        before_distance = epoch - self.times[before] if has_before else float('inf')
+        after_distance = self.times[after] - epoch if has_after else float('inf')
+        nearest = before if before_distance <= after_distance else after
+        if min(before_distance, after_distance) > self.max_gap:
+            return None
+        return (round(self.latitudes[nearest], position_decimals), round(self.longitudes[nearest], position_decimals),
+                self.track_names[self.tracks[nearest]])
+
+
+def sidecar_taken_times(directory):
+    # (sidecar path, photoTakenTime) of every sidecar without a location
+    for root, dirs, names in os.walk(directory):
+        for name in sorted(names):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(root, name)
+            try:
+                with open(path, 'r') as file:
+                    metadata = json.load(file)
+                geo_data = metadata.get('geoData') or metadata.get('geoDataExif') or {}
+                if geo_data.get('latitude', 0.0) == 0.0 and geo_data.get('longitude', 0.0) == 0.0:
+                    yield path, int(metadata['photoTakenTime']['timestamp'])
+            except (ValueError, KeyError, TypeError, OSError, AttributeError):
+                continue
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Show where the photos of a Takeout directory without a location were, according to GPX tracks")
+    arg_parser.add_argument('gpx_directory')
+    arg_parser.add_argument('takeout_directory')
+    arg_parser.add_argument('--max-gap', type=float, default=default_max_gap,
+                            help="seconds between fixes that are still interpolated, and the furthest a photo can be from a fix")
+    args = arg_parser.parse_args()
+
+    index = GpxTrackIndex.from_directory(args.gpx_directory, args.max_gap)
+    print(f"{len(index)} track points from {len(index.track_names)} files")
+
+    sidecars = list(sidecar_taken_times(args.takeout_directory))
+    positions = index.locate_many([taken for path, taken in sidecars])
+    for (path, taken), position in zip(sidecars, positions):
+        if position:
+            print(f"{path}: {position[0]}, {position[1]} ({position[2]})")
+    print(f"{sum(1 for position in positions if position)} of {len(sidecars)} photos without a location placed")
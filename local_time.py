@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+#########################################################################
+# File      local_time.py                                               #
+# Author    Adlai Gordon                                                #
+# Purpose   Turn UTC timestamps into local times for many photos at     #
+#             once, using the real rules of each time zone (zoneinfo)   #
+#           A zone's UTC offset changes are worked out once per year    #
+#             into a transition table, only for the years the photos    #
+#             were taken in, after that a whole directory of photos is  #
+#             one searchsorted per zone                                 #
+# Dependencies                                                          #
+#           numpy (optional, lookups fall back to bisect without it)    #
+#           tzdata on systems without a zoneinfo database               #
+#########################################################################
+
+import bisect
+import re
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Transition tables cover these years, times outside keep the first/last offset
+table_start_year = 1900
+table_end_year = 2100
+
+# Offsets are checked once a day, changes are then found to the second
+probe_step = 24 * 3600
+
+epoch = datetime(1970, 1, 1)
+
+
+@lru_cache(maxsize=None)
+def year_transitions(zone_name, year):
+    """Return [(epoch, offset, dst)] for the start of a UTC year and each change during it."""
+    zone = ZoneInfo(zone_name)
+
+    def offset_at(when):
+        local_time = datetime.fromtimestamp(when, zone)
+        return int(local_time.utcoffset().total_seconds()), bool(local_time.dst())
+
+    start = int(datetime(year, 1, 1, tzinfo=timezone.utc).timestamp())
+    end = int(datetime(year + 1, 1, 1, tzinfo=timezone.utc).timestamp())
+
+    current = offset_at(start)
+    transitions = [(start,) + current]
+    when = start
+    while when < end:
+        step = min(when + probe_step, end)
+        if offset_at(step) == current:
+            when = step
+            continue
+
+        # The first second with a different offset
+        low, high = when, step
+        while high - low > 1:
+            middle = (low + high) // 2
+            if offset_at(middle) == current:
+                low = middle
+            else:
+                high = middle
+        current = offset_at(high)
+        transitions.append((high,) + current)
+        when = high
+    return transitions
+
+
+@lru_cache(maxsize=None)
+def zone_transitions(zone_name, first_year=table_start_year, last_year=table_end_year):
+    """Return (epochs, offsets, dst flags) for a zone from first_year to last_year (UTC).
+
+    offsets[i] (UTC offset in seconds) and dst[i] apply from epochs[i] up
+    to the next transition.
+    """
+    transitions = year_transitions(zone_name, first_year)[:1]
+    for year in range(first_year, last_year + 1):
+        for transition in year_transitions(zone_name, year):
+            # A year starts with the offset the last one ended with
+            if transition[1:] != transitions[-1][1:]:
+                transitions.append(transition)
+
+    epochs, offsets, dst = (list(column) for column in zip(*transitions))
+    if np is not None:
+        return np.array(epochs, dtype=np.int64), np.array(offsets, dtype=np.int64), np.array(dst, dtype=bool)
+    return epochs, offsets, dst
+
+
+def year_range(epochs):
+    """First and last UTC year of some epochs, within the years tables cover."""
+    first_year = (epoch + timedelta(seconds=int(min(epochs)))).year if len(epochs) else table_start_year
+    last_year = (epoch + timedelta(seconds=int(max(epochs)))).year if len(epochs) else table_start_year
+    return max(table_start_year, min(first_year, table_end_year)), max(table_start_year, min(last_year, table_end_year))
+
+
+def utc_offsets(epochs, zone_names):
+    """Return (offsets in seconds, dst flags) of each UTC epoch in its zone."""
+    if np is None:
+        offsets, dst = [], []
+        for when, zone_name in zip(epochs, zone_names):
+            zone_epochs, zone_offsets, zone_dst = zone_transitions(zone_name, *year_range([when]))
+            index = max(0, bisect.bisect_right(zone_epochs, when) - 1)
+            offsets.append(zone_offsets[index])
+            dst.append(zone_dst[index])
+        return offsets, dst
+
+    epochs = np.asarray(epochs, dtype=np.int64)
+    offsets = np.zeros(len(epochs), dtype=np.int64)
+    dst = np.zeros(len(epochs), dtype=bool)
+    if not len(epochs):
+        return offsets, dst
+
+    # One lookup for every photo in the same zone
+    zones, zone_index = np.unique(np.asarray(zone_names, dtype=object).astype(str), return_inverse=True)
+    for number, zone_name in enumerate(zones.tolist()):
+        selected = zone_index == number
+        zone_epochs, zone_offsets, zone_dst = zone_transitions(zone_name, *year_range(epochs[selected]))
+        index = np.maximum(np.searchsorted(zone_epochs, epochs[selected], side='right') - 1, 0)
+        offsets[selected] = zone_offsets[index]
+        dst[selected] = zone_dst[index]
+    return offsets, dst
+
+
+def format_times(epochs, datetime_format, offsets=None):
+    """Format UTC epochs (shifted by offsets seconds) as naive times with a strftime format."""
+    if offsets is not None:
+        epochs = [when + offset for when, offset in zip(epochs, offsets)]
+
+    # Formats made only of these fields are filled in from numpy's ISO strings
+    template = _iso_template(datetime_format)
+    if np is None or template is None:
+        return [(epoch + timedelta(seconds=int(when))).strftime(datetime_format) for when in epochs]
+
+    iso_times = np.datetime_as_string(np.asarray(epochs, dtype=np.int64).astype('datetime64[s]'), unit='s').tolist()
+    return [template.format(iso[:4], iso[5:7], iso[8:10], iso[11:13], iso[14:16], iso[17:19]) for iso in iso_times]
+
+
+@lru_cache(maxsize=16)
+def _iso_template(datetime_format):
+    # '%Y-%m-%d_%H-%M-%S' -> '{0}-{1}-{2}_{3}-{4}-{5}', None for anything else
+    fields = {'Y': '{0}', 'm': '{1}', 'd': '{2}', 'H': '{3}', 'M': '{4}', 'S': '{5}'}
+    template = datetime_format.replace('{', '{{').replace('}', '}}')
+    template = re.sub(r'%(.)', lambda match: fields.get(match.group(1), '\0'), template)
+    return None if '\0' in template else template
+
+
+def local_times(epochs, zone_names, datetime_format):
+    """For each UTC epoch and zone return (offset in hours, is_dst, formatted local time)."""
+    offsets, dst = utc_offsets(epochs, zone_names)
+    formatted = format_times(epochs, datetime_format, offsets)
+    if np is not None:
+        offsets, dst = offsets.tolist(), dst.tolist()
+    return [(offset // 3600 if offset % 3600 == 0 else offset / 3600, is_dst, local_time)
+            for offset, is_dst, local_time in zip(offsets, dst, formatted)]
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+#########################################################################
+# File      metadata_cache.py                                           #
+# Author    Adlai Gordon                                                #
+# Purpose   Remember metadata already extracted from a file so reruns   #
+#             over the same trees skip exiftool / PIL / XML parsing     #
+#           Entries are keyed by device, inode, size and mtime, so a    #
+#             rename keeps the entry and any write invalidates it       #
+# Usage     ./metadata_cache.py --stats | --clear | --invalidate <path> #
+#########################################################################
+
+import atexit
+import json
+import os
+import sqlite3
+import sys
+import threading
+
+from content_index import head_tail_hash
+
+# Returned by get() when nothing is cached, since None is a valid cached value
+MISS = object()
+
+default_cache_path = os.path.join(os.path.expanduser('~'), '.cache', 'file-processing', 'metadata.sqlite')
+default_max_entries = 1000000
+
+# Cache hits whose last_used is updated together
+touched_batch_size = 500
+
+
+class MetadataCache:
+    """SQLite-backed cache of extracted metadata, shared by all the scripts.
+
+    Each script stores its results under its own field name. With
+    verify_content a hash of the start and end of the file is checked too,
+    for filesystems where mtime can't be trusted.
+    """
+
+    def __init__(self, path=default_cache_path, max_entries=default_max_entries, verify_content=False):
+        self.path = path
+        self.max_entries = max_entries
+        self.verify_content = verify_content
+        self._lock = threading.Lock()
+        self._puts = 0
+        # (last_used, file_key, field) of hits, written in one transaction
+        # so a get never holds the database open for writing
+        self._touched = []
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS metadata ('
+            ' file_key TEXT NOT NULL,'
+            ' field TEXT NOT NULL,'
+            ' path TEXT,'
+            ' content_hash TEXT,'
+            ' value TEXT,'
+            ' last_used INTEGER,'
+            ' PRIMARY KEY (file_key, field))')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS metadata_last_used ON metadata (last_used)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS metadata_path ON metadata (path)')
+        self.connection.commit()
+        self._clock = self.connection.execute('SELECT COALESCE(MAX(last_used), 0) FROM metadata').fetchone()[0]
+
+    def get(self, file_path, field, default=MISS):
+        try:
+            file_key = _file_key(file_path)
+        except OSError:
+            return default
+
+        with self._lock:
+            try:
+                row = self.connection.execute(
+                    'SELECT content_hash, value FROM metadata WHERE file_key = ? AND field = ?',
+                    (file_key, field)).fetchone()
+            except sqlite3.Error:
+                # Busy or broken, either way just a miss
+                return default
+            if row is None:
+                return default
+            if self.verify_content and row[0] != head_tail_hash(file_path):
+                return default
+            self._clock += 1
+            self._touched.append((self._clock, file_key, field))
+            if len(self._touched) >= touched_batch_size:
+                self._flush_touched()
+        return json.loads(row[1])
+
+    def _flush_touched(self):
+        # Called with the lock held. Recency is only a hint, lost updates don't matter
+        touched, self._touched = self._touched, []
+        try:
+            self.connection.executemany('UPDATE metadata SET last_used = ? WHERE file_key = ? AND field = ?', touched)
+            self.connection.commit()
+        except sqlite3.Error:
+            self.connection.rollback()
+
+    def put(self, file_path, field, value):
+        self.put_many(field, [(file_path, value)])
+
+    def put_many(self, field, items):
+        rows = []
+        for file_path, value in items:
+            try:
+                content_hash = head_tail_hash(file_path) if self.verify_content else None
+                rows.append((_file_key(file_path), field, os.path.abspath(file_path), content_hash, json.dumps(value)))
+            except OSError:
+                continue
+
+        with self._lock:
+            self._flush_touched()
+            try:
+                for row in rows:
+                    self._clock += 1
+                    self.connection.execute(
+                        'INSERT OR REPLACE INTO metadata (file_key, field, path, content_hash, value, last_used)'
+                        ' VALUES (?, ?, ?, ?, ?, ?)', row + (self._clock,))
+                self.connection.commit()
+
+                # Checking the size on every put would cost more than it saves
+                self._puts += len(rows)
+                if self._puts >= 1000:
+                    self._puts = 0
+                    self._evict()
+            except sqlite3.Error as e:
+                # Another process holding the cache only costs these entries
+                self.connection.rollback()
+                print(f"Metadata cache not updated: {e}")
+
+    def _evict(self):
+        # Drop the least recently used entries down to 90% of the limit
+        count = self.connection.execute('SELECT COUNT(*) FROM metadata').fetchone()[0]
+        if count > self.max_entries:
+            excess = count - int(self.max_entries * 0.9)
+            self.connection.execute(
+                'DELETE FROM metadata WHERE rowid IN'
+                ' (SELECT rowid FROM metadata ORDER BY last_used LIMIT ?)', (excess,))
+            self.connection.commit()
+
+    def invalidate(self, file_path=None):
+        """Forget one file (by its current or last cached path), or everything."""
+        with self._lock:
+            if file_path is None:
+                self.connection.execute('DELETE FROM metadata')
+            else:
+                self.connection.execute('DELETE FROM metadata WHERE path = ?', (os.path.abspath(file_path),))
+                try:
+                    self.connection.execute('DELETE FROM metadata WHERE file_key = ?', (_file_key(file_path),))
+                except OSError:
+                    pass
+            self.connection.commit()
+
+    def stats(self):
+        with self._lock:
+            count = self.connection.execute('SELECT COUNT(*) FROM metadata').fetchone()[0]
+        return {'path': self.path, 'entries': count, 'max_entries': self.max_entries}
+
+    def close(self):
+        with self._lock:
+            self._flush_touched()
+            self.connection.close()
+
+
+def _file_key(file_path):
+    st = os.stat(file_path)
+    return f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+def get_metadata_cache():
+    """The cache shared within this process, or None when disabled.
+
+    FILE_PROCESSING_CACHE sets the database path, or turns the cache off
+    with "off". FILE_PROCESSING_CACHE_VERIFY=1 turns on content hashing.
+    """
+    global _shared_cache
+    setting = os.environ.get('FILE_PROCESSING_CACHE', default_cache_path)
+    if setting.lower() in ('off', '0', 'none', ''):
+        return None
+
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            try:
+                _shared_cache = MetadataCache(
+                    setting, verify_content=os.environ.get('FILE_PROCESSING_CACHE_VERIFY') == '1')
+                atexit.register(_shared_cache.close)
+            except (OSError, sqlite3.Error) as e:
+                print(f"Metadata cache disabled: {e}")
+                os.environ['FILE_PROCESSING_CACHE'] = 'off'
+                return None
+        return _shared_cache
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ('--stats', '--clear', '--invalidate'):
+        print(f"Usage: {sys.argv[0]} --stats | --clear | --invalidate <path> [path ...]")
+        sys.exit(1)
+
+    cache = get_metadata_cache()
+    if cache is None:
+        print("Metadata cache is turned off")
+        sys.exit(1)
+
+    if sys.argv[1] == '--clear':
+        cache.invalidate()
+    elif sys.argv[1] == '--invalidate':
+        for path in sys.argv[2:]:
+            cache.invalidate(path)
+    print(cache.stats())
+    cache.close()
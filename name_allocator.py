@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+#########################################################################
+# File      name_allocator.py                                           #
+# Author    Adlai Gordon                                                #
+# Purpose   Hand out file names that are free in a directory without    #
+#             checking os.path.exists for every _1, _2, ... candidate   #
+#           Each directory is listed once, every name handed out after  #
+#             that is remembered, so a burst of photos with the same    #
+#             timestamp costs one lookup each                           #
+#########################################################################
+
+import os
+import threading
+
+
+class NameAllocator:
+    """Unique target names per directory, safe to share between threads.
+
+    Only names handed out by this allocator are tracked after the first
+    listing, so every rename into a directory should go through the same
+    instance.
+    """
+
+    def __init__(self):
+        self._taken = {}
+        self._next_counter = {}
+        self._lock = threading.Lock()
+
+    def _names(self, directory):
+        # Listed the first time a directory is used
+        names = self._taken.get(directory)
+        if names is None:
+            try:
+                with os.scandir(directory) as entries:
+                    names = {entry.name for entry in entries}
+            except FileNotFoundError:
+                names = set()
+            self._taken[directory] = names
+        return names
+
+    def allocate(self, directory, base_name, extension, separator='_', replacing=None):
+        """Return base_name + extension, or the next free base_name<separator>N + extension.
+
+        replacing is the current name of a file being renamed within the
+        same directory, which doesn't block its own new name.
+        """
+        with self._lock:
+            names = self._names(directory)
+            if replacing is not None:
+                names.discard(replacing)
+
+            name = f"{base_name}{extension}"
+            if name in names:
+                key = (directory, base_name, extension, separator)
+                counter = self._next_counter.get(key, 1)
+                while name in names:
+                    name = f"{base_name}{separator}{counter}{extension}"
+                    counter += 1
+                self._next_counter[key] = counter
+
+            names.add(name)
+            return name
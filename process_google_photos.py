@@ -8,148 +8,340 @@
 #             Modify file created date to best guess match original     #
 #             Handle "Live Photos" (TODO)                               #
 # Dependencies                                                          #
-#           exiftool, pytz, python-dateutil, and more (check imports)                    #
+#           exiftool, python-dateutil, and more (check imports)         #
 #########################################################################
 
+import argparse
 import os
 import re
 import shutil
+import signal
 import sys
 import json
-import subprocess
-from datetime import datetime, timedelta
+import atexit
+import threading
+import time
+from array import array
+from contextlib import nullcontext
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from dateutil import parser
-import pytz
 from timezonefinder import TimezoneFinder
 import pdb
 from pprint import pprint
+from exif_reader import read_tags
+from exif_writer import write_jpeg_tags
+from content_index import ContentIndex, find_duplicates, index_filename as content_index_filename
+from directory_watcher import open_watcher
+from exiftool_pool import ExifToolPool
+from file_plan import FilePlan, UndoLog, apply_operations, break_hard_link, move_file, output_modes, place_file, undo
+from gpx_track_index import GpxTrackIndex, default_max_gap
+import local_time
+from metadata_cache import MISS, get_metadata_cache
+from name_allocator import NameAllocator
+from run_metrics import metrics, run_profiled
+import run_state as stages
+from run_state import RunState
+from takeout_archive import extract_chunks, find_archives
+from takeout_index import SidecarMatcher, match_sidecars, scan_tree
 
 # Set this to be the desired output format for the new filenames
 desired_datetime_format = '%Y-%m-%d_%H-%M-%S'
 
-dst_dates = {
-    1994: ('April 03', 'September 18'),
-    1995: ('April 02', 'September 17'),
-    1996: ('April 07', 'September 22'),
-    1997: ('April 06', 'September 21'),
-    1998: ('April 05', 'September 20'),
-    1999: ('April 04', 'September 19'),
-    2000: ('April 02', 'September 17'),
-    2001: ('April 01', 'September 23'),
-    2002: ('April 07', 'September 22'),
-    2003: ('April 06', 'September 21'),
-    2004: ('April 04', 'September 19'),
-    2005: ('April 03', 'September 18'),
-    2006: ('April 02', 'September 17'),
-    2007: ('March 11', 'November 04'),
-    2008: ('March 09', 'November 02'),
-    2009: ('March 08', 'November 01'),
-    2010: ('March 14', 'November 07'),
-    2011: ('March 13', 'November 06'),
-    2012: ('March 11', 'November 04'),
-    2013: ('March 10', 'November 03'),
-    2014: ('March 09', 'November 02'),
-    2015: ('March 08', 'November 01'),
-    2016: ('March 13', 'November 06'),
-    2017: ('March 12', 'November 05'),
-    2018: ('March 11', 'November 04'),
-    2019: ('March 10', 'November 03'),
-    2020: ('March 08', 'November 01'),
-    2021: ('March 14', 'November 07'),
-    2022: ('March 13', 'November 06'),
-    2023: ('March 12', 'November 05')
-}
-
-def is_daylight_savings_time(dt):
-    year = dt.year
-    start_date_str, end_date_str = dst_dates.get(year, (None, None))
-    
-    if start_date_str and end_date_str:
-        start_date = datetime.strptime(f"{year} {start_date_str}", "%Y %B %d")
-        end_date = datetime.strptime(f"{year} {end_date_str}", "%Y %B %d")
-        
-        return start_date <= dt <= end_date
-    
-    return False
+# Long-lived exiftool processes shared by every read and write
+exiftool_pool = ExifToolPool(size=2, timeout=60)
+atexit.register(exiftool_pool.close)
+
+# Tags checked for the original created date, in order of preference
+created_date_tags = ['CreationDate', 'CreateDate', 'DateTimeOriginal', 'DateCreated']
+
+# Number of files per exiftool -json metadata read
+metadata_batch_size = 500
+
+# Field the exiftool records are kept under in the shared metadata cache
+metadata_cache_field = 'exiftool-dates-description'
+
+# Number of files per batch of exiftool writes
+write_batch_size = 500
+
+# Writers tried before exiftool, each takes (file_path, tag_args) and
+# returns (succeeded, output), or None to leave the file to exiftool
+native_writers = [write_jpeg_tags]
+
+# GpxTrackIndex used to place photos whose sidecar has no location, set by --gpx
+gpx_track_index = None
+
+# What happens to copies of a file already processed, set by --dedup: None
+# (processed again), 'skip' (moved to duplicates) or 'link' (moved there as a
+# hard link to the copy that was kept)
+dedup_mode = None
+
+# How the files of a directory get into the result folders, set by
+# --output-mode: 'move' them, or leave the Takeout as it is and process a
+# 'hardlink', 'reflink' or 'copy' of each (see file_plan.place_file)
+output_mode = 'move'
+
+# Seconds the directory has to be quiet in watch mode before new files are looked at
+watch_settle_seconds = 10
+
+# Seconds an image waits for its sidecar in watch mode before it's processed without one
+watch_sidecar_wait = 600
+
+# Zone used for photos without a location
+default_timezone = 'America/New_York'
 
 def read_sidecar_json(file_path):
     with open(file_path, 'r') as file:
         return json.load(file)
 
-def determine_timezone(latitude, longitude):
+# Timezone lookups are cached on a grid of this many degrees (about 1 km)
+timezone_cell_size = 0.01
+timezone_cache_size = 65536
+
+_timezone_finder = None
+_timezone_finder_lock = threading.Lock()
+
+def get_timezone_finder():
+    # Loading the polygon data is slow, so one finder is shared by the whole process
+    global _timezone_finder
+    with _timezone_finder_lock:
+        if _timezone_finder is None:
+            _timezone_finder = TimezoneFinder()
+        return _timezone_finder
+
+@lru_cache(maxsize=timezone_cache_size)
+def timezone_for_cell(lat_cell, lng_cell):
+    finder = get_timezone_finder()
+    with _timezone_finder_lock:
+        return finder.timezone_at(lng=lng_cell * timezone_cell_size, lat=lat_cell * timezone_cell_size)
+
+def timezone_at(latitude, longitude):
+    return timezone_for_cell(round(latitude / timezone_cell_size), round(longitude / timezone_cell_size))
+
+def timezone_name_at(latitude, longitude):
     try:
-        tf = TimezoneFinder()
-        timezone_str = tf.timezone_at(lng=longitude, lat=latitude)
-        
-        # Use the pytz library to get the UTC offset
-        timezone = pytz.timezone(timezone_str)
-        utc_offset = timezone.utcoffset(datetime.utcnow()).total_seconds() / 3600
-        
-        return int(utc_offset)
+        return timezone_at(latitude, longitude)
     except Exception as e:
         print(f"Error determining timezone: {e}")
         return None
 
-def get_original_created_date(file_path, metadata, modification_info):
-    exiftool_output = ""
+def resolve_sidecar_times(sidecars):
+    """Work out where, and at what local time, the photo of each sidecar was taken.
+
+    Done for a whole batch of sidecars at once, the GPX lookups and the UTC
+    offsets are one vectorized call each. Returns one dict per sidecar with
+    the GPS position (None if unknown), the report's time fields and an
+    'error' for a sidecar whose location can't be read.
+    """
+    with metrics.timer('time-resolution'):
+        return _resolve_sidecar_times(sidecars)
+
+def _resolve_sidecar_times(sidecars):
+    resolved = []
+    for metadata in sidecars:
+        entry = {'photo_taken_time': get_photo_taken_time(metadata), 'position': None, 'gpx-track': None,
+                 'timezone': None, 'dst': None, 'sidecar_created_datetime': None, 'sidecar_calculated_datetime': None, 'error': None}
+        try:
+            geo_data = metadata.get('geoData') or metadata.get('geoDataExif')
+            if geo_data and not (geo_data['latitude'] == 0.0 and geo_data['longitude'] == 0.0):
+                entry['position'] = (geo_data['latitude'], geo_data['longitude'])
+        except Exception as e:
+            entry['error'] = str(e)
+        resolved.append(entry)
+
+    # Takeout leaves geoData at 0,0 when it has no location, the GPX
+    # tracks may know where the photo was taken
+    if gpx_track_index is not None:
+        unplaced = [entry for entry in resolved if entry['position'] is None and entry['photo_taken_time'] and not entry['error']]
+        with metrics.timer('gpx-lookup'):
+            positions = gpx_track_index.locate_many([entry['photo_taken_time'] for entry in unplaced])
+        for entry, position in zip(unplaced, positions):
+            if position:
+                entry['position'], entry['gpx-track'] = position[:2], position[2]
+
+    # Photos without a known zone get the default one, but no 'timezone' in the report
+    timed = [entry for entry in resolved if entry['photo_taken_time'] and not entry['error']]
+    with metrics.timer('timezone-lookup'):
+        zone_names = [timezone_name_at(*entry['position']) if entry['position'] else None for entry in timed]
+    epochs = [int((entry['photo_taken_time'] - local_time.epoch).total_seconds()) for entry in timed]
+    created_times = local_time.format_times(epochs, desired_datetime_format)
+    times = local_time.local_times(epochs, [zone_name or default_timezone for zone_name in zone_names], desired_datetime_format)
+    for entry, zone_name, created_time, (utc_offset, is_dst, calculated_time) in zip(timed, zone_names, created_times, times):
+        entry['timezone'] = utc_offset if zone_name else None
+        entry['dst'] = is_dst
+        entry['sidecar_created_datetime'] = created_time
+        entry['sidecar_calculated_datetime'] = calculated_time
+    return resolved
+
+def get_photo_taken_time(metadata):
     try:
-        exiftool_command = ['exiftool', '-CreationDate', '-CreateDate', '-DateTimeOriginal', '-DateCreated', file_path]
-        result = subprocess.run(exiftool_command, capture_output=True, text=True, check=True)
-        modification_info['exiftool-output'] += (result.stdout.replace("\n", "").strip() + ";")
-
-        # Parse the output to extract the original created date
-        exif_output = result.stdout.strip().split('\n')
-        modification_info['exif-created-output'] = exif_output
-        for line in exif_output:
-            if ': ' in line:
-                tag, value = line.split(': ', 1)
-                if tag.lower().strip() in ['creation date', 'create date', 'date/time original', 'date created']:
-                    created_datetime_str = value.strip()
-
-                    # Remove timezone information using regex
-                    created_datetime_str = re.sub(r' [+-]\d{2}:\d{2}$', '', created_datetime_str)
-
-                    # Use dateutil.parser to parse datetime with timezone
-                    dt_obj = datetime.strptime(created_datetime_str, '%Y:%m:%d %H:%M:%S')
-
-                    # Format datetime object back to string in the desired format
-                    formatted_datetime_str = dt_obj.strftime(desired_datetime_format)
-                    return formatted_datetime_str
+        return datetime.utcfromtimestamp(int(metadata['photoTakenTime']['timestamp']))
+    except (ValueError, KeyError, TypeError):
         return None
 
-    except Exception as e:
-        modification_info['exiftool-output'] += str(e).replace("\n", "").strip() + ";"
-        print(f"Error extracting created date from {file_path}: {e}")
+def parse_created_datetime(record):
+    # Use the first date tag that parses, in the order they were requested
+    for tag in created_date_tags:
+        value = record.get(tag)
+        if not isinstance(value, str):
+            continue
+
+        # Remove timezone information using regex
+        created_datetime_str = re.sub(r' [+-]\d{2}:\d{2}$', '', value.strip())
+        try:
+            dt_obj = datetime.strptime(created_datetime_str, '%Y:%m:%d %H:%M:%S')
+        except ValueError:
+            continue
+
+        # Format datetime object back to string in the desired format
+        return dt_obj.strftime(desired_datetime_format)
+    return None
+
+def read_file_metadata(file_paths, workers=1):
+    """Read the date and description tags of many files, one exiftool -json call per batch.
+
+    JPEG and HEIC files are read by exif_reader without exiftool.
+
+    Returns {file_path: record}. Files exiftool couldn't read get a record
+    with an 'error' entry instead of the tags.
+    """
+    # Files that haven't changed since an earlier run don't need exiftool
+    file_metadata, file_paths = cached_file_metadata(file_paths)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch_metadata in executor.map(read_metadata_batch, split_batches(file_paths, metadata_batch_size, workers)):
+            file_metadata.update(batch_metadata)
+            cache_file_metadata(batch_metadata)
+            metrics.progress()
+    return file_metadata
+
+def cached_file_metadata(file_paths):
+    # ({file_path: record} found in the metadata cache, paths still to read)
+    file_metadata = {}
+    cache = get_metadata_cache()
+    if cache:
+        with metrics.timer('metadata-cache'):
+            for file_path in file_paths:
+                record = cache.get(file_path, metadata_cache_field)
+                if record is not MISS:
+                    file_metadata[file_path] = record
+        file_paths = [file_path for file_path in file_paths if file_path not in file_metadata]
+        metrics.count('metadata-cache-hits', len(file_metadata))
+    return file_metadata, file_paths
+
+def cache_file_metadata(batch_metadata):
+    cache = get_metadata_cache()
+    if cache:
+        cache.put_many(metadata_cache_field, [(file_path, record) for file_path, record in batch_metadata.items()
+                                              if 'error' not in record])
+
+def read_metadata_batch(batch):
+    # JPEG and HEIC headers are read in-process, exiftool only gets the rest
+    entries, exiftool_batch = read_native_metadata(batch)
+
+    errors = ""
+    if exiftool_batch:
+        try:
+            with metrics.timer('exiftool-read'):
+                result = exiftool_pool.run(exiftool_read_command(exiftool_batch), check=False)
+            metrics.count('exiftool-read-files', len(exiftool_batch))
+            entries += json.loads(result.stdout) if result.stdout.strip() else []
+            errors = result.stderr.replace("\n", "").strip()
+        except Exception as e:
+            errors = str(e).replace("\n", "").strip()
+
+    return metadata_records(batch, entries, errors)
+
+def read_native_metadata(batch):
+    # (exiftool-style entries read without exiftool, files left for exiftool)
+    entries = []
+    exiftool_batch = []
+    with metrics.timer('native-read'):
+        for file_path in batch:
+            entry = read_tags(file_path, created_date_tags + ['Description'])
+            if entry is None:
+                exiftool_batch.append(file_path)
+            else:
+                entries.append(entry)
+    metrics.count('native-read-files', len(entries))
+    return entries, exiftool_batch
+
+def exiftool_read_command(file_paths):
+    return ['-json'] + [f"-{tag}" for tag in created_date_tags + ['Description']] + file_paths
+
+def metadata_records(batch, entries, errors):
+    file_metadata = {}
+    for entry in entries:
+        description = entry.get('Description', '')
+        file_metadata[entry['SourceFile']] = {
+            'created_datetime': parse_created_datetime(entry),
+            'description': description if isinstance(description, str) else str(description),
+            'exif-created-output': [f"{tag}: {entry[tag]}" for tag in created_date_tags if tag in entry],
+            'exiftool-output': json.dumps(entry),
+        }
+
+    for file_path in batch:
+        if file_path not in file_metadata:
+            file_metadata[file_path] = {'error': errors or f"No metadata returned for {file_path}"}
+
+    return file_metadata
+
+def split_batches(items, batch_size, workers=1):
+    # Smaller batches when there isn't enough work to keep every worker busy
+    batch_size = max(1, min(batch_size, -(-len(items) // max(1, workers))))
+    return [items[start:start + batch_size] for start in range(0, len(items), batch_size)]
+
+def get_original_created_date(file_path, metadata, modification_info, file_metadata=None):
+    if file_metadata is None:
+        file_metadata = read_file_metadata([file_path])[file_path]
+
+    if 'error' in file_metadata:
+        modification_info['exiftool-output'] += file_metadata['error'] + ";"
+        print(f"Error extracting created date from {file_path}: {file_metadata['error']}")
         return None
 
-def update_exif_data_with_exiftool(file_path, metadata, error_directory, error_files):
+    modification_info['exif-created-output'] = file_metadata['exif-created-output']
+    return file_metadata['created_datetime']
+
+def prepare_exif_update(file_path, metadata, file_metadata=None, resolved_time=None):
+    """Work out the new metadata for one file without writing or moving anything.
+
+    Returns (extension, modification_info, exiftool_commands, error). Errors
+    are returned rather than raised so the caller decides where the file goes.
+    """
     exiftool_output = ""  # Initialize an empty string to store exiftool outputs
+    filename = os.path.basename(file_path)
+    extension = os.path.splitext(file_path)[1].strip('.').upper()
+
+    modification_info = {
+        'filename': filename,
+        'gps-updated': False,  # Default value if no GPS update
+        'existing_description': None,
+        'new-description': None,  # Default value for new description
+        'created_datetime': None,  # Default value for created datetime
+        'sidecar_created_datetime': None,  # Default value for sidecar created datetime
+        'timezone': None,  # Default value for timezone
+        'dst': None,  # Default value for daylight savings
+        'sidecar_calculated_datetime': None,  # Calculated datetime based on timezone & dst
+        'gpx-track': None,  # GPX file the location came from, when the sidecar had none
+        'exiftool-output': ''  # To capture exiftool command outputs
+    }
+
     try:
-        filename = os.path.basename(file_path)
-        extension = os.path.splitext(file_path)[1].strip('.').upper()
-        print(filename)
-
-        modification_info = {
-            'filename': filename,
-            'gps-updated': False,  # Default value if no GPS update
-            'existing_description': None,
-            'new-description': None,  # Default value for new description
-            'created_datetime': None,  # Default value for created datetime
-            'sidecar_created_datetime': None,  # Default value for sidecar created datetime
-            'timezone': None,  # Default value for timezone
-            'dst': None,  # Default value for daylight savings
-            'sidecar_calculated_datetime': None,  # Calculated datetime based on timezone & dst
-            'exiftool-output': ''  # To capture exiftool command outputs
-        }
+        # Dates and description come from a single -json read, usually done
+        # for the whole directory up front by process_directory
+        if file_metadata is None:
+            file_metadata = read_file_metadata([file_path])[file_path]
 
-        created_datetime = get_original_created_date(file_path, metadata, modification_info)
+        created_datetime = get_original_created_date(file_path, metadata, modification_info, file_metadata)
         if created_datetime:
             modification_info['created_datetime'] = created_datetime
 
-        read_description_command = ['exiftool', '-Description', file_path]
-        result = subprocess.run(read_description_command, capture_output=True, text=True, check=True)
-        existing_description = result.stdout.strip()
-        exiftool_output += result.stdout.replace("\n", "").strip() + ";"
+        if 'error' in file_metadata:
+            raise Exception(file_metadata['error'])
+        existing_description = file_metadata['description'].strip()
+        exiftool_output += file_metadata['exiftool-output'] + ";"
 
         new_description = {'original_filename': filename}
 
@@ -164,149 +356,166 @@ def update_exif_data_with_exiftool(file_path, metadata, error_directory, error_f
 
         if not existing_description.startswith('{'):
             new_description_json = json.dumps(new_description)
-            exiftool_commands = ['exiftool', '-overwrite_original', f"-Description={new_description_json}"]
+            exiftool_commands = [f"-Description={new_description_json}"]
         else:
             exiftool_commands = []
 
         modification_info['existing_description'] = existing_description
         modification_info['new-description'] = new_description
 
-        geo_data = metadata.get('geoData') or metadata.get('geoDataExif')
-        if geo_data:
-            latitude = geo_data['latitude']
-            longitude = geo_data['longitude']
-
-            if not (latitude == 0.0 and longitude == 0.0):
-                exiftool_commands.extend([f"-GPSLatitude={latitude}", f"-GPSLongitude={longitude}"])
-                timezone = determine_timezone(latitude, longitude)
-                if timezone:
-                    modification_info['timezone'] = timezone
-
-        if 'photoTakenTime' in metadata:
-            try:
-                timestamp = metadata['photoTakenTime']['timestamp']
-                photo_taken_time = datetime.utcfromtimestamp(int(timestamp))
-                modification_info['sidecar_created_datetime'] = photo_taken_time.strftime(desired_datetime_format)
-                is_dst = is_daylight_savings_time(photo_taken_time)
-                modification_info['dst'] = is_dst
-
-                utc_offset = -5  # Default timezone (America/New York)
-
-                if 'timezone' in modification_info and modification_info['timezone'] is not None:
-                    utc_offset = modification_info['timezone']
-                
-                adjusted_datetime = photo_taken_time + timedelta(hours=utc_offset)
+        if resolved_time is None:
+            resolved_time = resolve_sidecar_times([metadata])[0]
+        if resolved_time['error']:
+            raise Exception(resolved_time['error'])
 
-                if 'dst' in modification_info and modification_info['dst']:
-                    adjusted_datetime += timedelta(hours=1)
+        if resolved_time['position']:
+            latitude, longitude = resolved_time['position']
+            exiftool_commands.extend([f"-GPSLatitude={latitude}", f"-GPSLongitude={longitude}"])
+        modification_info['gpx-track'] = resolved_time['gpx-track']
 
-                modification_info['sidecar_calculated_datetime'] = adjusted_datetime.strftime(desired_datetime_format)
-
-            except (ValueError, KeyError, TypeError):
-                pass
-
-        if exiftool_commands:
-            exiftool_commands.append(file_path)
-            result = subprocess.run(exiftool_commands, capture_output=True, text=True, check=True)
-            exiftool_output += result.stdout.replace("\n", "").strip() + ";"
+        # The offset at the time the photo was taken already includes DST
+        if resolved_time['photo_taken_time']:
+            for field in ('timezone', 'dst', 'sidecar_created_datetime', 'sidecar_calculated_datetime'):
+                modification_info[field] = resolved_time[field]
 
         # Assign the captured output to modification_info
         modification_info['exiftool-output'] = exiftool_output
 
-        return extension, modification_info
-
-    except Exception as e:
-        modification_info['exiftool-output'] += str(e).replace("\n", "").strip() + ";"
-        print(f"Error updating metadata for {file_path}: {e}")
-        if not os.path.exists(error_directory):
-            os.makedirs(error_directory)
-        error_file_path = os.path.join(error_directory, os.path.basename(file_path))
-        error_files.append(modification_info)
-        shutil.move(file_path, error_file_path)
-        return None, None
-
-def change_system_file_datetime(file_path, modification_info):
-    try:
-        # Convert the new filename to a datetime object
-        dt_obj = datetime.strptime(modification_info['new_filename_base'], desired_datetime_format)
-
-        # Convert datetime object to a timestamp
-        timestamp = dt_obj.timestamp()
-
-        os.utime(file_path, (timestamp, timestamp))
-        modification_info['file_mtime_updated'] = True
+        return extension, modification_info, exiftool_commands, None
 
     except Exception as e:
-        modification_info['file_mtime_updated'] = False
-        print(f"Error in change_system_file_datetime for {file_path}: {e}")
-
-    return modification_info
+        return extension, modification_info, [], str(e)
+
+def plan_error_move(plan, file_path, modification_info, error, error_directory, directory, name_allocator):
+    modification_info['exiftool-output'] += error.replace("\n", "").strip() + ";"
+    print(f"Error updating metadata for {file_path}: {error}")
+    plan.add_move(file_path, result_target(name_allocator, error_directory, os.path.relpath(file_path, directory)),
+                  section='error-processing', entry=modification_info)
+
+def result_target(name_allocator, result_directory, relative_path):
+    # Below a result folder a file keeps the folders it had below the scanned
+    # directory, and gets a name no other file there has
+    target_directory = os.path.join(result_directory, os.path.dirname(relative_path))
+    base_name, extension = os.path.splitext(os.path.basename(relative_path))
+    return os.path.join(target_directory, name_allocator.allocate(target_directory, base_name, extension))
+
+class ExifWritePlan:
+    """Tag assignments collected per file across a directory, then written in batches.
+
+    Each batch goes to one exiftool worker as an argfile on its stdin with an
+    -execute after every file, so every file still gets its own result.
+    """
+
+    def __init__(self):
+        self.writes = []
+
+    def add(self, file_path, tag_args):
+        self.writes.append((file_path, list(tag_args)))
+
+    def apply(self, workers=1, written=None):
+        """Write everything, returning {file_path: (succeeded, output)}.
+
+        written, if given, is called on this thread with the results of each
+        batch as soon as it's done.
+        """
+        results = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for batch_results in executor.map(self.apply_batch, split_batches(self.writes, write_batch_size, workers)):
+                results.update(batch_results)
+                if written:
+                    written(batch_results)
+                metrics.progress()
+        return results
+
+    def apply_batch(self, batch):
+        # Files a native writer can handle never reach exiftool
+        results, batch = write_natively(batch)
+        if not batch:
+            return results
+
+        try:
+            with metrics.timer('exiftool-write'):
+                completed = exiftool_pool.run_many(exiftool_write_commands(batch))
+            metrics.count('exiftool-write-files', len(batch))
+        except Exception as e:
+            completed = e
+        results.update(exiftool_write_results(batch, completed))
+        return results
+
+def write_natively(batch):
+    # ({file_path: (succeeded, output)}, writes left for exiftool)
+    results = {}
+    exiftool_batch = []
+    with metrics.timer('native-write'):
+        for file_path, tag_args in batch:
+            for writer in native_writers:
+                result = writer(file_path, tag_args)
+                if result is not None:
+                    results[file_path] = result
+                    break
+            else:
+                exiftool_batch.append((file_path, tag_args))
+    metrics.count('native-write-files', len(results))
+    return results, exiftool_batch
+
+def exiftool_write_commands(batch):
+    return [['-overwrite_original'] + tag_args + [file_path] for file_path, tag_args in batch]
+
+def exiftool_write_results(batch, completed):
+    # completed is the CompletedProcess of every write, or the exception
+    # that stopped the whole batch
+    results = {}
+    if isinstance(completed, Exception):
+        for file_path, _ in batch:
+            results[file_path] = (False, str(completed))
+        return results
+
+    for (file_path, _), result in zip(batch, completed):
+        if result.returncode:
+            output = result.stdout.strip() + " " + result.stderr.strip()
+            results[file_path] = (False, output.replace("\n", "").strip())
+        else:
+            results[file_path] = (True, result.stdout.replace("\n", "").strip())
+    return results
 
-def rename_file_based_on_datetime(file_path, modification_info, error_renaming_directory, error_renaming_files, processed_sidecars_directory, sidecar_path, success_directory):
+def file_timestamp(file_path, modification_info):
+    # The new file name is the time the file should get
     try:
-        # datetime_format = desired_datetime_format
-        extension = os.path.splitext(file_path)[1].strip('.').lower()
-
-        new_filename_base = None
-        
-        # Try using the sidecar calcualted datetime first
-        if modification_info['sidecar_calculated_datetime']:
-            try:
-                new_filename_base = modification_info['sidecar_calculated_datetime']
-            except ValueError:
-                pass
-
-
-        # If this fails use the file time found in the file
-        if not new_filename_base and modification_info['created_datetime']:
-            try:
-                new_filename_base = modification_info['created_datetime']
-            except ValueError:
-                pass
-
-        if new_filename_base:
-            modification_info['new_filename_base'] = new_filename_base
-            new_filename = f"{new_filename_base}.{extension}"
-            new_file_path = os.path.join(os.path.dirname(file_path), new_filename)
-
-            counter = 1
-            while os.path.exists(new_file_path):
-                new_filename = f"{new_filename_base}_{counter}.{extension}"
-                new_file_path = os.path.join(os.path.dirname(file_path), new_filename)
-                counter += 1
-
-            os.rename(file_path, new_file_path)
-
-            modification_info['new_filename'] = new_filename
-            modification_info = change_system_file_datetime(new_file_path, modification_info)
-
-            # Move the renamed file to the success directory
-            success_file_path = os.path.join(success_directory, new_filename)
-            if not os.path.exists(success_directory):
-                os.makedirs(success_directory)
-            shutil.move(new_file_path, success_file_path)
-
-            # Move the sidecar file
-            if sidecar_path and os.path.exists(sidecar_path):
-                if not os.path.exists(processed_sidecars_directory):
-                    os.makedirs(processed_sidecars_directory)
-                shutil.move(sidecar_path, os.path.join(processed_sidecars_directory, os.path.basename(sidecar_path)))
-
-            print('    renamed to', new_filename)
-            return new_file_path
-
-        return file_path
-
+        return datetime.strptime(modification_info['new_filename_base'], desired_datetime_format).timestamp()
     except Exception as e:
-        print(f"Error renaming file {file_path}: {e}")
-        if not os.path.exists(error_renaming_directory):
-            os.makedirs(error_renaming_directory)
-        error_file_path = os.path.join(error_renaming_directory, os.path.basename(file_path))
-        error_renaming_files.append(modification_info)
-        shutil.move(file_path, error_file_path)
+        modification_info['file_mtime_updated'] = False
+        print(f"Error in file_timestamp for {file_path}: {e}")
         return None
 
-def create_matched_file_list(file_list):
+def plan_rename(plan, file_path, modification_info, success_directory, name_allocator, **details):
+    """Plan the move of a written file to the success directory under its date.
+
+    Names come from name_allocator, so two files with the same date get
+    different names before either of them exists.
+    """
+    extension = os.path.splitext(file_path)[1].strip('.').lower()
+
+    # Try using the sidecar calcualted datetime first, then the file's own
+    new_filename_base = modification_info['sidecar_calculated_datetime'] or modification_info['created_datetime']
+    if not new_filename_base:
+        # Without a date the file stays where it is
+        return plan.add_move(file_path, None, **details)
+
+    modification_info['new_filename_base'] = new_filename_base
+    new_filename = name_allocator.allocate(success_directory, new_filename_base, f".{extension}")
+    modification_info['new_filename'] = new_filename
+    return plan.add_move(file_path, os.path.join(success_directory, new_filename),
+                         file_timestamp(file_path, modification_info), **details)
+
+def archive_sidecar(sidecar_path, processed_sidecars_directory):
+    # Live photos share a sidecar, so it may already have been moved
+    if sidecar_path and os.path.exists(sidecar_path):
+        if not os.path.exists(processed_sidecars_directory):
+            os.makedirs(processed_sidecars_directory)
+        base_name, extension = os.path.splitext(os.path.basename(sidecar_path))
+        move_file(sidecar_path, os.path.join(processed_sidecars_directory, NameAllocator().allocate(processed_sidecars_directory, base_name, extension)))
+
+def create_matched_file_list(file_list, ambiguous_matches=None):
     matched_files = {}
     json_file_list = []
 
@@ -334,143 +543,896 @@ def create_matched_file_list(file_list):
         matched_files[short_key]['img'].extend(matched_files[long_key]['img'])
         del matched_files[long_key]  # Remove the longer key entry
 
-    for json_file in json_file_list:
-        
-        possible_matches = []
-        partial_name = os.path.splitext(json_file)[0] # img123.json -> img123
-        possible_matches.append(partial_name)
+    # Sidecars that fit more than one group are added to ambiguous_matches
+    match_sidecars(matched_files, json_file_list, ambiguous_matches)
 
-        # Check and extract the parenthetical component # img123.jpg(1).json -> (1)
-        parenthetical_match = re.search(r'\(\d+\)$', partial_name)
-        parenthetical = parenthetical_match.group(0) if parenthetical_match else None
+    return matched_files
 
-        base_name = os.path.splitext(partial_name)[0] # img123.jpg.json -> img123
+def print_ambiguous_matches(ambiguous_matches):
+    # These sidecars are left where they are, nothing is guessed
+    for match in ambiguous_matches:
+        print(f"Ambiguous sidecar {match['json']} could belong to: {', '.join(match['candidates'])}")
 
-        if parenthetical:
-            possible_matches.append(f"{base_name}{parenthetical}")
-        else:
-            possible_matches.append(f"{base_name}")
+def create_matched_file_index(relative_paths, ambiguous_matches=None):
+    """Match a whole tree at once, like create_matched_file_list does for one folder.
 
-        # Loop through possible matches
-        for possible_match in possible_matches:
-            if possible_match in matched_files:
-                matched_files[possible_match]['json'] = json_file
+    Files are matched within their own folder first. Images still without a
+    sidecar then get one from any other folder (or Takeout part) if exactly
+    one unused sidecar there fits. Keys and file names are relative paths.
+    """
+    folders = {}
+    for relative_path in relative_paths:
+        folder, name = os.path.split(relative_path)
+        folders.setdefault(folder, []).append(name)
+
+    matched_files = {}
+    unused_sidecars = []
+    for folder, names in folders.items():
+        folder_matches = create_matched_file_list(names, ambiguous_matches)
+        used_sidecars = set()
+        for base_name, file_group in folder_matches.items():
+            matched_files[os.path.join(folder, base_name)] = {
+                'img': [os.path.join(folder, img_file) for img_file in file_group['img']],
+                'json': os.path.join(folder, file_group['json']) if file_group['json'] else None,
+            }
+            used_sidecars.add(file_group['json'])
+
+        for name in names:
+            if name.lower().endswith('.json') and name not in used_sidecars and not name.startswith('.'):
+                unused_sidecars.append(os.path.join(folder, name))
+
+    # Images still without a sidecar, by base name. A base name found in
+    # more than one folder can't be told apart
+    unmatched = {}
+    for key, file_group in matched_files.items():
+        if file_group['json'] is None:
+            unmatched.setdefault(os.path.basename(key), []).append(key)
+    unmatched_groups = {
+        base_name: {'img': [os.path.basename(f) for key in keys for f in matched_files[key]['img']], 'json': None}
+        for base_name, keys in unmatched.items()}
+    matcher = SidecarMatcher(unmatched_groups)
+
+    # Sidecars in another folder are only used when there is no doubt which one
+    claims = {}
+    for sidecar in unused_sidecars:
+        candidates = [key for base_name in matcher.resolve(os.path.basename(sidecar)) for key in unmatched[base_name]]
+        if len(candidates) == 1:
+            claims.setdefault(candidates[0], []).append(sidecar)
+        elif candidates and ambiguous_matches is not None:
+            ambiguous_matches.append({'json': sidecar, 'candidates': candidates})
+
+    for key, sidecars in claims.items():
+        if len(sidecars) == 1:
+            matched_files[key]['json'] = sidecars[0]
+        elif ambiguous_matches is not None:
+            for sidecar in sidecars:
+                ambiguous_matches.append({'json': sidecar, 'candidates': [key]})
 
     return matched_files
 
 
-def process_directory(directory, report_number):
+def read_group_sidecar(directory, file_group):
+    sidecar_path = os.path.join(directory, file_group['json'])
+    with metrics.timer('sidecar-json'):
+        return sidecar_path, read_sidecar_json(sidecar_path)
+
+def prepare_group(directory, file_group, file_metadata, resumed_files, sidecar, resolved_time):
+    # Runs on the worker threads, so it must not move or write anything
+    with metrics.timer('prepare'):
+        return _prepare_group(directory, file_group, file_metadata, resumed_files, sidecar, resolved_time)
+
+def _prepare_group(directory, file_group, file_metadata, resumed_files, sidecar, resolved_time):
+    sidecar_path, sidecar_metadata = sidecar
+
+    prepared_files = []
+    for img_file in file_group['img']: # Loop through all files with the same base name
+        file_path = os.path.join(directory, img_file)
+        if file_path in resumed_files:
+            # Metadata was already written by an interrupted run
+            record = resumed_files[file_path]
+            extension = os.path.splitext(file_path)[1].strip('.').upper()
+            prepared_files.append((file_path, extension, record['modification_info'], [], None))
+        else:
+            prepared_files.append((file_path,) + prepare_exif_update(file_path, sidecar_metadata, file_metadata.get(file_path), resolved_time))
+    return sidecar_path, prepared_files
+
+def process_directory(directory, progress_interval, workers=1, archive_paths=None, recursive=False, files=None):
+    # A progress line is printed every progress_interval seconds, instead of a line per file.
+    # With files only those files of the directory are processed
     report_timestamp = datetime.now().strftime(desired_datetime_format)
-    os.makedirs(sidecar_directory := os.path.join(directory, "error-missing-sidecar"), exist_ok=True)
-    processed_sidecars_directory = os.path.join(directory, "processed-sidecars")
-    os.makedirs(error_renaming_directory := os.path.join(directory, "error-renaming"), exist_ok=True)
-    error_directory = os.path.join(directory, "processing-errors")
-    success_directory = os.path.join(directory, "successfully-processed")
-    missing_files = []
-    error_files = []
-    error_renaming_files = []
-    files_examined = 0
+    metrics.reset()
+    metrics.progress_interval = progress_interval
+    os.makedirs(os.path.join(directory, "error-missing-sidecar"), exist_ok=True)
+    os.makedirs(os.path.join(directory, "error-renaming"), exist_ok=True)
     extension_modifications = {}  # To group modifications by file extension
+    exiftool_pool.resize(workers)
+
+    # Every report event goes to the journal as it happens, the report itself
+    # is only built from it once the run is over
+    journal = ReportJournal(os.path.join(directory, f"report_{report_timestamp}.jsonl"))
+    missing_files = JournaledList(journal, 'error-missing-sidecars')
+    error_files = JournaledList(journal, 'error-processing')
+    error_renaming_files = JournaledList(journal, 'error-renaming')
+
+    # Progress of every file, so an interrupted run can be resumed. The file
+    # starts with a dot so it's never picked up as a photo
+    run_state = RunState(os.path.join(directory, run_state_filename))
+
+    # Every move of the run, so it can be rolled back with file_plan.py --undo
+    undo_log = UndoLog(os.path.join(directory, f"undo_{report_timestamp}.jsonl"), output_mode)
+
+    # Hashes of everything in the library, to recognise copies of it
+    content_index = ContentIndex.for_library(os.path.join(directory, "successfully-processed")) if dedup_mode else None
+
+    try:
+        # Finish files an interrupted run had already renamed before they are
+        # mistaken for new files without a sidecar
+        resume_renamed_files(directory, run_state, journal, extension_modifications)
+
+        if archive_paths:
+            process_archives(archive_paths, directory, workers, journal, run_state, missing_files, error_files, error_renaming_files, extension_modifications, undo_log,
+                             content_index)
+        else:
+            matched_files = None
+            if files is None:
+                with metrics.timer('scan'):
+                    files, matched_files = list_input_files(directory, recursive)
+            if output_mode == 'move':
+                process_matched_files(directory, files, workers, journal, run_state, missing_files, error_files, error_renaming_files, extension_modifications,
+                                      matched_files=matched_files, undo_log=undo_log, content_index=content_index)
+            else:
+                process_placed_files(directory, files, matched_files, workers, journal, run_state, missing_files, error_files, error_renaming_files, extension_modifications,
+                                     undo_log, content_index)
+        if dedup_mode == 'link':
+            content_index.link_duplicates()
+        run_state.clear_finished()
+    finally:
+        if content_index:
+            record_duplicates(journal, content_index, run_over=True)
+            content_index.close()
+        run_state.close()
+        journal.close()
+        write_run_report(directory, journal.path, report_timestamp)
+
+    return missing_files, error_files, error_renaming_files, extension_modifications
+
+def write_run_report(directory, journal_path, report_timestamp):
+    # The report and, next to it, how long every stage took
+    with metrics.timer('report'):
+        write_report_from_journal(journal_path)
+    metrics.progress(force=True)
+    metrics.write(os.path.join(directory, f"metrics_{report_timestamp}.json"))
+
+def list_input_files(directory, recursive=False):
+    # Returns the files to process and, for a whole tree, how they match up
+    if recursive:
+        # Every album and year folder below the directory, matched as one tree
+        files = [f for f in scan_tree(directory, result_directories) if not is_run_log(f)]
+        ambiguous_matches = []
+        matched_files = create_matched_file_index(files, ambiguous_matches)
+        print_ambiguous_matches(ambiguous_matches)
+        return files, matched_files
+
+    # Skip the journals of earlier runs, they aren't photos
+    files = [f for f in os.listdir(directory)
+             if os.path.isfile(os.path.join(directory, f)) and not is_run_log(f)]
+    return files, None
+
+def plan_directory(directory, workers=1, recursive=False):
+    """Work out what process_directory would do, without writing or moving anything."""
+    exiftool_pool.resize(workers)
+    files, matched_files = list_input_files(directory, recursive)
+
+    # An existing library index is used, but not created
+    index_path = os.path.join(directory, "successfully-processed", content_index_filename)
+    content_index = ContentIndex(index_path) if dedup_mode and os.path.exists(index_path) else None
+    try:
+        return process_matched_files(directory, files, workers, None, None, [], [], [], {},
+                                     matched_files=matched_files, dry_run=True, content_index=content_index)
+    finally:
+        if content_index:
+            content_index.close()
+
+def watch_directory(directory, progress_interval, workers=1, poll_interval=None):
+    """Process the groups dropped into directory as they become complete, until interrupted.
+
+    The exiftool workers, timezone finder and metadata cache are loaded
+    once and stay warm between drops, and only the new groups are
+    processed. Files already in the directory are processed first.
+    """
+    exiftool_pool.resize(workers)
+    exiftool_pool.warm()
+    get_timezone_finder()
+    get_metadata_cache()
+    watcher = open_watcher(directory, poll_interval)
+    # Stopped by a service manager the same way as with Ctrl-C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    print(f"Watching {directory} for new files, Ctrl-C to stop")
+
+    first_seen = {}
+    # Files handed to a run with their size and modification time, so files
+    # a run left where they were aren't tried again until they change
+    attempted = {}
+    changed, waiting = True, False
+    last_change = time.monotonic() - watch_settle_seconds
+    try:
+        while True:
+            now = time.monotonic()
+            if (changed or waiting) and now - last_change >= watch_settle_seconds:
+                changed = False
+                listing = watched_files(directory)
+                first_seen = {name: first_seen.get(name, now) for name in listing}
+                attempted = {name: signature for name, signature in attempted.items() if name in listing}
+                ready, waiting = ready_watched_files(listing, first_seen, attempted, now)
+                if ready:
+                    print(f"{len(ready)} new files in {directory}")
+                    attempted.update((name, listing[name]) for name in ready)
+                    print_report(*process_directory(directory, progress_interval, workers, files=ready))
+            if watcher.wait(watch_settle_seconds):
+                changed, last_change = True, time.monotonic()
+    except KeyboardInterrupt:
+        print(f"Stopped watching {directory}")
+    finally:
+        watcher.close()
+
+def watched_files(directory):
+    # {name: (size, modification time)} of the files that could be photos or sidecars
+    listing = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.startswith('.') or is_run_log(entry.name):
+                continue
+            try:
+                if entry.is_file():
+                    stat = entry.stat()
+                    listing[entry.name] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                continue
+    return listing
+
+def ready_watched_files(listing, first_seen, attempted, now):
+    """Files of the groups that can be processed now, and whether a group is still waiting for its sidecar.
+
+    A group is ready once its images and sidecar are all there, or when
+    its images have waited watch_sidecar_wait seconds for a sidecar.
+    """
+    ready = set()
+    waiting = False
+    for file_group in create_matched_file_list(listing).values():
+        group_files = file_group['img'] + ([file_group['json']] if file_group['json'] else [])
+        if all(attempted.get(name) == listing[name] for name in group_files):
+            continue
+        if file_group['json'] or all(now - first_seen[name] >= watch_sidecar_wait for name in file_group['img']):
+            ready.update(group_files)
+        else:
+            waiting = True
+    return sorted(ready), waiting
+
+def resume_renamed_files(directory, run_state, journal, extension_modifications):
+    processed_sidecars_directory = os.path.join(directory, "processed-sidecars")
+
+    for record in run_state.unfinished():
+        # Files whose metadata was written are picked up again when listed
+        if record['stage'] == stages.METADATA_WRITTEN:
+            continue
 
-    files = [f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f))]
-    matched_files = create_matched_file_list(files)
+        # Only the stage and where the file went are kept after METADATA_WRITTEN
+        modification_info = record['modification_info']
+        success_file_path = record['current_path']
+        modification_info['new_filename_base'] = modification_info['sidecar_calculated_datetime'] or modification_info['created_datetime']
+        modification_info['new_filename'] = os.path.basename(success_file_path)
+        try:
+            if not os.path.exists(success_file_path):
+                # Stopped before the move, the file is processed again when listed
+                if os.path.exists(record['path']):
+                    run_state.record(record['path'], stages.METADATA_WRITTEN)
+                else:
+                    print(f"Error resuming {record['path']}: file not found")
+                continue
+
+            if record['stage'] != stages.SIDECAR_ARCHIVED:
+                archive_sidecar(record['sidecar_path'], processed_sidecars_directory)
+                run_state.record(record['path'], stages.SIDECAR_ARCHIVED)
+
+            print(f"Resumed {os.path.basename(record['path'])} -> {modification_info.get('new_filename')}")
+            add_modification(extension_modifications, journal, record['report_key'], record['group_name'], modification_info)
+            run_state.record(record['path'], stages.DONE)
+        except Exception as e:
+            print(f"Error resuming {record['path']}: {e}")
+
+def add_modification(extension_modifications, journal, report_key, base_name, modification_info):
+    if report_key == "LIVE":
+        # Group under "LIVE" if more than one image in the group
+        if report_key not in extension_modifications:
+            extension_modifications[report_key] = {}
+        if base_name not in extension_modifications[report_key]:
+            extension_modifications[report_key][base_name] = []
+        journal.record('modifications', modification_info, report_key, base_name)
+        extension_modifications[report_key][base_name].append(ReportRecord('modifications', modification_info, report_key, base_name))
+    else:
+        if report_key not in extension_modifications:
+            extension_modifications[report_key] = []
+        journal.record('modifications', modification_info, report_key)
+        extension_modifications[report_key].append(ReportRecord('modifications', modification_info, report_key))
+
+def process_archives(archive_paths, directory, workers, journal, run_state, missing_files, error_files, error_renaming_files, extension_modifications, undo_log=None, content_index=None):
+    # Chunks are extracted next to the output so moving them out is a rename
+    staging_directory = os.path.join(directory, archive_staging_directory)
+
+    # Files are extracted again on a rerun, so metadata written to the old
+    # copies of an interrupted run doesn't count
+    for record in run_state.unfinished():
+        if record['stage'] == stages.METADATA_WRITTEN and record['path'].startswith(staging_directory + os.sep):
+            run_state.forget(record['path'])
+
+    # Every chunk ends up in the same success directory
+    name_allocator = NameAllocator()
+
+    # What an interrupted run already finished isn't extracted again, whole
+    # chunks included, so their sidecars and errors aren't handled twice
+    def finished(path):
+        record = run_state.get(path)
+        return record is not None and record['stage'] == stages.DONE
+
+    for chunk_directory, files, folder in extract_chunks(archive_paths, staging_directory, create_matched_file_list, archive_chunk_size, archive_chunk_bytes,
+                                                         finished=finished):
+        process_matched_files(chunk_directory, files, workers, journal, run_state, missing_files, error_files, error_renaming_files, extension_modifications, directory,
+                              undo_log=undo_log, name_allocator=name_allocator, content_index=content_index)
+
+        # Anything left over (e.g. files without a usable date) is kept in
+        # the output directory under its folder in the archive, the same
+        # place a directory run leaves them, with a name nothing there has
+        leftover_directory = os.path.join(directory, folder)
+        for leftover in os.listdir(chunk_directory):
+            os.makedirs(leftover_directory, exist_ok=True)
+            base_name, extension = os.path.splitext(leftover)
+            target = os.path.join(leftover_directory, name_allocator.allocate(leftover_directory, base_name, extension))
+            move_file(os.path.join(chunk_directory, leftover), target)
+        os.rmdir(chunk_directory)
+        run_state.record(chunk_directory, stages.DONE)
+
+    if os.path.isdir(staging_directory) and not os.listdir(staging_directory):
+        os.rmdir(staging_directory)
+
+def process_placed_files(directory, files, matched_files, workers, journal, run_state, missing_files, error_files, error_renaming_files, extension_modifications, undo_log=None, content_index=None):
+    # The Takeout is left as it is: every file is placed in a staging folder
+    # with output_mode, and only those copies are written to and moved
+    staging_directory = os.path.join(directory, archive_staging_directory, 'placed')
+
+    # Skip what an interrupted run already finished
+    placed_files = []
+    for f in files:
+        record = run_state.get(os.path.join(staging_directory, f))
+        if not record or record['stage'] != stages.DONE:
+            placed_files.append(f)
+    if matched_files is not None and len(placed_files) < len(files):
+        placed = set(placed_files)
+        matched_files = {base_name: dict(file_group, img=[f for f in file_group['img'] if f in placed])
+                         for base_name, file_group in matched_files.items() if any(f in placed for f in file_group['img'])}
+
+    def place(f):
+        # A copy left by an interrupted run may already have its metadata
+        staged_path = os.path.join(staging_directory, f)
+        if not os.path.exists(staged_path):
+            os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+            place_file(os.path.join(directory, f), staged_path, output_mode)
+
+    with metrics.timer('place'), ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(place, placed_files))
+
+    process_matched_files(staging_directory, placed_files, workers, journal, run_state, missing_files, error_files, error_renaming_files, extension_modifications, directory,
+                          matched_files=matched_files, undo_log=undo_log, content_index=content_index)
+
+    # What's left are copies of files that stay in the Takeout anyway
+    shutil.rmtree(staging_directory, ignore_errors=True)
+    if os.path.isdir(os.path.dirname(staging_directory)) and not os.listdir(os.path.dirname(staging_directory)):
+        os.rmdir(os.path.dirname(staging_directory))
+
+def process_matched_files(directory, files, workers, journal, run_state, missing_files, error_files, error_renaming_files, extension_modifications, output_directory=None, matched_files=None, dry_run=False, undo_log=None, name_allocator=None, content_index=None):
+    """Plan and apply everything for one folder of files.
+
+    With dry_run nothing is written or moved, the plan (assuming every
+    write succeeds) is returned instead. Pass the same name_allocator to
+    every call that shares a success directory. With dedup_mode set,
+    copies of another file of the run or of the library in content_index
+    go to the duplicates folder instead.
+    """
+    # Files are read from directory, the result folders go in output_directory
+    output_directory = output_directory or directory
+    name_allocator = name_allocator or NameAllocator()
+    plan = FilePlan()
+
+    if matched_files is None:
+        ambiguous_matches = []
+        with metrics.timer('match'):
+            matched_files = create_matched_file_list(files, ambiguous_matches)
+        print_ambiguous_matches(ambiguous_matches)
+
+    # Groups that can't be processed are moved without reading anything
+    groups_to_update = plan_unprocessable_groups(plan, directory, matched_files, output_directory, name_allocator)
+    if dedup_mode:
+        groups_to_update = plan_duplicate_groups(plan, directory, groups_to_update, output_directory, content_index, run_state, name_allocator, workers)
+
+    # Read the existing metadata of every file that will be updated in batches
+    file_paths = group_file_paths(directory, groups_to_update)
+    resumed_files = resumed_file_records(run_state, file_paths)
+    file_metadata = read_file_metadata([f for f in file_paths if f not in resumed_files], workers)
+
+    # Groups are prepared on the worker threads. Everything that touches the
+    # filesystem or the report stays here, in group order, so the result is
+    # the same for any number of workers
+    write_plan = ExifWritePlan()
+    pending_files = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Sidecars are read on the workers, then every photo is placed in
+        # space and time in one pass before the groups are prepared
+        sidecars = list(executor.map(lambda group: read_group_sidecar(directory, group[1]), groups_to_update))
+        resolved_times = resolve_sidecar_times([sidecar_metadata for sidecar_path, sidecar_metadata in sidecars])
+        prepared_groups = executor.map(lambda item: prepare_group(directory, item[0][1], file_metadata, resumed_files, item[1], item[2]),
+                                       zip(groups_to_update, sidecars, resolved_times))
+        for group, prepared_group in zip(groups_to_update, prepared_groups):
+            plan_prepared_group(write_plan, pending_files, group, prepared_group)
+
+    if dry_run:
+        # Assume every write works
+        for file_path, tag_args in write_plan.writes:
+            plan.add_write(file_path, tag_args)
+        write_results = {}
+    else:
+        pending_by_path = {pending[3]: pending for pending in pending_files}
+        write_results = write_plan.apply(workers, lambda batch_results: record_written_files(pending_by_path, batch_results, run_state))
+
+    plan_written_files(plan, pending_files, write_results, run_state, name_allocator, directory, output_directory)
+
+    if not dry_run:
+        apply_file_plan(plan, journal, run_state, missing_files, error_files, error_renaming_files, extension_modifications,
+                        os.path.join(output_directory, "error-renaming"), undo_log, content_index)
+    return plan
+
+def plan_unprocessable_groups(plan, directory, matched_files, output_directory, name_allocator):
+    # Plans the moves of groups with too many files or no sidecar and
+    # returns the (base_name, file_group) pairs left to update
+    sidecar_directory = os.path.join(output_directory, "error-missing-sidecar")
+    error_renaming_directory = os.path.join(output_directory, "error-renaming")
+
+    # Edited copies share the original's sidecar, which has to stay for them
+    sidecar_users = {}
+    for file_group in matched_files.values():
+        if file_group['json']:
+            sidecar_users[file_group['json']] = sidecar_users.get(file_group['json'], 0) + 1
 
+    groups_to_update = []
     for base_name, file_group in matched_files.items():
 
         # Check that there base_name doesn't apply to too many files
         if len(file_group['img']) > 2:
             for img_file in file_group['img']:
                 file_path = os.path.join(directory, img_file)
-                shutil.move(file_path, os.path.join(error_renaming_directory, img_file))
-                error_renaming_files.append(file_path)
+                plan.add_move(file_path, result_target(name_allocator, error_renaming_directory, img_file),
+                              section='error-renaming', entry=file_path)
 
-            if file_group['json']:
+            if file_group['json'] and sidecar_users[file_group['json']] == 1:
                 json_file_path = os.path.join(directory, file_group['json'])
-                shutil.move(json_file_path, os.path.join(error_renaming_directory, file_group['json']))
-                error_renaming_files.append(json_file_path)
+                plan.add_move(json_file_path, result_target(name_allocator, error_renaming_directory, file_group['json']),
+                              section='error-renaming', entry=json_file_path)
+            if file_group['json']:
+                sidecar_users[file_group['json']] -= 1
             continue
 
-        sidecar_path = None
-        if file_group['json']:
-            sidecar_path = os.path.join(directory, file_group['json'])
-            sidecar_metadata = read_sidecar_json(sidecar_path)
-        else:
+        if not file_group['json']:
             # Move images to missing sidecar directory
             for img_file in file_group['img']:
                 file_path = os.path.join(directory, img_file)
-                missing_files.append(file_path)
-                shutil.move(file_path, os.path.join(sidecar_directory, img_file))
+                plan.add_move(file_path, result_target(name_allocator, sidecar_directory, img_file),
+                              section='error-missing-sidecars', entry=file_path)
             continue
 
-        modification_info_list = []
-
-        for img_file in file_group['img']: # Loop through all files with the same base name
+        groups_to_update.append((base_name, file_group))
+    return groups_to_update
+
+def plan_duplicate_groups(plan, directory, groups, output_directory, content_index, run_state, name_allocator, workers=1):
+    """Plan the move of every file that's a copy of an earlier file of the run or of one in the library.
+
+    Returns the groups left to update, without their duplicates. A sidecar
+    goes with the duplicates once no file left uses it.
+    """
+    duplicates_directory = os.path.join(output_directory, "duplicates")
+
+    # Files an interrupted run already wrote to don't have their original bytes any more
+    file_paths = group_file_paths(directory, groups)
+    resumed_files = resumed_file_records(run_state, file_paths)
+    with metrics.timer('dedup'):
+        duplicates, hashes = find_duplicates([f for f in file_paths if f not in resumed_files], content_index, workers)
+    if content_index:
+        for file_path, file_hashes in hashes.items():
+            content_index.remember(file_path, file_hashes)
+    metrics.count('duplicates', len(duplicates))
+
+    def plan_duplicate_move(file_path, entry):
+        target = result_target(name_allocator, duplicates_directory, os.path.relpath(file_path, directory))
+        plan.add_move(file_path, target, section='duplicates', entry=entry)
+        return target
+
+    remaining_groups = []
+    used_sidecars = set()
+    unused_sidecars = []
+    for base_name, file_group in groups:
+        remaining = []
+        for img_file in file_group['img']:
             file_path = os.path.join(directory, img_file)
+            original = duplicates.get(file_path)
+            if original is None:
+                remaining.append(img_file)
+                continue
+            target = plan_duplicate_move(file_path, {'filename': os.path.basename(file_path), 'file': file_path, 'duplicate-of': original})
+            if dedup_mode == 'link' and content_index:
+                content_index.links.append((target, original, hashes.get(original)))
+
+        if remaining:
+            remaining_groups.append((base_name, dict(file_group, img=remaining)))
+            used_sidecars.add(file_group['json'])
+        else:
+            unused_sidecars.append(file_group['json'])
+
+    for sidecar in dict.fromkeys(unused_sidecars):
+        if sidecar not in used_sidecars:
+            plan_duplicate_move(os.path.join(directory, sidecar), None)
+    return remaining_groups
+
+def group_file_paths(directory, groups):
+    return [os.path.join(directory, img_file)
+            for base_name, file_group in groups
+            for img_file in file_group['img']]
+
+def resumed_file_records(run_state, file_paths):
+    # Files an interrupted run already wrote the metadata of
+    resumed_files = {}
+    for file_path in file_paths:
+        record = run_state.get(file_path) if run_state else None
+        if record and record['stage'] == stages.METADATA_WRITTEN:
+            resumed_files[file_path] = record
+    return resumed_files
+
+def plan_prepared_group(write_plan, pending_files, group, prepared_group):
+    base_name, file_group = group
+    sidecar_path, prepared_files = prepared_group
+    # Files that failed get their error folder name in plan_written_files,
+    # with every other name, so names are handed out in group order
+    for file_path, extension, modification_info, exiftool_commands, error in prepared_files:
+        if exiftool_commands and not error:
+            write_plan.add(file_path, exiftool_commands)
+        pending_files.append((base_name, file_group, sidecar_path, file_path, extension, modification_info, error))
+
+def record_written_files(pending_by_path, batch_results, run_state):
+    # Every file is recorded as soon as its batch is written, so a restart
+    # doesn't read and write the same metadata again
+    with run_state.transaction() if run_state else nullcontext():
+        for file_path, (succeeded, output) in batch_results.items():
+            base_name, file_group, sidecar_path, _, extension, modification_info, _ = pending_by_path[file_path]
+            if succeeded and modification_info:
+                modification_info['exiftool-output'] += output + ";"
+                if run_state:
+                    run_state.record(file_path, stages.METADATA_WRITTEN, modification_info, file_path, base_name, group_report_key(file_group, extension), sidecar_path)
+
+def group_report_key(file_group, extension):
+    return "LIVE" if len(file_group['img']) > 1 else extension
+
+def plan_written_files(plan, pending_files, write_results, run_state, name_allocator, directory, output_directory):
+    # Written files were recorded by record_written_files
+    error_directory = os.path.join(output_directory, "processing-errors")
+    success_directory = os.path.join(output_directory, "successfully-processed")
+    processed_sidecars_directory = os.path.join(output_directory, "processed-sidecars")
+
+    sidecar_sources = {}
+    unwritten = []
+    for base_name, file_group, sidecar_path, file_path, extension, modification_info, error in pending_files:
+        if error:
+            plan_error_move(plan, file_path, modification_info, error, error_directory, directory, name_allocator)
+            continue
 
-            extension, modification_info = update_exif_data_with_exiftool(file_path, sidecar_metadata, error_directory, error_files)
-
-            if modification_info:
-                file_path = rename_file_based_on_datetime(file_path, modification_info, error_renaming_directory, error_renaming_files, processed_sidecars_directory, sidecar_path, success_directory)
-                
-                if file_path is None:
-                    # File renaming failed, move to the next file
-                    write_report(report_timestamp, directory, missing_files, error_files, error_renaming_files, extension_modifications)
+        report_key = group_report_key(file_group, extension)
+        if modification_info and file_path in write_results:
+            succeeded, output = write_results[file_path]
+            if not succeeded:
+                plan_error_move(plan, file_path, modification_info, output, error_directory, directory, name_allocator)
+                modification_info = None
+        elif modification_info:
+            unwritten.append((file_path, stages.METADATA_WRITTEN, modification_info, file_path, base_name, report_key, sidecar_path))
+
+        if modification_info:
+            operation = plan_rename(plan, file_path, modification_info, success_directory, name_allocator,
+                                    section='modifications', entry=modification_info,
+                                    report_key=report_key, group=base_name, stage=stages.MOVED)
+            if operation['target'] is not None:
+                sidecar_sources.setdefault(sidecar_path, []).append(file_path)
+
+    # A sidecar is archived once any file that used it was moved
+    for sidecar_path, sources in sidecar_sources.items():
+        plan.add_move(sidecar_path, result_target(name_allocator, processed_sidecars_directory, os.path.relpath(sidecar_path, directory)),
+                      section='processed-sidecars', requires=sources)
+
+    # Files with nothing to write are recorded before anything is moved too
+    if run_state:
+        with run_state.transaction():
+            for record in unwritten:
+                run_state.record(*record)
+
+def apply_file_plan(plan, journal, run_state, missing_files, error_files, error_renaming_files, extension_modifications, error_renaming_directory, undo_log=None, content_index=None):
+    # Each move is recorded in the run state before it happens, a resumed run
+    # checks where the file actually ended up. The modification info was
+    # stored with METADATA_WRITTEN already
+    def record_stage(operation):
+        if run_state and operation.get('stage'):
+            run_state.record(operation['source'], operation['stage'], current_path=operation['target'])
+        # A hard link that wasn't written to is still the Takeout file, whose time has to stay
+        if output_mode == 'hardlink' and operation.get('mtime') is not None:
+            break_hard_link(operation['source'])
+
+    # Files moved to an error or duplicates folder are finished too, a
+    # resumed archive run doesn't extract them again
+    def record_error_moved(operation):
+        if run_state and operation.get('section') not in ('modifications', 'processed-sidecars'):
+            run_state.record(operation['source'], stages.DONE)
+
+    # The run state is committed once per folder of moves, not per file
+    transaction = run_state.transaction if run_state else nullcontext
+    with metrics.timer('moves'):
+        errors = apply_operations(plan.operations, undo_log, record_stage, record_error_moved, transaction)
+
+    sections = {
+        'error-missing-sidecars': missing_files,
+        'error-processing': error_files,
+        'error-renaming': error_renaming_files,
+    }
+    library_moves = []
+    with transaction():
+        for operation, error in zip(plan.operations, errors):
+            # Once reported an entry only lives on in the journal
+            entry = operation.pop('entry', None)
+            section = operation.get('section')
+            if section in sections:
+                if error:
+                    print(f"Error moving {operation['source']}: {error}")
+                sections[section].append(entry)
+                metrics.count('files-failed')
+
+            elif section == 'modifications':
+                file_path, modification_info = operation['source'], entry
+                if error:
+                    print(f"Error renaming file {file_path}: {error}")
+                    error_renaming_files.append(modification_info)
+                    if os.path.exists(file_path):
+                        base_name, extension = os.path.splitext(os.path.basename(file_path))
+                        try:
+                            os.makedirs(error_renaming_directory, exist_ok=True)
+                            error_path = os.path.join(error_renaming_directory, NameAllocator().allocate(error_renaming_directory, base_name, extension))
+                            if undo_log:
+                                undo_log.record([{'source': file_path, 'target': error_path}])
+                            move_file(file_path, error_path)
+                        except OSError as e:
+                            print(f"Error moving {file_path} to {error_renaming_directory}: {e}")
+                    if run_state:
+                        run_state.forget(file_path)
+                    metrics.count('files-failed')
                     continue
 
+                if operation['target'] is not None:
+                    if 'mtime_updated' in operation:
+                        modification_info['file_mtime_updated'] = operation['mtime_updated']
+                    metrics.count('bytes', file_size(operation['target']))
+                    library_moves.append((file_path, operation['target']))
+                add_modification(extension_modifications, journal, operation['report_key'], operation['group'], modification_info)
+                if run_state:
+                    run_state.record(file_path, stages.DONE)
+
+                metrics.count('files-done')
+                metrics.progress()
+
+            elif section == 'duplicates':
+                if error:
+                    print(f"Error moving duplicate {operation['source']}: {error}")
+                elif entry:
+                    content_index.duplicates.append(entry)
+
+            elif error and error != 'skipped':
+                print(f"Error archiving sidecar {operation['source']}: {error}")
+
+    # Later copies of these files are recognised as duplicates
+    if content_index:
+        content_index.record_moves(library_moves)
+        record_duplicates(journal, content_index)
+
+def record_duplicates(journal, content_index, run_over=False):
+    # A duplicate is reported once its original is in the library, with
+    # the path it has there. Once the run is over the rest are reported
+    # with the path their original had
+    waiting = []
+    for entry in content_index.duplicates:
+        original = entry['duplicate-of']
+        if original in content_index.pending and not run_over:
+            waiting.append(entry)
+            continue
+        entry['duplicate-of'] = content_index.final_paths.get(original, original)
+        journal.record('duplicates', entry)
+    content_index.duplicates = waiting
 
-                modification_info_list.append(modification_info)
-                if len(file_group['img']) > 1:
-                    # Group under "LIVE" if more than one image in the group
-                    extension = "LIVE"
-                    if extension not in extension_modifications:
-                        extension_modifications[extension] = {}
-                    if base_name not in extension_modifications[extension]:
-                        extension_modifications[extension][base_name] = []
-                    extension_modifications[extension][base_name].append(modification_info)
-                else:
-                    if extension not in extension_modifications:
-                        extension_modifications[extension] = []
-                    extension_modifications[extension].append(modification_info)
-
-                write_report(report_timestamp, directory, missing_files, error_files, error_renaming_files, extension_modifications)
-
-            files_examined += 1
-            if files_examined % report_number == 0:
-                print_report(missing_files, error_files, error_renaming_files, extension_modifications)
-        
-
-    return missing_files, error_files, error_renaming_files, extension_modifications
-
-
-def write_report(timestamp, directory, missing_files, error_files, error_renaming_files, extension_modifications):
-    # timestamp = datetime.now().strftime(desired_datetime_format)
-    report_filename = f"report_{timestamp}.json"
-    report_path = os.path.join(directory, report_filename)
-
-    # Function to convert datetime objects to strings
-    def datetime_converter(o):
-        if isinstance(o, datetime):
-            return o.strftime("%Y-%m-%d %H:%M:%S")
-
-    report_data = {
-        "run-datetime": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "error-missing-sidecars": {
-            "total": len(missing_files),
-            "filelist": missing_files
-        },
-        "error-processing": {
-            "total": len(error_files),
-            "filelist": error_files
-        },
-        "error-renaming": {
-            "total": len(error_renaming_files),
-            "filelist": error_renaming_files
-        },
-        "modifications": extension_modifications  # Add the grouped modifications
-    }
-
-    with open(report_path, 'w') as report_file:
-        json.dump(report_data, report_file, indent=4, default=datetime_converter)
+def file_size(file_path):
+    try:
+        return os.path.getsize(file_path)
+    except OSError:
+        return 0
+
+
+# Function to convert datetime objects to strings
+def datetime_converter(o):
+    if isinstance(o, datetime):
+        return o.strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(o, ReportRecord):
+        return o.as_dict()
+
+# Folders process_directory moves files into, never scanned as input
+result_directories = ['duplicates', 'error-missing-sidecar', 'error-renaming', 'processed-sidecars', 'processing-errors', 'successfully-processed']
+
+# Archive runs extract this many files (and at most this many bytes, unless
+# a single group is bigger) at a time into the staging directory
+archive_chunk_size = 1000
+archive_chunk_bytes = 1024 * 1024 * 1024
+archive_staging_directory = '.takeout-staging'
+
+# Per-file progress of the current run, kept in the target directory
+run_state_filename = '.process-google-photos-state.sqlite'
+
+# Number of journal events buffered before they are appended to the file
+journal_flush_size = 100
+
+class ReportJournal:
+    """Append-only JSON Lines record of the report, one event per line.
+
+    Rewriting the full report after every file gets slower as the library
+    grows, so events are appended in batches and the report is built once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pending = []
+
+    def record(self, section, entry, extension=None, group=None):
+        event = {'section': section, 'entry': entry}
+        if extension is not None:
+            event['extension'] = extension
+        if group is not None:
+            event['group'] = group
+        self.pending.append(json.dumps(event, default=datetime_converter))
+        if len(self.pending) >= journal_flush_size:
+            self.flush()
+
+    def flush(self):
+        # Opened even with nothing pending so an empty run still has a journal
+        with open(self.path, 'a') as journal_file:
+            if self.pending:
+                journal_file.write('\n'.join(self.pending) + '\n')
+        self.pending = []
+
+    def close(self):
+        self.flush()
+
+class ReportRecord:
+    """What stays in memory of a reported file, the full entry is in the journal.
+
+    Section and report key strings are interned, so millions of records
+    share one copy of each.
+    """
+
+    __slots__ = ('section', 'report_key', 'group', 'filename', 'new_filename')
+
+    def __init__(self, section, entry, report_key=None, group=None):
+        self.section = sys.intern(section)
+        self.report_key = sys.intern(report_key) if report_key else None
+        self.group = group
+        self.filename = entry.get('filename')
+        self.new_filename = entry.get('new_filename')
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__ if getattr(self, field) is not None}
+
+def compact_entry(section, entry, report_key=None, group=None):
+    # File paths are already small, report entries become a ReportRecord
+    if isinstance(entry, dict):
+        return ReportRecord(section, entry, report_key, group)
+    return entry
+
+class JournaledList(list):
+    """A list that records everything appended to it in the journal and only
+    keeps a compact record of it."""
+
+    def __init__(self, journal, section):
+        super().__init__()
+        self.journal = journal
+        self.section = section
+
+    def append(self, entry):
+        self.journal.record(self.section, entry)
+        super().append(compact_entry(self.section, entry))
+
+def is_report_journal(filename):
+    return filename.startswith('report_') and filename.endswith('.jsonl')
+
+def is_run_log(filename):
+    # Report journals, undo logs and metrics left in the directory by earlier runs
+    return (is_report_journal(filename) or (filename.startswith('undo_') and filename.endswith('.jsonl'))
+            or (filename.startswith('metrics_') and filename.endswith('.json')))
+
+def index_report_journal(journal_path):
+    """Return where the entries of every report section are in a journal.
+
+    ({section: offsets}, {extension: offsets or {group: offsets}}), with
+    the line offsets in compact arrays and everything in journal order.
+    """
+    section_offsets = {'error-missing-sidecars': array('q'), 'error-processing': array('q'), 'error-renaming': array('q')}
+    modification_offsets = {}
+
+    with open(journal_path, 'rb') as journal_file:
+        offset = 0
+        for line in journal_file:
+            line_offset, offset = offset, offset + len(line)
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                # A run that was killed can leave half a line at the end
+                continue
+
+            if event['section'] in section_offsets:
+                section_offsets[event['section']].append(line_offset)
+            elif event['section'] == 'duplicates':
+                # Only runs with --dedup have this section
+                section_offsets.setdefault('duplicates', array('q')).append(line_offset)
+            elif 'group' in event:
+                modification_offsets.setdefault(event['extension'], {}).setdefault(event['group'], array('q')).append(line_offset)
+            else:
+                modification_offsets.setdefault(event['extension'], array('q')).append(line_offset)
+
+    return section_offsets, modification_offsets
+
+def write_report_from_journal(journal_path, report_path=None):
+    """Build report_<timestamp>.json from report_<timestamp>.jsonl.
+
+    Entries are copied from the journal one at a time, in report order, so
+    a run of any size is never loaded into memory at once.
+    """
+    report_path = report_path or os.path.splitext(journal_path)[0] + '.json'
+    section_offsets, modification_offsets = index_report_journal(journal_path)
+
+    # Arrays of offsets are written as the list of their entries, laid out
+    # the way json.dump(indent=4) would
+    with open(journal_path, 'rb') as journal_file, open(report_path, 'w') as report_file:
+        def write_value(value, depth):
+            if isinstance(value, (array, dict)):
+                items = value.items() if isinstance(value, dict) else value
+                is_object = isinstance(value, dict)
+                if not len(value):
+                    report_file.write('{}' if is_object else '[]')
+                    return
+                indent = '\n' + ' ' * 4 * (depth + 1)
+                report_file.write('{' if is_object else '[')
+                for number, item in enumerate(items):
+                    report_file.write((',' if number else '') + indent)
+                    if is_object:
+                        report_file.write(json.dumps(item[0]) + ': ')
+                        write_value(item[1], depth + 1)
+                    else:
+                        journal_file.seek(item)
+                        entry = json.loads(journal_file.readline())['entry']
+                        report_file.write(json.dumps(entry, indent=4, default=datetime_converter).replace('\n', indent))
+                report_file.write('\n' + ' ' * 4 * depth + ('}' if is_object else ']'))
+            else:
+                report_file.write(json.dumps(value))
+
+        report = {'run-datetime': datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+        for section, offsets in section_offsets.items():
+            report[section] = {'total': len(offsets), 'filelist': offsets}
+        report['modifications'] = modification_offsets
+        write_value(report, 0)
 
     return report_path
 
@@ -492,14 +1454,83 @@ def print_report(missing_files, error_files, error_renaming_files, extension_mod
     print(f"\n{success_count + fail_count} files processed ({success_count} success, {fail_count} fail)\n")
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: ./script.py <directory>")
-        sys.exit(1)
-
-    directory = sys.argv[1]
-    report_number = 10
-    missing_files, error_files, error_renaming_files, extension_modifications = process_directory(directory, report_number)
-    # report_path = write_report(directory, missing_files, error_files, error_renaming_files, extension_modifications)
+    arg_parser = argparse.ArgumentParser(description="Process a directory from Google Photos Takeout")
+    arg_parser.add_argument('directory', nargs='?')
+    arg_parser.add_argument('--workers', type=int, default=1,
+                            help="number of groups prepared and exiftool processes run in parallel")
+    arg_parser.add_argument('--recursive', action='store_true',
+                            help="also process every folder below the directory, matching sidecars across folders")
+    arg_parser.add_argument('--archive', nargs='+', metavar='PATH',
+                            help="read the Takeout from these .zip/.tgz parts (or folders of them) "
+                                 "instead of an unpacked directory, which becomes the output. Zip parts are "
+                                 "extracted a chunk at a time, .tgz/.tar parts can only be listed by reading "
+                                 "them through, so they are extracted in full into the staging folder first")
+    arg_parser.add_argument('--build-report', metavar='JOURNAL',
+                            help="only build the report_<timestamp>.json of an earlier run from its journal")
+    arg_parser.add_argument('--gpx', metavar='DIRECTORY',
+                            help="place photos without a location in their sidecar using the GPX tracks in this directory")
+    arg_parser.add_argument('--gpx-max-gap', type=float, default=default_max_gap, metavar='SECONDS',
+                            help="longest gap between track points that is interpolated over, and furthest a photo can be from one")
+    arg_parser.add_argument('--dedup', choices=['skip', 'link'],
+                            help="move copies of a file already processed (in this run or the library) to duplicates instead of "
+                                 "processing them again, with link as hard links to the copy that was kept")
+    arg_parser.add_argument('--output-mode', choices=output_modes, default='move',
+                            help="move the files into the result folders (default), or leave the Takeout as it is and "
+                                 "process a hard link, reflink (a copy where not supported) or copy of each file")
+    arg_parser.add_argument('--watch', action='store_true',
+                            help="keep running and process new groups as they are dropped into the directory")
+    arg_parser.add_argument('--poll', type=float, metavar='SECONDS',
+                            help="with --watch, look for new files every SECONDS instead of using inotify (e.g. on a network share)")
+    arg_parser.add_argument('--dry-run', action='store_true',
+                            help="only print what would be written and moved, changing nothing")
+    arg_parser.add_argument('--save-plan', metavar='PATH',
+                            help="with --dry-run, also save the plan as JSON for review")
+    arg_parser.add_argument('--undo', metavar='UNDO_LOG',
+                            help="move the files of an earlier run back, using its undo_<timestamp>.jsonl. The copies "
+                                 "and links of an --output-mode other than move are deleted")
+    arg_parser.add_argument('--profile', metavar='PATH',
+                            help="save a profile of the run: a trace of every stage on every thread for PATH.json "
+                                 "(chrome://tracing, Perfetto), cProfile stats of the main thread otherwise")
+    args = arg_parser.parse_args()
+
+    if args.build_report:
+        print(write_report_from_journal(args.build_report))
+        sys.exit(0)
+    if args.undo:
+        print(f"{undo(args.undo)} files moved back or removed")
+        sys.exit(0)
+    if not args.directory:
+        arg_parser.error("a directory is required")
+    if args.dry_run and args.archive:
+        arg_parser.error("--dry-run works on a directory, not on archives")
+    if args.output_mode != 'move' and args.archive:
+        arg_parser.error("--output-mode is for a directory, archives are always extracted")
+    if args.watch and (args.archive or args.recursive or args.dry_run):
+        arg_parser.error("--watch only works on an unpacked directory, without --recursive or --dry-run")
+
+    directory = args.directory
+    dedup_mode = args.dedup
+    output_mode = args.output_mode
+    if args.gpx:
+        gpx_track_index = GpxTrackIndex.from_directory(args.gpx, args.gpx_max_gap)
+        print(f"{len(gpx_track_index)} track points loaded from {len(gpx_track_index.track_names)} GPX files")
+    if args.dry_run:
+        plan = plan_directory(directory, max(1, args.workers), args.recursive)
+        for line in plan.describe():
+            print(line)
+        print(f"\n{len(plan.writes)} metadata writes and {len(plan.operations)} moves planned, nothing changed")
+        if args.save_plan:
+            print(plan.save(args.save_plan))
+        sys.exit(0)
+
+    progress_interval = 5
+    if args.watch:
+        run_profiled(args.profile, watch_directory, directory, progress_interval, max(1, args.workers), args.poll)
+        sys.exit(0)
+    archive_paths = find_archives(args.archive) if args.archive else None
+    if archive_paths is not None:
+        os.makedirs(directory, exist_ok=True)
+    missing_files, error_files, error_renaming_files, extension_modifications = run_profiled(
+        args.profile, process_directory, directory, progress_interval, max(1, args.workers), archive_paths, args.recursive)
     print(f"\n\nCOMPLETE: {directory}\n\n")
     print_report(missing_files, error_files, error_renaming_files, extension_modifications)
-
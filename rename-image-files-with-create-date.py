@@ -9,8 +9,32 @@ import sys
 from PIL import Image
 from PIL.ExifTags import TAGS
 import datetime
+from exif_reader import read_tags
+from metadata_cache import MISS, get_metadata_cache
+from name_allocator import NameAllocator
 
 def get_date_taken(path):
+    # Reuse the date from an earlier run if the file hasn't changed since
+    cache = get_metadata_cache()
+    if cache:
+        cached = cache.get(path, 'date-taken')
+        if cached is not MISS:
+            return datetime.datetime.fromisoformat(cached) if cached else None
+
+    date_taken = read_date_taken(path)
+    if cache:
+        cache.put(path, 'date-taken', date_taken.isoformat() if date_taken else None)
+    return date_taken
+
+def read_date_taken(path):
+    # JPEG and HEIC headers are parsed directly, PIL is only opened for other formats
+    tags = read_tags(path, ['DateTimeOriginal'])
+    if tags is not None:
+        try:
+            return datetime.datetime.strptime(tags['DateTimeOriginal'], "%Y:%m:%d %H:%M:%S")
+        except (KeyError, ValueError):
+            return None
+
     try:
         img = Image.open(path)
         exif_data = img._getexif()
@@ -25,13 +49,11 @@ def get_date_taken(path):
 def get_creation_time(path):
     return datetime.datetime.fromtimestamp(os.path.getmtime(path))
 
-def unique_filename(directory, base_filename, extension):
-    counter = 1
-    new_filename = base_filename + extension
-    while os.path.exists(os.path.join(directory, new_filename)):
-        new_filename = f"{base_filename}-{counter}{extension}"
-        counter += 1
-    return new_filename
+# Lists the directory once instead of checking every -1, -2, ... name
+name_allocator = NameAllocator()
+
+def unique_filename(directory, base_filename, extension, replacing=None):
+    return name_allocator.allocate(directory, base_filename, extension, '-', replacing)
 
 def rename_files(directory):
     renamed_files = {}
@@ -41,7 +63,7 @@ def rename_files(directory):
             date_taken = get_date_taken(original_filepath) or get_creation_time(original_filepath)
             base_filename = date_taken.strftime("%Y-%m-%d_%H.%M.%S")
             extension = os.path.splitext(filename)[1]
-            new_filename = unique_filename(directory, base_filename, extension)
+            new_filename = unique_filename(directory, base_filename, extension, filename)
             new_filepath = os.path.join(directory, new_filename)
             os.rename(original_filepath, new_filepath)
             print(f"Renamed {filename} to {new_filename}")
@@ -1,17 +1,86 @@
+import argparse
 import os
 import sys
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from metadata_cache import MISS, get_metadata_cache
+from name_allocator import NameAllocator
 
 ### rename_gpx.py ###
 ### Adlai Gordon - March 2025 ###
 ### Renames a directory of gpx files with their datestamps ###
 ### Optional Suffix argument to add additional text to the end ###
+### Usage: rename_gpx.py <directory> [suffix] [--workers N] ###
 
 def format_timestamp(timestamp):
     """Convert timestamp by replacing 'T' with '_' and ':' with '-'"""
     return timestamp.replace('T', '_').replace(':', '-')
 
-def rename_gpx_files(directory, suffix=None):
+def local_name(tag):
+    # '{http://www.topografix.com/GPX/1/1}time' -> 'time', for GPX 1.0 and 1.1 alike
+    return tag.rpartition('}')[2]
+
+def read_gpx_timestamp(filepath):
+    """Return the metadata/time text of a gpx file, else the time of its first
+    track point, else None.
+
+    The file is parsed as a stream and reading stops at the first usable
+    time, so only the start of a long track is ever read.
+    """
+    path = []
+    parents = []
+    with open(filepath, 'rb') as gpx_file:
+        for event, elem in ET.iterparse(gpx_file, events=('start', 'end')):
+            if event == 'start':
+                path.append(local_name(elem.tag))
+                parents.append(elem)
+                continue
+
+            path.pop()
+            parents.pop()
+            if local_name(elem.tag) == 'time' and elem.text and elem.text.strip():
+                parent = path[-1] if path else None
+                # GPX 1.1 keeps the time in <metadata>, GPX 1.0 directly in <gpx>
+                if parent in ('metadata', 'gpx') and len(path) <= 2:
+                    return elem.text.strip()
+                # <metadata> comes before the tracks, so there is none
+                if parent == 'trkpt':
+                    return elem.text.strip()
+            # Finished elements aren't needed, dropping them keeps memory
+            # flat however long the track is
+            if parents:
+                del parents[-1][:]
+    return None
+
+def get_gpx_timestamp(filepath):
+    """read_gpx_timestamp, unless an earlier run already read the file"""
+    cache = get_metadata_cache()
+    if cache:
+        cached = cache.get(filepath, 'gpx-start-time')
+        if cached is not MISS:
+            return cached
+
+    timestamp = read_gpx_timestamp(filepath)
+    if cache:
+        cache.put(filepath, 'gpx-start-time', timestamp)
+    return timestamp
+
+def read_timestamp_or_error(filename):
+    # Runs on the worker threads: (timestamp, None) or (None, error message)
+    try:
+        # Check if file is readable and has content
+        if not os.path.getsize(filename) > 0:
+            return None, f"Skipping {filename}: File is empty"
+        timestamp = get_gpx_timestamp(filename)
+        if timestamp is None:
+            return None, f"Error: No metadata/time or trkpt/time found in {filename}"
+        return timestamp, None
+    except ET.ParseError as e:
+        return None, f"Error parsing XML in {filename}: {str(e)}"
+    except Exception as e:
+        return None, f"Unexpected error processing {filename}: {str(e)}"
+
+def rename_gpx_files(directory, suffix=None, workers=1):
     # Check if directory exists
     if not os.path.isdir(directory):
         print(f"Error: Directory '{directory}' does not exist")
@@ -20,73 +89,43 @@ def rename_gpx_files(directory, suffix=None):
     # Change to directory
     os.chdir(directory)
 
+    name_allocator = NameAllocator()
+
     # Counter for processed files
     processed = 0
     errors = 0
 
-    # Loop through all .gpx files
-    for filename in os.listdir('.'):
-        if not filename.endswith('.gpx'):
-            continue
-
-        processed += 1
-        old_filepath = filename
-
-        try:
-            # Check if file is readable and has content
-            if not os.path.getsize(old_filepath) > 0:
-                print(f"Skipping {filename}: File is empty")
+    # Timestamps are read in parallel, the renames happen here in listing
+    # order so the _1, _2 ... suffixes are the same for any number of workers
+    filenames = [filename for filename in os.listdir('.') if filename.endswith('.gpx')]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for filename, (timestamp, error) in zip(filenames, executor.map(read_timestamp_or_error, filenames)):
+            processed += 1
+            if error:
+                print(error)
                 errors += 1
                 continue
 
-            # Parse the XML file
-            tree = ET.parse(old_filepath)
-            root = tree.getroot()
-
-            # Define namespace
-            namespace = {'gpx': 'http://www.topografix.com/GPX/1/1'}
-            
-            # Try to find the time element
-            time_element = root.find('.//gpx:metadata/gpx:time', namespace)
-            
-            if time_element is None:
-                # Try without namespace as a fallback
-                time_element = root.find('.//metadata/time')
-                
-            if time_element is not None:
-                timestamp = time_element.text
+            try:
                 formatted_timestamp = format_timestamp(timestamp)
-                # Build new filename with optional suffix
-                new_filename = f"{formatted_timestamp}{'_' + suffix if suffix else ''}.gpx"
-                os.rename(old_filepath, new_filename)
-                print(f"Renamed: {old_filepath} -> {new_filename}")
-            else:
-                print(f"Error: No timestamp found in {filename}")
-                # Print the XML structure for debugging
-                print("XML structure preview:")
-                for elem in root.iter():
-                    print(f"  {elem.tag}")
-                    if elem.text and elem.text.strip():
-                        print(f"    Text: {elem.text.strip()}")
+                # Build new filename with optional suffix, tracks from the
+                # same second get _1, _2, ... instead of overwriting each other
+                new_filename = name_allocator.allocate('.', f"{formatted_timestamp}{'_' + suffix if suffix else ''}", '.gpx', replacing=filename)
+                os.rename(filename, new_filename)
+                print(f"Renamed: {filename} -> {new_filename}")
+            except Exception as e:
+                print(f"Unexpected error processing {filename}: {str(e)}")
                 errors += 1
 
-        except ET.ParseError as e:
-            print(f"Error parsing XML in {filename}: {str(e)}")
-            errors += 1
-        except Exception as e:
-            print(f"Unexpected error processing {filename}: {str(e)}")
-            errors += 1
-
     print(f"\nProcessing complete!")
     print(f"Files processed: {processed}")
     print(f"Files with errors: {errors}")
 
 if __name__ == "__main__":
-    # Check arguments
-    if len(sys.argv) < 2 or len(sys.argv) > 3:
-        print(f"Usage: {sys.argv[0]} <directory_path> [suffix]")
-        sys.exit(1)
-    
-    directory = sys.argv[1]
-    suffix = sys.argv[2] if len(sys.argv) == 3 else None
-    rename_gpx_files(directory, suffix)
\ No newline at end of file
+    arg_parser = argparse.ArgumentParser(description="Rename a directory of gpx files with their datestamps")
+    arg_parser.add_argument('directory')
+    arg_parser.add_argument('suffix', nargs='?', help="text added to the end of every new name")
+    arg_parser.add_argument('--workers', type=int, default=4,
+                            help="number of files read in parallel")
+    args = arg_parser.parse_args()
+    rename_gpx_files(args.directory, args.suffix, max(1, args.workers))
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+#########################################################################
+# File      run_metrics.py                                              #
+# Author    Adlai Gordon                                                #
+# Purpose   Time every stage of a run (exiftool reads and writes,       #
+#             sidecar parsing, timezone lookups, moves, ...) and count  #
+#             files and bytes, from any thread                          #
+#           Gives a progress line at most every few seconds, a JSON     #
+#             metrics file with p50/p99 per stage at the end, and a     #
+#             trace of every timed span for chrome://tracing / Perfetto #
+#########################################################################
+
+import cProfile
+import json
+import os
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+
+
+class RunMetrics:
+    """Per-stage timings and counters of one run, safe to share between threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Keep every timed span too, for write_trace
+        self.tracing = False
+        # Seconds between two progress lines
+        self.progress_interval = 5
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.perf_counter()
+            self.durations = {}
+            self.counters = {}
+            self.trace_events = [] if self.tracing else None
+            self.last_progress = self.started
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, start, time.perf_counter())
+
+    def add_time(self, stage, start, end):
+        with self._lock:
+            durations = self.durations.get(stage)
+            if durations is None:
+                durations = self.durations[stage] = array('d')
+            durations.append(end - start)
+            if self.trace_events is not None:
+                self.trace_events.append((stage, threading.get_ident(), start, end))
+
+    def count(self, counter, amount=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def summary(self):
+        with self._lock:
+            elapsed = time.perf_counter() - self.started
+            counters = dict(self.counters)
+            stages = {stage: _stage_summary(durations) for stage, durations in self.durations.items()}
+        files = counters.get('files-done', 0) + counters.get('files-failed', 0)
+        return {
+            'elapsed-seconds': round(elapsed, 3),
+            'files-per-second': round(files / elapsed, 2) if elapsed else None,
+            'bytes-per-second': round(counters.get('bytes', 0) / elapsed) if elapsed else None,
+            'counters': counters,
+            'stages': stages,
+        }
+
+    def progress_line(self):
+        summary = self.summary()
+        counters = summary['counters']
+        done, failed = counters.get('files-done', 0), counters.get('files-failed', 0)
+        read = sum(counters.get(counter, 0) for counter in ('metadata-cache-hits', 'native-read-files', 'exiftool-read-files'))
+        written = counters.get('native-write-files', 0) + counters.get('exiftool-write-files', 0)
+        duplicates = f", {counters['duplicates']} duplicates" if counters.get('duplicates') else ""
+        return (f"{summary['elapsed-seconds']:.0f}s: {read} read, {written} written, "
+                f"{done + failed} files finished ({done} done, {failed} failed{duplicates}), "
+                f"{summary['files-per-second'] or 0:.1f} files/s, {(summary['bytes-per-second'] or 0) / 1e6:.1f} MB/s")
+
+    def progress(self, force=False):
+        """Print the progress line, at most once every progress_interval seconds unless forced."""
+        now = time.perf_counter()
+        with self._lock:
+            if not force and now - self.last_progress < self.progress_interval:
+                return
+            self.last_progress = now
+        print(self.progress_line(), flush=True)
+
+    def write(self, path):
+        with open(path, 'w') as metrics_file:
+            json.dump(self.summary(), metrics_file, indent=4)
+        return path
+
+    def write_trace(self, path):
+        """Write the timed spans in the Chrome trace event format, one row per thread."""
+        with self._lock:
+            events = list(self.trace_events or [])
+            started = self.started
+        threads = {}
+        trace = [{'name': stage, 'ph': 'X', 'pid': os.getpid(), 'tid': threads.setdefault(thread, len(threads)),
+                  'ts': round((start - started) * 1e6), 'dur': round((end - start) * 1e6)}
+                 for stage, thread, start, end in events]
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, trace_file)
+        return path
+
+
+def _stage_summary(durations):
+    ordered = sorted(durations)
+    return {
+        'calls': len(ordered),
+        'total-seconds': round(sum(ordered), 4),
+        'p50-ms': round(_percentile(ordered, 50) * 1000, 3),
+        'p99-ms': round(_percentile(ordered, 99) * 1000, 3),
+        'max-ms': round(ordered[-1] * 1000, 3),
+    }
+
+
+def _percentile(ordered, percent):
+    # Nearest rank
+    index = max(0, -(-len(ordered) * percent // 100) - 1)
+    return ordered[int(index)]
+
+
+def run_profiled(profile_path, function, *args):
+    """Call function(*args), saving a profile of the call to profile_path.
+
+    A path ending in .json gets a trace of the timed stages on every thread,
+    anything else cProfile stats of the calling thread (for pstats or
+    snakeviz). Without a path the function is just called.
+    """
+    if not profile_path:
+        return function(*args)
+
+    if profile_path.endswith('.json'):
+        metrics.tracing = True
+        try:
+            return function(*args)
+        finally:
+            metrics.write_trace(profile_path)
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        profiler.dump_stats(profile_path)
+
+
+# Shared by everything in one process, process_directory resets it per run
+metrics = RunMetrics()
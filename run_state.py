@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+#########################################################################
+# File      run_state.py                                                #
+# Author    Adlai Gordon                                                #
+# Purpose   Remember how far process_google_photos.py got with each     #
+#             file so an interrupted run can pick up where it stopped   #
+#########################################################################
+
+import json
+import os
+import sqlite3
+from contextlib import contextmanager
+
+# Stages a file goes through, in order
+METADATA_WRITTEN = 'metadata-written'
+MOVED = 'moved'
+SIDECAR_ARCHIVED = 'sidecar-archived'
+DONE = 'done'
+
+
+class RunState:
+    """Per-file progress kept in a small SQLite database in the target directory.
+
+    Files are keyed by their original path. Only the coordinating thread
+    should use an instance, sqlite connections aren't shared between threads.
+    Every change is committed on its own, unless it's made inside
+    transaction().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self._transactions = 0
+        # WAL keeps every commit cheap
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            ' path TEXT PRIMARY KEY,'
+            ' group_name TEXT,'
+            ' report_key TEXT,'
+            ' stage TEXT NOT NULL,'
+            ' current_path TEXT,'
+            ' sidecar_path TEXT,'
+            ' modification_info TEXT)')
+        self.connection.commit()
+
+    def get(self, path):
+        row = self.connection.execute(
+            'SELECT path, group_name, report_key, stage, current_path, sidecar_path, modification_info'
+            ' FROM files WHERE path = ?', (path,)).fetchone()
+        return _row_to_record(row) if row else None
+
+    def unfinished(self):
+        rows = self.connection.execute(
+            'SELECT path, group_name, report_key, stage, current_path, sidecar_path, modification_info'
+            ' FROM files WHERE stage != ? ORDER BY rowid', (DONE,)).fetchall()
+        return [_row_to_record(row) for row in rows]
+
+    def record(self, path, stage, modification_info=None, current_path=None,
+               group_name=None, report_key=None, sidecar_path=None):
+        """Move a file to `stage`, keeping any fields that aren't given."""
+        info_json = json.dumps(modification_info) if modification_info is not None else None
+        self.connection.execute(
+            'INSERT INTO files (path, group_name, report_key, stage, current_path, sidecar_path, modification_info)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?)'
+            ' ON CONFLICT(path) DO UPDATE SET'
+            ' stage = excluded.stage,'
+            ' group_name = COALESCE(excluded.group_name, group_name),'
+            ' report_key = COALESCE(excluded.report_key, report_key),'
+            ' current_path = COALESCE(excluded.current_path, current_path),'
+            ' sidecar_path = COALESCE(excluded.sidecar_path, sidecar_path),'
+            ' modification_info = COALESCE(excluded.modification_info, modification_info)',
+            (path, group_name, report_key, stage, current_path, sidecar_path, info_json))
+        self._commit()
+
+    def forget(self, path):
+        self.connection.execute('DELETE FROM files WHERE path = ?', (path,))
+        self._commit()
+
+    @contextmanager
+    def transaction(self):
+        """Commit every change made in the with block at once, when it ends."""
+        self._transactions += 1
+        try:
+            yield self
+        finally:
+            self._transactions -= 1
+            self._commit()
+
+    def _commit(self):
+        if not self._transactions:
+            self.connection.commit()
+
+    def clear_finished(self):
+        """Drop the finished files, and the database itself once nothing is left."""
+        self.connection.execute('DELETE FROM files WHERE stage = ?', (DONE,))
+        self.connection.commit()
+        if self.connection.execute('SELECT 1 FROM files LIMIT 1').fetchone() is None:
+            self.close()
+            for suffix in ('', '-wal', '-shm'):
+                try:
+                    os.remove(self.path + suffix)
+                except FileNotFoundError:
+                    pass
+
+    def close(self):
+        # Safe to call twice, clear_finished may have closed it already
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+
+def _row_to_record(row):
+    path, group_name, report_key, stage, current_path, sidecar_path, info_json = row
+    return {
+        'path': path,
+        'group_name': group_name,
+        'report_key': report_key,
+        'stage': stage,
+        'current_path': current_path,
+        'sidecar_path': sidecar_path,
+        'modification_info': json.loads(info_json) if info_json else None,
+    }
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+#########################################################################
+# File      takeout_archive.py                                          #
+# Author    Adlai Gordon                                                #
+# Purpose   Read Google Photos Takeout straight from its .zip / .tgz    #
+#             parts instead of unpacking everything first               #
+#           Members are indexed, matched by name, and only the groups   #
+#             that get processed are extracted, a chunk at a time,      #
+#             while earlier chunks are being processed                  #
+#           Zip parts are listed from their central directory. Gzipped  #
+#             tars can only be listed by decompressing them, so their   #
+#             files are written to the staging area in that same pass   #
+#########################################################################
+
+import os
+import queue
+import re
+import shutil
+import tarfile
+import threading
+import time
+import zipfile
+
+# Buffer used when copying a member out of an archive
+copy_buffer_size = 1024 * 1024
+
+# Folder of the staging area tar members wait in until their chunk is filled
+spool_folder = 'spool'
+
+
+class ArchiveMember:
+    __slots__ = ('archive_path', 'name', 'folder', 'basename', 'mtime', 'size', 'spool_path')
+
+    def __init__(self, archive_path, name, mtime, size=0, spool_path=None):
+        path = member_path(name)
+        if path is None:
+            raise ValueError(f"unsafe member name {name!r}")
+        self.archive_path = archive_path
+        self.name = name
+        self.folder, self.basename = os.path.split(path)
+        self.mtime = mtime
+        self.size = size
+        self.spool_path = spool_path
+
+
+def member_path(name):
+    """The relative path a member name is extracted to, or None if it could end up outside the output.
+
+    Absolute names, drive letters and '..' components are refused, empty
+    and '.' components are dropped and backslashes count as separators.
+    """
+    if re.match(r'^([A-Za-z]:|[/\\])', name):
+        return None
+    parts = [part for part in re.split(r'[/\\]', name) if part not in ('', '.')]
+    if not parts or '..' in parts:
+        return None
+    return '/'.join(parts)
+
+
+def _safe_member(archive_path, name):
+    if member_path(name) is None:
+        print(f"Skipping {name} in {archive_path}: the name points outside the output directory")
+        return False
+    return True
+
+
+def is_archive(path):
+    return path.lower().endswith(('.zip', '.tgz', '.tar.gz', '.tar'))
+
+
+def find_archives(paths):
+    """Expand directories into the Takeout parts they contain, sorted by name."""
+    archive_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            archive_paths.extend(sorted(os.path.join(path, f) for f in os.listdir(path) if is_archive(f)))
+        else:
+            archive_paths.append(path)
+    return archive_paths
+
+
+def index_archive_members(archive_paths, spool_directory):
+    """List the regular files in every archive, in the order they are stored.
+
+    Zip parts only need their central directory. Tars are read once, in
+    stream mode, and every file is written to spool_directory on the way
+    (its spool_path), so a gzipped part is never decompressed twice.
+    """
+    members = []
+    for archive_path in archive_paths:
+        if archive_path.lower().endswith('.zip'):
+            with zipfile.ZipFile(archive_path) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir() and _safe_member(archive_path, info.filename):
+                        members.append(ArchiveMember(archive_path, info.filename, _zip_mtime(info), info.file_size))
+        else:
+            os.makedirs(spool_directory, exist_ok=True)
+            with tarfile.open(archive_path, 'r|*') as archive:
+                for info in archive:
+                    if info.isfile() and _safe_member(archive_path, info.name):
+                        spool_path = os.path.join(spool_directory, f"{len(members):09d}")
+                        with archive.extractfile(info) as source, open(spool_path, 'wb') as destination:
+                            shutil.copyfileobj(source, destination, copy_buffer_size)
+                        members.append(ArchiveMember(archive_path, info.name, info.mtime, info.size, spool_path))
+    return members
+
+
+def _zip_mtime(info):
+    try:
+        return time.mktime(info.date_time + (0, 0, -1))
+    except (OverflowError, ValueError):
+        return None
+
+
+def plan_chunks(members, match_files, chunk_size, chunk_bytes=None):
+    """Group members like a directory run would and split them into chunks.
+
+    Folders are matched separately, with the same folder from every part
+    merged so a sidecar in another part is still found. A chunk never mixes
+    folders, so its files can share one flat staging directory, and holds at
+    most chunk_size files and chunk_bytes bytes (unless a single group is
+    bigger). Groups sharing a sidecar, like an -edited copy and its
+    original, stay in the same chunk so they match there the same way.
+    Returns a list of (folder, {basename: member}).
+    """
+    folders = {}
+    for member in members:
+        # The same file can appear in more than one part, keep the first
+        folders.setdefault(member.folder, {}).setdefault(member.basename, member)
+
+    chunks = []
+    for folder, folder_members in folders.items():
+        sidecar_groups = {}
+        for key, file_group in match_files(list(folder_members)).items():
+            # Sidecars without any image are never extracted
+            names = sidecar_groups.setdefault(file_group['json'] or (key,), [])
+            names.extend(file_group['img'])
+            if file_group['json'] and file_group['json'] not in names:
+                names.append(file_group['json'])
+
+        chunk = {}
+        size = 0
+        for names in sidecar_groups.values():
+            group_size = sum(folder_members[name].size for name in names)
+            if chunk and (len(chunk) + len(names) > chunk_size or (chunk_bytes and size + group_size > chunk_bytes)):
+                chunks.append((folder, chunk))
+                chunk = {}
+                size = 0
+            for name in names:
+                chunk[name] = folder_members[name]
+            size += group_size
+        if chunk:
+            chunks.append((folder, chunk))
+    return chunks
+
+
+def extract_chunks(archive_paths, staging_directory, match_files, chunk_size=1000, chunk_bytes=None, max_ready_chunks=2, finished=None):
+    """Yield (chunk_directory, filenames, folder in the archive) as soon as each chunk is filled.
+
+    Chunks are filled one after another on a background thread, so that
+    overlaps with whatever the caller does with a chunk. At most
+    max_ready_chunks filled chunks wait for the caller, which with
+    chunk_bytes keeps the staging area of zip parts to a few chunks. Tar
+    parts are different: all their files are spooled before the first
+    chunk, and the spool only shrinks as chunks take their files.
+
+    finished(path) tells whether an earlier run completed a chunk
+    directory or a file in one. Those chunks, and groups whose images
+    are all finished, are not extracted again.
+    """
+    spool_directory = os.path.join(staging_directory, spool_folder)
+    # Spooled files of an interrupted run may be incomplete
+    shutil.rmtree(spool_directory, ignore_errors=True)
+    chunks = []
+    for index, (folder, chunk) in enumerate(plan_chunks(index_archive_members(archive_paths, spool_directory), match_files, chunk_size, chunk_bytes)):
+        chunk_directory = os.path.join(staging_directory, f"chunk-{index:06d}")
+        if finished is not None:
+            chunk = _unfinished_files(chunk, chunk_directory, match_files, finished)
+        if chunk:
+            chunks.append((chunk_directory, folder, chunk))
+
+    ready = queue.Queue(maxsize=max_ready_chunks)
+
+    def extract():
+        zip_archives = {}
+        try:
+            for chunk_directory, folder, chunk in chunks:
+                os.makedirs(chunk_directory, exist_ok=True)
+                for basename, member in chunk.items():
+                    target = os.path.join(chunk_directory, basename)
+                    if member.spool_path:
+                        os.replace(member.spool_path, target)
+                    else:
+                        archive = zip_archives.get(member.archive_path)
+                        if archive is None:
+                            archive = zip_archives[member.archive_path] = zipfile.ZipFile(member.archive_path)
+                        with archive.open(member.name) as source, open(target, 'wb') as destination:
+                            shutil.copyfileobj(source, destination, copy_buffer_size)
+                    if member.mtime is not None:
+                        os.utime(target, (member.mtime, member.mtime))
+                ready.put((chunk_directory, list(chunk), folder))
+            ready.put(None)
+        except BaseException as e:
+            ready.put(e)
+        finally:
+            for archive in zip_archives.values():
+                archive.close()
+
+    extractor = threading.Thread(target=extract, daemon=True)
+    extractor.start()
+
+    while True:
+        item = ready.get()
+        if item is None:
+            break
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+    extractor.join()
+
+    # Tar files no chunk needed, like sidecars without an image
+    shutil.rmtree(spool_directory, ignore_errors=True)
+
+
+def _unfinished_files(chunk, chunk_directory, match_files, finished):
+    # The images in chunk still to process, and their sidecars
+    needed = set()
+    if not finished(chunk_directory):
+        for file_group in match_files(list(chunk)).values():
+            images = [name for name in file_group['img'] if not finished(os.path.join(chunk_directory, name))]
+            needed.update(images)
+            if images and file_group['json']:
+                needed.add(file_group['json'])
+
+    for basename, member in chunk.items():
+        if basename not in needed and member.spool_path:
+            os.remove(member.spool_path)
+    return {basename: member for basename, member in chunk.items() if basename in needed}
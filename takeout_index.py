@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+#########################################################################
+# File      takeout_index.py                                            #
+# Author    Adlai Gordon                                                #
+# Purpose   Find every file in a Takeout tree spread over album, year   #
+#             and part folders, quickly enough for millions of files    #
+#           Match sidecars to images: exact names are dict lookups,     #
+#             names Google truncated are a bisect prefix search over    #
+#             the sorted image names (SidecarMatcher)                   #
+#########################################################################
+
+import bisect
+import os
+
+
+def scan_tree(directory, skip_directories=()):
+    """Yield the path (relative to directory) of every file below it.
+
+    Uses the file types os.scandir already has from the directory listing,
+    so there is no stat() per entry. Hidden files and folders are skipped,
+    as are skip_directories (relative paths).
+    """
+    skip_directories = set(skip_directories)
+    folders = ['']
+    while folders:
+        folder = folders.pop()
+        with os.scandir(os.path.join(directory, folder)) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                relative_path = os.path.join(folder, entry.name) if folder else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if relative_path not in skip_directories:
+                        folders.append(relative_path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield relative_path
+
+
+# Google truncates the part of a sidecar name before ".json" (and any "(n)")
+# to 46 or 47 characters, so a stem this long may be cut off
+truncated_stem_length = 46
+
+# Newer Takeouts name sidecars IMG_1234.JPG.supplemental-metadata.json,
+# truncated to any prefix of this when the name gets too long
+supplemental_suffix = 'supplemental-metadata'
+
+# Edited copies (IMG_1234-edited.JPG) have no sidecar of their own and use
+# the original's. Google localizes the suffix
+edited_suffixes = ('-edited', '-effects', '-smile', '-mix', '-bearbeitet', '-bewerkt',
+                   '-modifié', '-editado', '-edytowane')
+
+
+def split_parenthetical(name):
+    # IMG_1234.JPG(1) -> ('IMG_1234.JPG', '(1)'), without a regex per name
+    if name.endswith(')'):
+        start = name.rfind('(')
+        if start >= 0 and name[start + 1:-1].isdigit():
+            return name[:start], name[start:]
+    return name, ''
+
+
+def strip_supplemental(stem):
+    # IMG_1234.JPG.supplemental-meta -> IMG_1234.JPG
+    dot = stem.rfind('.')
+    if dot > 0 and supplemental_suffix.startswith(stem[dot + 1:]) and stem[dot + 1:]:
+        return stem[:dot]
+    return stem
+
+
+class SidecarMatcher:
+    """Resolves sidecar names to image groups using indexes built once.
+
+    groups is {base_name: {'img': [...], 'json': ...}} as built by
+    create_matched_file_list. Exact names are dict lookups, truncated names
+    are a prefix search over the sorted image names, so matching a listing
+    is O(n log n) overall.
+    """
+
+    def __init__(self, groups):
+        self.groups = groups
+        self.group_by_filename = {}
+        for base_name, file_group in groups.items():
+            for img_file in file_group['img']:
+                self.group_by_filename[img_file] = base_name
+        self.sorted_filenames = sorted(self.group_by_filename)
+
+    def resolve(self, json_file):
+        """Return the base names a sidecar could belong to.
+
+        One entry is a match, more than one means the name is ambiguous
+        (only possible for truncated names), none means no image fits.
+        """
+        stem = json_file[:-len('.json')] if json_file.lower().endswith('.json') else json_file
+        core, parenthetical = split_parenthetical(stem)
+        core = strip_supplemental(core)
+        core_base, core_extension = os.path.splitext(core)
+
+        if parenthetical:
+            # IMG_1234(1).JPG is described by IMG_1234.JPG(1).json
+            candidates = [
+                (stem, None),
+                (None, f"{core_base}{parenthetical}{core_extension}"),
+                (f"{core_base}{parenthetical}", None),
+                (f"{core}{parenthetical}", None),
+            ]
+        else:
+            candidates = [
+                (None, core),        # IMG_1234.JPG.json
+                (core, None),        # IMG_1234.json
+                (core_base, None),
+            ]
+
+        for base_name, filename in candidates:
+            if base_name is not None and base_name in self.groups:
+                return [base_name]
+            if filename is not None and filename in self.group_by_filename:
+                return [self.group_by_filename[filename]]
+
+        if len(core) >= truncated_stem_length:
+            return self.resolve_truncated(core, parenthetical)
+        return []
+
+    def resolve_truncated(self, prefix, parenthetical):
+        # Every image name starting with prefix sits together in the sorted
+        # list, from where bisect finds the first one
+        matches = []
+        index = bisect.bisect_left(self.sorted_filenames, prefix)
+        while index < len(self.sorted_filenames) and self.sorted_filenames[index].startswith(prefix):
+            filename = self.sorted_filenames[index]
+            index += 1
+            # Copies only match the sidecar with the same (n)
+            image_parenthetical = split_parenthetical(os.path.splitext(filename)[0])[1]
+            if image_parenthetical != parenthetical:
+                continue
+            base_name = self.group_by_filename[filename]
+            if base_name not in matches:
+                matches.append(base_name)
+        return matches
+
+
+def match_sidecars(groups, json_files, ambiguous_matches=None):
+    """Set the 'json' of every group in groups that one of json_files describes.
+
+    Sidecars that fit more than one group, or a group that already has one,
+    are left out and added to ambiguous_matches (if given) as
+    {'json': ..., 'candidates': [...]}.
+    """
+    matcher = SidecarMatcher(groups)
+    for json_file in json_files:
+        candidates = matcher.resolve(json_file)
+        if len(candidates) == 1 and groups[candidates[0]]['json'] in (None, json_file):
+            groups[candidates[0]]['json'] = json_file
+        elif candidates and ambiguous_matches is not None:
+            ambiguous_matches.append({'json': json_file, 'candidates': candidates})
+
+    # Edited copies share the original's sidecar
+    for base_name, file_group in groups.items():
+        if file_group['json'] is None:
+            for suffix in edited_suffixes:
+                original = base_name[:-len(suffix)] if base_name.endswith(suffix) else None
+                if original in groups and groups[original]['json']:
+                    file_group['json'] = groups[original]['json']
+                    break
+    return groups
@@ -1,51 +1,971 @@
 #!/usr/bin/env python3
 
-from process_google_photos import create_matched_file_list
-
-def test_create_matched_file_list(test_cases):
-    for i, (file_list, expected_output) in enumerate(test_cases):
-        print(f"Test Case {i+1}:")
-        print("Input file list:", file_list)
-        actual_output = create_matched_file_list(file_list)
-        print("Expected output:", expected_output)
-        print("Actual output:", actual_output)
-        print("Test Passed:", expected_output == actual_output)
-        print("\n" + "-"*50 + "\n")
+import io
+import json
+import os
+import struct
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
 
-if __name__ == "__main__":
-    test_cases = [
-        
-        # without extension on sidecar
-        (
-            ['IMG_7309.HEIC', 'IMG_7309.json', 'IMG_7309.MP4'], 
-            {'IMG_7309': {'img': ['IMG_7309.HEIC', 'IMG_7309.MP4'], 'json': 'IMG_7309.json'}}
-        ),
+import async_pipeline
+import content_index as hashing
+import gpx_track_index
+import local_time
+import process_google_photos
+import run_state as stages
+from benchmark import jpeg_stub, sidecar_json, synthetic_groups
+from content_index import ContentIndex, find_duplicates
+from exif_reader import read_tags
+from exif_writer import write_jpeg_tags, written_output
+from exiftool_pool import ExifToolError, ExifToolPool
+from file_plan import FilePlan, undo
+from gpx_track_index import GpxTrackIndex, read_track_points
+from name_allocator import NameAllocator
+from run_state import RunState
+from takeout_archive import extract_chunks
+from rename_gpx import read_gpx_timestamp, rename_gpx_files
+from process_google_photos import create_matched_file_list, plan_unprocessable_groups, ready_watched_files, watch_sidecar_wait
+
+long_name = 'Screenshot_20190512-184412_Samsung Internet Browser'  # 51 characters
+
+# (description, input file list, expected output, expected ambiguous sidecars)
+test_cases = [
+
+    (
+        "without extension on sidecar",
+        ['IMG_7309.HEIC', 'IMG_7309.json', 'IMG_7309.MP4'],
+        {'IMG_7309': {'img': ['IMG_7309.HEIC', 'IMG_7309.MP4'], 'json': 'IMG_7309.json'}},
+        [],
+    ),
+
+    (
+        "Standard Live Photo",
+        ['IMG_7309.HEIC', 'IMG_7309.HEIC.json', 'IMG_7309.MP4'],
+        {'IMG_7309': {'img': ['IMG_7309.HEIC', 'IMG_7309.MP4'], 'json': 'IMG_7309.HEIC.json'}},
+        [],
+    ),
+
+    (
+        "(n) format",
+        ['IMG_1739.JPG', 'IMG_1739(1).JPG', 'IMG_1739.JPG.json', 'IMG_1739.JPG(1).json'],
+        {
+            'IMG_1739': {'img' :['IMG_1739.JPG'], 'json': 'IMG_1739.JPG.json'},
+            'IMG_1739(1)': {'img' :['IMG_1739(1).JPG'], 'json': 'IMG_1739.JPG(1).json'}
+        },
+        [],
+    ),
+
+    (
+        "One letter added to the end of one of the img files",
+        ['70759752381.HEIC', '70759752381.json', '70759752381C.MP4'],
+        {'70759752381': {'img': ['70759752381.HEIC', '70759752381C.MP4'], 'json': '70759752381.json'}},
+        [],
+    ),
+
+    (
+        "supplemental-metadata sidecar",
+        ['IMG_2001.JPG', 'IMG_2001.JPG.supplemental-metadata.json'],
+        {'IMG_2001': {'img': ['IMG_2001.JPG'], 'json': 'IMG_2001.JPG.supplemental-metadata.json'}},
+        [],
+    ),
+
+    (
+        "Truncated supplemental-metadata sidecar",
+        ['PXL_20230704_193015123.MP.jpg', 'PXL_20230704_193015123.MP.jpg.supplemental-me.json'],
+        {'PXL_20230704_193015123.MP': {'img': ['PXL_20230704_193015123.MP.jpg'],
+                                       'json': 'PXL_20230704_193015123.MP.jpg.supplemental-me.json'}},
+        [],
+    ),
+
+    (
+        "(n) format with supplemental-metadata",
+        ['IMG_2002.JPG', 'IMG_2002(1).JPG', 'IMG_2002.JPG.supplemental-metadata.json',
+         'IMG_2002.JPG.supplemental-metadata(1).json'],
+        {
+            'IMG_2002': {'img': ['IMG_2002.JPG'], 'json': 'IMG_2002.JPG.supplemental-metadata.json'},
+            'IMG_2002(1)': {'img': ['IMG_2002(1).JPG'], 'json': 'IMG_2002.JPG.supplemental-metadata(1).json'}
+        },
+        [],
+    ),
+
+    (
+        "Sidecar name truncated to 46 characters",
+        [long_name + '.jpg', long_name[:46] + '.json'],
+        {long_name: {'img': [long_name + '.jpg'], 'json': long_name[:46] + '.json'}},
+        [],
+    ),
+
+    (
+        "Sidecar name truncated to 47 characters, with (n)",
+        [long_name + '.jpg', long_name + '(1).jpg', long_name[:47] + '.json', long_name[:47] + '(1).json'],
+        {
+            long_name: {'img': [long_name + '.jpg'], 'json': long_name[:47] + '.json'},
+            long_name + '(1)': {'img': [long_name + '(1).jpg'], 'json': long_name[:47] + '(1).json'}
+        },
+        [],
+    ),
+
+    (
+        "-edited copy uses the original's sidecar",
+        ['IMG_3001.JPG', 'IMG_3001-edited.JPG', 'IMG_3001.JPG.json'],
+        {
+            'IMG_3001': {'img': ['IMG_3001.JPG'], 'json': 'IMG_3001.JPG.json'},
+            'IMG_3001-edited': {'img': ['IMG_3001-edited.JPG'], 'json': 'IMG_3001.JPG.json'}
+        },
+        [],
+    ),
+
+    (
+        "Truncated sidecar fitting two images is ambiguous",
+        [long_name + ' A.jpg', long_name + ' B.jpg', long_name[:46] + '.json'],
+        {
+            long_name + ' A': {'img': [long_name + ' A.jpg'], 'json': None},
+            long_name + ' B': {'img': [long_name + ' B.jpg'], 'json': None}
+        },
+        [{'json': long_name[:46] + '.json', 'candidates': [long_name + ' A', long_name + ' B']}],
+    ),
+
+    (
+        "Short sidecar names are never prefix matched",
+        ['IMG_4001.JPG', 'IMG_40.json'],
+        {'IMG_4001': {'img': ['IMG_4001.JPG'], 'json': None}},
+        [],
+    ),
+
+    (
+        "System files are skipped",
+        ['.DS_Store', 'IMG_5001.PNG', 'IMG_5001.PNG.json'],
+        {'IMG_5001': {'img': ['IMG_5001.PNG'], 'json': 'IMG_5001.PNG.json'}},
+        [],
+    ),
+
+]
+
+def test_create_matched_file_list():
+    failures = []
+    for i, (description, file_list, expected_output, expected_ambiguous) in enumerate(test_cases):
+        ambiguous_matches = []
+        actual_output = create_matched_file_list(file_list, ambiguous_matches)
+        passed = expected_output == actual_output and expected_ambiguous == ambiguous_matches
+        if __name__ == "__main__":
+            print(f"Test Case {i+1}: {description}")
+            print("Input file list:", file_list)
+            print("Expected output:", expected_output)
+            print("Actual output:", actual_output)
+            if expected_ambiguous or ambiguous_matches:
+                print("Expected ambiguous:", expected_ambiguous)
+                print("Actual ambiguous:", ambiguous_matches)
+            print("Test Passed:", passed)
+            print("\n" + "-"*50 + "\n")
+        if not passed:
+            failures.append(description)
+    assert not failures, failures
+
+def test_benchmark_takeout_matches():
+    # Every image of benchmark.py's trees should find the sidecar it was generated with
+    groups = synthetic_groups(3000)
+    file_list = sorted({name for group in groups for name in group['images'] + [group['sidecar']] if name})
+    matched_files = create_matched_file_list(file_list)
+    matched_sidecars = {img_file: file_group['json'] for file_group in matched_files.values() for img_file in file_group['img']}
+    mismatches = [(image, group['sidecar'], matched_sidecars.get(image))
+                  for group in groups for image in group['images'] if matched_sidecars.get(image) != group['sidecar']]
+    assert not mismatches, mismatches[:10]
+
+def test_unprocessable_files_keep_their_folders():
+    # The same name in two album folders must not end up as one file in an error folder
+    matched_files = {'A/IMG_0001': {'img': ['A/IMG_0001.JPG'], 'json': None},
+                     'B/IMG_0001': {'img': ['B/IMG_0001.JPG'], 'json': None},
+                     'C/IMG_0001': {'img': ['C/IMG_0001.JPG'], 'json': None}}
+    plan = FilePlan()
+    name_allocator = NameAllocator()
+    name_allocator.allocate(os.path.join('/nonexistent', 'error-missing-sidecar', 'C'), 'IMG_0001', '.JPG')
+    plan_unprocessable_groups(plan, '/takeout', matched_files, '/nonexistent', name_allocator)
+    targets = [os.path.relpath(operation['target'], '/nonexistent') for operation in plan.operations]
+    assert targets == ['error-missing-sidecar/A/IMG_0001.JPG', 'error-missing-sidecar/B/IMG_0001.JPG',
+                       'error-missing-sidecar/C/IMG_0001_1.JPG'], targets
+
+def test_ready_watched_files():
+    # Groups wait for their sidecar, and groups already tried wait until a file of theirs changes
+    listing = {'IMG_0001.JPG': (1, 1), 'IMG_0001.JPG.json': (1, 1), 'IMG_0002.HEIC': (1, 1), 'IMG_0003.JPG': (1, 1), 'IMG_0003.JPG.json': (1, 1)}
+    first_seen = {name: 0 for name in listing}
+    attempted = {'IMG_0003.JPG': (1, 1), 'IMG_0003.JPG.json': (1, 1)}
+    assert ready_watched_files(listing, first_seen, attempted, 1) == (['IMG_0001.JPG', 'IMG_0001.JPG.json'], True)
+    assert ready_watched_files(listing, first_seen, attempted, watch_sidecar_wait) == (['IMG_0001.JPG', 'IMG_0001.JPG.json', 'IMG_0002.HEIC'], False)
+    listing['IMG_0003.JPG'] = (2, 2)
+    assert 'IMG_0003.JPG' in ready_watched_files(listing, first_seen, attempted, 1)[0]
+
+def tiff_block(ifd0, gps=None, exif=None):
+    # Big-endian TIFF with IFD0 and optional GPS and Exif IFDs, each {tag: (type, count, value bytes)}
+    block = bytearray(b'MM\x00\x2a\x00\x00\x00\x00')
+
+    def write_ifd(entries):
+        offset = len(block)
+        values = bytearray()
+        values_start = offset + 2 + 12 * len(entries) + 4
+        table = bytearray(struct.pack('>H', len(entries)))
+        for tag in sorted(entries):
+            field_type, count, value = entries[tag]
+            if len(value) <= 4:
+                field = value.ljust(4, b'\x00')
+            else:
+                field = struct.pack('>I', values_start + len(values))
+                values += value + b'\x00' * (len(value) % 2)
+            table += struct.pack('>HHI', tag, field_type, count) + field
+        block.extend(table + b'\x00\x00\x00\x00' + values)
+        return offset
+
+    ifd0 = dict(ifd0)
+    if gps:
+        ifd0[0x8825] = (4, 1, struct.pack('>I', write_ifd(gps)))
+    if exif:
+        ifd0[0x8769] = (4, 1, struct.pack('>I', write_ifd(exif)))
+    block[4:8] = struct.pack('>I', write_ifd(ifd0))
+    return bytes(block)
+
+def jpeg_file(directory, name, segments=()):
+    # SOI, JFIF, the given (marker, payload) segments, then a scan that must come through unchanged
+    data = bytearray(b'\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00')
+    for marker, payload in segments:
+        data += bytes([0xFF, marker]) + struct.pack('>H', len(payload) + 2) + payload
+    data += b'\xff\xda\x00\x08\x01\x01\x00\x00\x3f\x00' + bytes(range(256)) + b'\xff\xd9'
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+def test_exif_writer_gps_round_trip():
+    # All four hemispheres, written into a JPEG without Exif and read back
+    scan = b'\xff\xda\x00\x08\x01\x01\x00\x00\x3f\x00' + bytes(range(256)) + b'\xff\xd9'
+    with tempfile.TemporaryDirectory() as directory:
+        for latitude, longitude in [(48.8584, 2.2945), (-33.8568, 151.2153), (40.6892, -74.0445), (-22.9519, -43.2105)]:
+            path = jpeg_file(directory, 'gps.jpg')
+            assert write_jpeg_tags(path, [f"-GPSLatitude={latitude}", f"-GPSLongitude={longitude}"]) == (True, written_output)
+            tags = read_tags(path)
+            assert abs(tags['GPSLatitude'] - latitude) < 1e-6 and abs(tags['GPSLongitude'] - longitude) < 1e-6, (latitude, longitude, tags)
+            with open(path, 'rb') as f:
+                assert f.read().endswith(scan)
+
+def test_exif_writer_keeps_existing_exif():
+    # An existing GPS IFD is updated in place of its old position, IFD0 and other GPS tags stay
+    tiff = tiff_block({0x010F: (2, 6, b'Canon\x00'), 0x0132: (2, 20, b'2020:01:02 03:04:05\x00')},
+                      {0x0001: (2, 2, b'N\x00'), 0x0002: (5, 3, struct.pack('>6I', 1, 1, 0, 1, 0, 1)),
+                       0x0003: (2, 2, b'E\x00'), 0x0004: (5, 3, struct.pack('>6I', 2, 1, 0, 1, 0, 1)),
+                       0x0005: (1, 1, b'\x00'), 0x0006: (5, 1, struct.pack('>2I', 100, 1))})
+    with tempfile.TemporaryDirectory() as directory:
+        path = jpeg_file(directory, 'exif.jpg', [(0xE1, b'Exif\x00\x00' + tiff)])
+        assert read_tags(path)['GPSLatitude'] == 1.0
+        description = 'Tom & "Jerry" <3'
+        assert write_jpeg_tags(path, ['-Description=' + description, '-GPSLatitude=-12.5', '-GPSLongitude=-45.25']) == (True, written_output)
+        tags = read_tags(path)
+        assert tags['GPSLatitude'] == -12.5 and tags['GPSLongitude'] == -45.25, tags
+        assert tags['ModifyDate'] == '2020:01:02 03:04:05' and tags['GPSAltitude'] == 100.0, tags
+        assert tags['Description'] == description, tags
+        with open(path, 'rb') as f:
+            assert b'&quot;Jerry&quot;' in f.read()
+
+def test_exif_writer_leaves_xmp_and_iptc_to_exiftool():
+    # Merging into XMP or IPTC is exiftool's job, the file must come back untouched
+    xmp = b'http://ns.adobe.com/xap/1.0/\x00' + (b"<x:xmpmeta xmlns:x='adobe:ns:meta/'><rdf:RDF xmlns:rdf='http://www.w3.org/1999/02/22-rdf-syntax-ns#'>"
+                                              b"<rdf:Description rdf:about=''/></rdf:RDF></x:xmpmeta>")
+    iptc = b'Photoshop 3.0\x008BIM\x04\x04\x00\x00\x00\x00\x00\x00'
+    with tempfile.TemporaryDirectory() as directory:
+        for name, segments, tag_args in [('xmp.jpg', [(0xE1, xmp)], ['-Description=x']),
+                                         ('iptc.jpg', [(0xED, iptc)], ['-GPSLatitude=1', '-GPSLongitude=2']),
+                                         ('unknown-tag.jpg', [], ['-Title=x'])]:
+            path = jpeg_file(directory, name, segments)
+            with open(path, 'rb') as f:
+                before = f.read()
+            assert write_jpeg_tags(path, tag_args) is None, name
+            with open(path, 'rb') as f:
+                assert f.read() == before, name
+
+def heif_file(directory, name, exif_tiff, xmp):
+    # ftyp, a meta box whose iinf/iloc point at an Exif and an XMP item, and the items in mdat
+    def box(box_type, payload, version=None):
+        if version is not None:
+            payload = bytes([version, 0, 0, 0]) + payload
+        return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+    exif_item = struct.pack('>I', 6) + b'Exif\x00\x00' + exif_tiff
+    infos = box(b'infe', struct.pack('>HH4s', 1, 0, b'Exif') + b'\x00', 2)
+    infos += box(b'infe', struct.pack('>HH4s', 2, 0, b'mime') + b'\x00application/rdf+xml\x00', 2)
+
+    def meta(mdat_start):
+        locations = struct.pack('>BBH', 0x44, 0x00, 2)
+        locations += struct.pack('>HHHII', 1, 0, 1, mdat_start, len(exif_item))
+        locations += struct.pack('>HHHII', 2, 0, 1, mdat_start + len(exif_item), len(xmp))
+        return box(b'meta', box(b'hdlr', b'\x00' * 4 + b'pict' + b'\x00' * 13, 0)
+                   + box(b'iinf', struct.pack('>H', 2) + infos, 0) + box(b'iloc', locations, 0), 0)
+
+    ftyp = box(b'ftyp', b'heic' + b'\x00\x00\x00\x00' + b'mif1heic')
+    mdat_start = len(ftyp) + len(meta(0)) + 8
+    data = ftyp + meta(mdat_start) + box(b'mdat', exif_item + xmp)
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+def test_exif_reader_jpeg_and_heif():
+    # Dates from IFD0 and the Exif IFD, GPS, and the XMP description, the way exiftool -n reports them
+    tiff = tiff_block({0x0132: (2, 20, b'2021:05:06 07:08:09\x00')},
+                      {0x0001: (2, 2, b'S\x00'), 0x0002: (5, 3, struct.pack('>6I', 33, 1, 30, 1, 0, 1)),
+                       0x0003: (2, 2, b'W\x00'), 0x0004: (5, 3, struct.pack('>6I', 70, 1, 15, 1, 0, 1))},
+                      {0x9003: (2, 20, b'2021:05:06 01:02:03\x00')})
+    xmp = (b"<x:xmpmeta xmlns:x='adobe:ns:meta/'><rdf:RDF xmlns:rdf='http://www.w3.org/1999/02/22-rdf-syntax-ns#'>"
+           b"<rdf:Description rdf:about='' xmlns:dc='http://purl.org/dc/elements/1.1/'"
+           b" xmlns:photoshop='http://ns.adobe.com/photoshop/1.0/' photoshop:DateCreated='2021-05-06T01:02:03'>"
+           b"<dc:description><rdf:Alt><rdf:li xml:lang='x-default'>Harbour</rdf:li></rdf:Alt></dc:description>"
+           b"</rdf:Description></rdf:RDF></x:xmpmeta>")
+    expected = {'DateTimeOriginal': '2021:05:06 01:02:03', 'ModifyDate': '2021:05:06 07:08:09', 'DateCreated': '2021:05:06 01:02:03',
+                'Description': 'Harbour', 'GPSLatitude': -33.5, 'GPSLongitude': -70.25}
+    with tempfile.TemporaryDirectory() as directory:
+        paths = [jpeg_file(directory, 'photo.jpg', [(0xE1, b'Exif\x00\x00' + tiff), (0xE1, b'http://ns.adobe.com/xap/1.0/\x00' + xmp)]),
+                 heif_file(directory, 'photo.heic', tiff, xmp)]
+        for path in paths:
+            tags = read_tags(path)
+            assert tags == dict(expected, SourceFile=path), tags
+
+def test_exif_reader_rejects_broken_files():
+    # Anything the reader can't fully understand is None (left to exiftool), never an exception
+    with tempfile.TemporaryDirectory() as directory:
+        jpeg = jpeg_file(directory, 'photo.jpg', [(0xE1, b'Exif\x00\x00' + tiff_block({0x0132: (2, 20, b'2021:05:06 07:08:09\x00')}))])
+        heif = heif_file(directory, 'photo.heic', tiff_block({}), b"<x:xmpmeta xmlns:x='adobe:ns:meta/'/>")
+        with open(jpeg, 'rb') as f:
+            jpeg_data = f.read()
+        with open(heif, 'rb') as f:
+            heif_data = f.read()
+        broken = {'empty.jpg': b'', 'garbage.jpg': bytes(range(256)) * 4, 'truncated.jpg': jpeg_data[:40],
+                  'no-scan.jpg': jpeg_data[:jpeg_data.index(b'\xff\xda')], 'truncated.heic': heif_data[:60],
+                  'bad-box.heic': heif_data[:24] + b'\xff\xff\xff\xff' + heif_data[28:],
+                  'other-brand.mp4': heif_data.replace(b'heic', b'isom').replace(b'mif1', b'mp41')}
+        for name, data in broken.items():
+            path = os.path.join(directory, name)
+            with open(path, 'wb') as f:
+                f.write(data)
+            assert read_tags(path) is None, name
+        assert read_tags(os.path.join(directory, 'missing.jpg')) is None
+
+def test_archive_members_stay_inside_the_output():
+    # Zip-slip: members named to leave the output directory are skipped, the rest is extracted
+    hostile_names = ['../../escaped/BAD_1.JPG.json', '/tmp/absolute/BAD_2.JPG', 'C:/Windows/BAD_3.JPG',
+                     'Takeout/Google Photos/../../../BAD_4.JPG', '..\\..\\BAD_5.JPG']
+    safe_names = ['Takeout/Google Photos/Album/IMG_0001.JPG', 'Takeout/Google Photos/Album/IMG_0001.JPG.json']
+    with tempfile.TemporaryDirectory() as directory:
+        output = os.path.join(directory, 'a', 'b', 'output')
+        os.makedirs(output)
+        with zipfile.ZipFile(os.path.join(directory, 'takeout-001.zip'), 'w') as archive:
+            for name in hostile_names + safe_names:
+                archive.writestr(name, b'data')
+        with tarfile.open(os.path.join(directory, 'takeout-002.tgz'), 'w:gz') as archive:
+            for name in hostile_names + [name.replace('IMG_0001', 'IMG_0002') for name in safe_names]:
+                info = tarfile.TarInfo(name)
+                info.size = 4
+                archive.addfile(info, io.BytesIO(b'data'))
+
+        staging = os.path.join(output, '.takeout-staging')
+        extracted = []
+        for chunk_directory, files, folder in extract_chunks([os.path.join(directory, 'takeout-001.zip'), os.path.join(directory, 'takeout-002.tgz')],
+                                                              staging, create_matched_file_list):
+            extracted += [folder + '/' + f for f in sorted(files)]
+            assert os.path.dirname(chunk_directory) == staging
+        assert extracted == safe_names + [name.replace('IMG_0001', 'IMG_0002') for name in safe_names], extracted
+        written = [os.path.join(root, f) for root, dirs, files in os.walk(directory) for f in files]
+        assert all(path.startswith(output + os.sep) or path.startswith(os.path.join(directory, 'takeout-')) for path in written), written
+
+def takeout_fixture(directory, count):
+    # JPEGs with a sidecar each, an hour apart, which the native reader and writer handle without exiftool
+    for i in range(count):
+        name = f'IMG_{i:04d}.jpg'
+        with open(os.path.join(directory, name), 'wb') as file:
+            file.write(jpeg_stub(1000, None, name))
+        with open(os.path.join(directory, name + '.json'), 'w') as file:
+            json.dump(sidecar_json(name, 1600000000 + i * 3600, (48.1, 11.5)), file)
 
+class Interrupted(Exception):
+    pass
 
-        # Standard Live Photo
-        (
-            ['IMG_7309.HEIC', 'IMG_7309.HEIC.json', 'IMG_7309.MP4'], 
-            {'IMG_7309': {'img': ['IMG_7309.HEIC', 'IMG_7309.MP4'], 'json': 'IMG_7309.HEIC.json'}}
-        ),
+def test_resume_after_interrupted_writes():
+    # A run stopped while writing keeps the files it already wrote, a rerun only writes the rest
+    written = []
+    def stop_after_four(file_path, tag_args):
+        if len(written) == 4:
+            raise Interrupted()
+        written.append(os.path.basename(file_path))
+        return write_jpeg_tags(file_path, tag_args)
 
+    saved = (process_google_photos.native_writers[:], process_google_photos.write_batch_size, os.environ.get('FILE_PROCESSING_CACHE'))
+    os.environ['FILE_PROCESSING_CACHE'] = 'off'
+    process_google_photos.write_batch_size = 2
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            takeout_fixture(directory, 6)
+            process_google_photos.native_writers[:] = [stop_after_four]
+            try:
+                process_google_photos.process_directory(directory, 60)
+                assert False, "the run wasn't interrupted"
+            except Interrupted:
+                pass
 
-        # (n) format
-        (
-            ['IMG_1739.JPG', 'IMG_1739(1).JPG', 'IMG_1739.JPG.json', 'IMG_1739.JPG(1).json'],
-            {
-                'IMG_1739': {'img' :['IMG_1739.JPG'], 'json': 'IMG_1739.JPG.json'},
-                'IMG_1739(1)': {'img' :['IMG_1739(1).JPG'], 'json': 'IMG_1739.JPG(1).json'}
-            }
-        ),
+            run_state = RunState(os.path.join(directory, process_google_photos.run_state_filename))
+            records = run_state.unfinished()
+            run_state.close()
+            assert sorted(os.path.basename(record['path']) for record in records if record['stage'] == stages.METADATA_WRITTEN) == sorted(written), records
 
-        # One letter added to the end of one of the img files
-        (
-            ['70759752381.HEIC', '70759752381.json', '70759752381C.MP4'], 
-            {'70759752381': {'img': ['70759752381.HEIC', '70759752381C.MP4'], 'json': '70759752381.json'}}
-        ),
+            written_before = written[:]
+            written.clear()
+            process_google_photos.native_writers[:] = [lambda file_path, tag_args: written.append(os.path.basename(file_path)) or write_jpeg_tags(file_path, tag_args)]
+            process_google_photos.process_directory(directory, 60)
+            assert not set(written) & set(written_before), written
+            assert len(os.listdir(os.path.join(directory, 'successfully-processed'))) == 6
+            assert len(os.listdir(os.path.join(directory, 'processed-sidecars'))) == 6
+            assert not [f for f in os.listdir(directory) if f.startswith('IMG_')]
+            # Nothing is left to resume, so the state is gone too
+            assert not os.path.exists(os.path.join(directory, process_google_photos.run_state_filename))
+    finally:
+        process_google_photos.native_writers[:], process_google_photos.write_batch_size, cache = saved
+        if cache is None:
+            os.environ.pop('FILE_PROCESSING_CACHE', None)
+        else:
+            os.environ['FILE_PROCESSING_CACHE'] = cache
 
+def test_undo_from_another_folder():
+    # A run given a relative path can still be undone from anywhere else
+    saved = (os.getcwd(), os.environ.get('FILE_PROCESSING_CACHE'))
+    os.environ['FILE_PROCESSING_CACHE'] = 'off'
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            os.makedirs(os.path.join(directory, 'takeout'))
+            takeout_fixture(os.path.join(directory, 'takeout'), 3)
+            before = sorted(os.listdir(os.path.join(directory, 'takeout')))
+            os.chdir(directory)
+            process_google_photos.process_directory('takeout', 60)
+            undo_log = [f for f in os.listdir('takeout') if f.startswith('undo_')][0]
 
+            os.chdir(tempfile.gettempdir())
+            assert undo(os.path.join(directory, 'takeout', undo_log)) == len(before)
+            assert sorted(f for f in os.listdir(os.path.join(directory, 'takeout')) if f.startswith('IMG_')) == before
+    finally:
+        os.chdir(saved[0])
+        if saved[1] is None:
+            os.environ.pop('FILE_PROCESSING_CACHE', None)
+        else:
+            os.environ['FILE_PROCESSING_CACHE'] = saved[1]
 
+def test_undo_removes_placed_copies():
+    # Outside move mode the Takeout stays as it was and undo only deletes the results
+    saved = (process_google_photos.output_mode, os.environ.get('FILE_PROCESSING_CACHE'))
+    os.environ['FILE_PROCESSING_CACHE'] = 'off'
+    try:
+        for mode in ('hardlink', 'copy'):
+            process_google_photos.output_mode = mode
+            with tempfile.TemporaryDirectory() as directory:
+                takeout_fixture(directory, 3)
+                before = sorted(os.listdir(directory))
+                process_google_photos.process_directory(directory, 60)
+                assert len(os.listdir(os.path.join(directory, 'successfully-processed'))) == 3
+                undo_log = [f for f in os.listdir(directory) if f.startswith('undo_')][0]
+
+                assert undo(os.path.join(directory, undo_log)) == 6
+                assert sorted(f for f in os.listdir(directory) if f.startswith('IMG_')) == before
+                assert not os.listdir(os.path.join(directory, 'successfully-processed'))
+                assert not os.listdir(os.path.join(directory, 'processed-sidecars'))
+                assert not os.path.exists(os.path.join(directory, process_google_photos.archive_staging_directory))
+    finally:
+        process_google_photos.output_mode = saved[0]
+        if saved[1] is None:
+            os.environ.pop('FILE_PROCESSING_CACHE', None)
+        else:
+            os.environ['FILE_PROCESSING_CACHE'] = saved[1]
+
+def output_tree(directory):
+    # Every result file and the report, with the run's own names and paths taken out
+    files = sorted(os.path.relpath(os.path.join(root, f), directory) for root, dirs, names in os.walk(directory) for f in names
+                   if not f.startswith(('report_', 'metrics_', 'undo_')))
+    report_path = [f for f in os.listdir(directory) if f.startswith('report_') and f.endswith('.json')][0]
+    with open(os.path.join(directory, report_path)) as report_file:
+        report = json.loads(report_file.read().replace(directory, '<directory>'))
+    del report['run-datetime']
+    return files, report
+
+def test_async_pipeline_matches_a_normal_run():
+    # Same names, folders and report for a tree with clashing dates, a broken file and one without a sidecar
+    saved = (process_google_photos.write_batch_size, async_pipeline.pipeline_batch_size, os.environ.get('FILE_PROCESSING_CACHE'))
+    os.environ['FILE_PROCESSING_CACHE'] = 'off'
+    process_google_photos.write_batch_size = 2
+    async_pipeline.pipeline_batch_size = 2
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            results = []
+            for run in (process_google_photos.process_directory, async_pipeline.process_directory_async):
+                takeout = os.path.join(directory, run.__name__)
+                os.makedirs(takeout)
+                takeout_fixture(takeout, 6)
+                for name in ('IMG_0100.jpg', 'IMG_0101.jpg', 'IMG_0102.jpg'):
+                    with open(os.path.join(takeout, name), 'wb') as file:
+                        file.write(jpeg_stub(1000, None, name) if name != 'IMG_0102.jpg' else b'not a jpeg')
+                    with open(os.path.join(takeout, name + '.json'), 'w') as file:
+                        json.dump(sidecar_json(name, 1600000000, (48.1, 11.5)), file)
+                with open(os.path.join(takeout, 'IMG_0200.jpg'), 'wb') as file:
+                    file.write(jpeg_stub(1000, None, 'IMG_0200.jpg'))
+                run(takeout, 60)
+                results.append(output_tree(takeout))
+
+            (files, report), (async_files, async_report) = results
+            assert files == async_files, (files, async_files)
+            assert report == async_report
+            assert len([f for f in files if f.startswith('successfully-processed')]) == 8
+    finally:
+        process_google_photos.write_batch_size, async_pipeline.pipeline_batch_size, cache = saved
+        if cache is None:
+            os.environ.pop('FILE_PROCESSING_CACHE', None)
+        else:
+            os.environ['FILE_PROCESSING_CACHE'] = cache
+
+def test_find_duplicates_hashes_only_what_it_has_to():
+    # Sizes first, then the first and last 64 KB, and a full hash only for files still alike
+    big = hashing.hash_chunk_size * 3
+    contents = {
+        'alone.jpg': b'a' * 10,
+        'same-size-1.jpg': b'b' * 20,
+        'same-size-2.jpg': b'c' * 20,
+        'same-ends-1.jpg': b'd' * hashing.hash_chunk_size + b'1' * hashing.hash_chunk_size + b'd' * hashing.hash_chunk_size,
+        'same-ends-2.jpg': b'd' * hashing.hash_chunk_size + b'2' * hashing.hash_chunk_size + b'd' * hashing.hash_chunk_size,
+        'copy.jpg': b'e' * big,
+        'copy-of-copy.jpg': b'e' * big,
+    }
+    hashed = {'head_tail_hash': [], 'full_hash': []}
+    def counted(function):
+        def wrapper(file_path):
+            hashed[function.__name__].append(os.path.basename(file_path))
+            return function(file_path)
+        return wrapper
+
+    saved = (hashing.head_tail_hash, hashing.full_hash)
+    hashing.head_tail_hash, hashing.full_hash = counted(saved[0]), counted(saved[1])
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for name, data in contents.items():
+                with open(os.path.join(directory, name), 'wb') as file:
+                    file.write(data)
+            duplicates, hashes = find_duplicates([os.path.join(directory, name) for name in contents], workers=2)
+    finally:
+        hashing.head_tail_hash, hashing.full_hash = saved
+
+    assert duplicates == {os.path.join(directory, 'copy-of-copy.jpg'): os.path.join(directory, 'copy.jpg')}, duplicates
+    assert hashes == {}
+    assert sorted(hashed['head_tail_hash']) == sorted(set(contents) - {'alone.jpg'}), hashed
+    assert sorted(hashed['full_hash']) == ['copy-of-copy.jpg', 'copy.jpg', 'same-ends-1.jpg', 'same-ends-2.jpg'], hashed
+
+def test_find_duplicates_in_the_library_index():
+    # A later copy matches the original bytes of a library file, even after its metadata was written
+    with tempfile.TemporaryDirectory() as directory:
+        library = os.path.join(directory, 'successfully-processed')
+        os.makedirs(library)
+        takeout = os.path.join(directory, 'takeout')
+        os.makedirs(takeout)
+        original = os.path.join(takeout, 'IMG_0001.jpg')
+        with open(original, 'wb') as file:
+            file.write(jpeg_stub(1000, None, 'IMG_0001'))
+
+        index = ContentIndex.for_library(library)
+        try:
+            duplicates, hashes = find_duplicates([original], index)
+            assert duplicates == {} and set(hashes) == {original}
+            index.remember(original, hashes[original])
+            library_path = os.path.join(library, '2020-09-13_14-26-40.jpg')
+            os.rename(original, library_path)
+            index.record_moves([(original, library_path)])
+            assert index.final_paths == {original: library_path}
+            with open(library_path, 'ab') as file:
+                file.write(b'written metadata')
+
+            copies = [os.path.join(takeout, 'IMG_0001(1).jpg'), os.path.join(takeout, 'IMG_0002.jpg')]
+            with open(copies[0], 'wb') as file:
+                file.write(jpeg_stub(1000, None, 'IMG_0001'))
+            with open(copies[1], 'wb') as file:
+                file.write(jpeg_stub(1000, None, 'IMG_0002'))
+            duplicates, hashes = find_duplicates(copies, index)
+            assert duplicates == {copies[0]: library_path}, duplicates
+            assert set(hashes) == {copies[1]}
+        finally:
+            index.close()
+
+def test_duplicates_report_where_the_original_went():
+    saved = (process_google_photos.dedup_mode, os.environ.get('FILE_PROCESSING_CACHE'))
+    os.environ['FILE_PROCESSING_CACHE'] = 'off'
+    process_google_photos.dedup_mode = 'skip'
+    try:
+        for run in (process_google_photos.process_directory, async_pipeline.process_directory_async):
+            with tempfile.TemporaryDirectory() as directory:
+                takeout_fixture(directory, 2)
+                with open(os.path.join(directory, 'IMG_0000(1).jpg'), 'wb') as file:
+                    file.write(jpeg_stub(1000, None, 'IMG_0000.jpg'))
+                with open(os.path.join(directory, 'IMG_0000.jpg(1).json'), 'w') as file:
+                    json.dump(sidecar_json('IMG_0000(1).jpg', 1600000000, (48.1, 11.5)), file)
+                run(directory, 60)
+
+                files, report = output_tree(directory)
+                assert 'duplicates/IMG_0000(1).jpg' in files, files
+                [duplicate] = report['duplicates']['filelist']
+                assert duplicate['duplicate-of'] == '<directory>/successfully-processed/2020-09-13_14-26-40.jpg', duplicate
+    finally:
+        process_google_photos.dedup_mode = saved[0]
+        if saved[1] is None:
+            os.environ.pop('FILE_PROCESSING_CACHE', None)
+        else:
+            os.environ['FILE_PROCESSING_CACHE'] = saved[1]
+
+def test_local_times_match_zoneinfo():
+    # Around DST gaps and overlaps, in zones with half hour offsets and in zones without any changes
+    def utc(*fields):
+        return int(datetime(*fields, tzinfo=timezone.utc).timestamp())
+    cases = [
+        ('Europe/Berlin', utc(2021, 3, 28, 1)),       # 02:00 local doesn't exist
+        ('Europe/Berlin', utc(2021, 10, 31, 1)),      # 02:00-03:00 local happens twice
+        ('America/New_York', utc(2021, 3, 14, 7)),
+        ('America/New_York', utc(2021, 11, 7, 6)),
+        ('Australia/Lord_Howe', utc(2021, 4, 3, 15)), # DST of half an hour
+        ('America/St_Johns', utc(2021, 11, 7, 3, 30)),
+        ('Asia/Kolkata', utc(2021, 6, 1)),            # +05:30, no changes for decades
+        ('UTC', utc(2021, 1, 1)),                     # no transitions at all
+        ('Pacific/Auckland', utc(2000, 12, 31, 23, 59, 59)),
     ]
+    epochs, zone_names = [], []
+    for zone_name, when in cases:
+        for offset in (-3601, -1, 0, 1, 3600):
+            epochs.append(when + offset)
+            zone_names.append(zone_name)
+
+    expected = []
+    for when, zone_name in zip(epochs, zone_names):
+        local = datetime.fromtimestamp(when, ZoneInfo(zone_name))
+        offset = int(local.utcoffset().total_seconds())
+        expected.append((offset // 3600 if offset % 3600 == 0 else offset / 3600, bool(local.dst()), local.strftime('%Y-%m-%d_%H-%M-%S')))
+
+    saved = local_time.np
+    try:
+        for np in (saved, None):
+            # The transition tables are numpy arrays or lists, depending on which path built them
+            local_time.np = np
+            local_time.zone_transitions.cache_clear()
+            assert local_time.local_times(epochs, zone_names, '%Y-%m-%d_%H-%M-%S') == expected, np
+            assert local_time.local_times([], [], '%Y-%m-%d_%H-%M-%S') == []
+    finally:
+        local_time.np = saved
+        local_time.zone_transitions.cache_clear()
+
+fake_exiftool = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_exiftool.py')
+
+def test_exiftool_pool_batches():
+    # Every command of a batch gets its own output, split at its {readyN} marker, also across batches
+    with tempfile.TemporaryDirectory() as directory, ExifToolPool(size=1, timeout=10, executable=fake_exiftool) as pool:
+        image = os.path.join(directory, 'IMG_0001.jpg')
+        with open(image, 'wb') as file:
+            file.write(jpeg_stub(100))
+        for number in range(2):
+            results = pool.run_many([['-overwrite_original', f'-Description=round {number}', image],
+                                     ['-json', '-Description', image],
+                                     ['-json', '-Description', os.path.join(directory, 'missing.jpg')],
+                                     ['-json', '-Description', image]])
+            assert [result.returncode for result in results] == [0, 0, 1, 0], results
+            assert '1 image files updated' in results[0].stdout and not results[0].stderr
+            assert json.loads(results[1].stdout) == [{'SourceFile': image, 'Description': f'round {number}'}]
+            assert results[2].stdout == '' and 'File not found' in results[2].stderr
+            assert results[3].stdout == results[1].stdout
+        assert len(pool._workers) == 1
+
+def test_exiftool_pool_timeout_and_retry():
+    saved = os.environ.get('FAKE_EXIFTOOL_DELAY')
+    try:
+        with tempfile.TemporaryDirectory() as directory, ExifToolPool(size=1, timeout=10, executable=fake_exiftool) as pool:
+            image = os.path.join(directory, 'IMG_0001.jpg')
+            with open(image, 'wb') as file:
+                file.write(jpeg_stub(100))
 
-    test_create_matched_file_list(test_cases)
+            # A command that takes too long kills its worker, the next command gets a new one
+            os.environ['FAKE_EXIFTOOL_DELAY'] = '5'
+            start = time.monotonic()
+            try:
+                pool.run(['-json', image], timeout=0.5)
+                assert False, "no timeout"
+            except subprocess.TimeoutExpired:
+                pass
+            assert time.monotonic() - start < 3
+            [worker] = pool._workers
+            assert not worker.is_alive()
+            os.environ.pop('FAKE_EXIFTOOL_DELAY')
+            assert pool.run(['-json', image]).returncode == 0
+
+            # A worker that died while idle is started again
+            pid = worker.process.pid
+            worker.process.kill()
+            worker.process.wait()
+            assert pool.run(['-json', image]).returncode == 0
+            assert worker.process.pid != pid
+
+            # One that dies in the middle of a command has the command run again, unless retries is 0
+            os.environ['FAKE_EXIFTOOL_DELAY'] = '1'
+            for retries in (1, 0):
+                with ExifToolPool(size=1, timeout=10, executable=fake_exiftool, retries=retries) as pool:
+                    pool.warm()
+                    threading.Timer(0.3, pool._workers[0].process.kill).start()
+                    try:
+                        assert pool.run(['-json', image]).returncode == 0 and retries
+                    except ExifToolError:
+                        assert not retries
+    finally:
+        if saved is None:
+            os.environ.pop('FAKE_EXIFTOOL_DELAY', None)
+        else:
+            os.environ['FAKE_EXIFTOOL_DELAY'] = saved
+
+def test_exiftool_pool_close_and_resize():
+    saved = os.environ.get('FAKE_EXIFTOOL_DELAY')
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            # Workers read the delay when they start
+            os.environ['FAKE_EXIFTOOL_DELAY'] = '30'
+            pool = ExifToolPool(size=3, timeout=30, executable=fake_exiftool)
+            pool.warm()
+            processes = [worker.process for worker in pool._workers]
+            pool.resize(1)
+            assert len(pool._workers) == 1
+            assert sum(process.poll() is None for process in processes) == 1
+
+            # close() doesn't leave a worker that is still busy running
+            image = os.path.join(directory, 'IMG_0001.jpg')
+            with open(image, 'wb') as file:
+                file.write(jpeg_stub(100))
+            errors = []
+            def busy():
+                try:
+                    pool.run(['-json', image])
+                except Exception as e:
+                    errors.append(e)
+            thread = threading.Thread(target=busy)
+            thread.start()
+            time.sleep(0.5)
+            [worker] = pool._workers
+            start = time.monotonic()
+            pool.close(timeout=0.5)
+            thread.join(5)
+            assert not thread.is_alive() and time.monotonic() - start < 5
+            assert isinstance(errors[0], ExifToolError), errors
+            assert not worker.is_alive() and not pool._workers
+    finally:
+        if saved is None:
+            os.environ.pop('FAKE_EXIFTOOL_DELAY', None)
+        else:
+            os.environ['FAKE_EXIFTOOL_DELAY'] = saved
+
+def gpx_file(directory, name, segments, metadata_time=None, version='1.1'):
+    # segments are lists of (epoch, latitude, longitude), a None epoch writes a point without a time
+    def iso(when):
+        return datetime.fromtimestamp(when, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    lines = [f'<gpx xmlns="http://www.topografix.com/GPX/{version.replace(".", "/")}" version="{version}">']
+    if metadata_time is not None:
+        lines.append(f'<metadata><time>{iso(metadata_time)}</time></metadata>' if version == '1.1' else f'<time>{iso(metadata_time)}</time>')
+    lines.append('<trk><name>track</name>')
+    for segment in segments:
+        lines.append('<trkseg>')
+        for when, latitude, longitude in segment:
+            time_element = f'<time>{iso(when)}</time>' if when is not None else ''
+            lines.append(f'<trkpt lat="{latitude}" lon="{longitude}"><ele>500</ele>{time_element}</trkpt>')
+        lines.append('</trkseg>')
+    lines.append('</trk></gpx>')
+    with open(os.path.join(directory, name), 'w') as file:
+        file.write('\n'.join(lines))
+    return os.path.join(directory, name)
+
+def test_gpx_track_index():
+    # Interpolated between fixes, the nearest fix at the ends of a track and across gaps, None too far away
+    start = 1717228800  # 2024-06-01 08:00 UTC
+    with tempfile.TemporaryDirectory() as directory:
+        gpx_file(directory, 'morning.gpx', [
+            [(start, 47.0, 11.0), (start + 60, 47.001, 11.002), (None, 1.0, 1.0), (start + 120, 47.002, 11.004)],
+            # A second segment after a pause short enough to interpolate across
+            [(start + 720, 47.010, 11.010), (start + 780, 47.011, 11.011)],
+        ])
+        gpx_file(directory, 'afternoon.gpx', [[(start + 7200, 48.0, 12.0), (start + 7260, 48.001, 12.001)]], version='1.0')
+        with open(os.path.join(directory, 'broken.gpx'), 'w') as file:
+            file.write('<gpx><trk><trkseg><trkpt lat="1"')
+
+        cases = [
+            (start + 30, (47.0005, 11.001, 'morning.gpx')),
+            (start + 60, (47.001, 11.002, 'morning.gpx')),
+            (start + 420, (47.006, 11.007, 'morning.gpx')),         # across the two segments
+            (start - 600, (47.0, 11.0, 'morning.gpx')),             # before the first fix
+            (start - 1801, None),
+            (start + 780 + 1800, (47.011, 11.011, 'morning.gpx')),  # after the last fix of the track
+            (start + 2500, (47.011, 11.011, 'morning.gpx')),        # between the tracks, the nearest end
+            (start + 4000, None),
+            (start + 5500, (48.0, 12.0, 'afternoon.gpx')),
+            (start + 7260 + 1801, None),
+            (datetime.fromtimestamp(start + 7230, timezone.utc).replace(tzinfo=None), (48.0005, 12.0005, 'afternoon.gpx')),
+        ]
+        saved = gpx_track_index.np
+        try:
+            for np in (saved, None):
+                gpx_track_index.np = np
+                index = GpxTrackIndex.from_directory(directory)
+                assert len(index) == 7 and index.track_names == ['afternoon.gpx', 'broken.gpx', 'morning.gpx']
+                assert index.locate_many([when for when, expected in cases]) == [expected for when, expected in cases], np
+                assert index.locate(start + 30) == cases[0][1]
+        finally:
+            gpx_track_index.np = saved
+
+def test_gpx_readers():
+    # Both readers stream the file: track points without a time are skipped, the start time is read from the top
+    start = 1717228800
+    with tempfile.TemporaryDirectory() as directory:
+        track = gpx_file(directory, 'track.gpx', [[(start, 47.0, 11.0), (None, 1.0, 1.0), (start + 60, 47.5, 11.5)]])
+        times, latitudes, longitudes = read_track_points(track)
+        assert (list(times), list(latitudes), list(longitudes)) == ([start, start + 60], [47.0, 47.5], [11.0, 11.5])
+        assert read_gpx_timestamp(track) == '2024-06-01T08:00:00Z'
+        assert read_gpx_timestamp(gpx_file(directory, 'metadata.gpx', [[(start + 60, 1.0, 1.0)]], metadata_time=start)) == '2024-06-01T08:00:00Z'
+        assert read_gpx_timestamp(gpx_file(directory, 'old.gpx', [[(start + 60, 1.0, 1.0)]], metadata_time=start, version='1.0')) == '2024-06-01T08:00:00Z'
+        assert read_gpx_timestamp(gpx_file(directory, 'untimed.gpx', [[(None, 1.0, 1.0)]])) is None
+
+def test_rename_gpx_files():
+    start = 1717228800
+    saved = (os.getcwd(), os.environ.get('FILE_PROCESSING_CACHE'))
+    os.environ['FILE_PROCESSING_CACHE'] = 'off'
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            gpx_file(directory, 'a.gpx', [[(start, 1.0, 1.0)]])
+            gpx_file(directory, 'b.gpx', [[(start, 1.0, 1.0)]], metadata_time=start)
+            gpx_file(directory, 'untimed.gpx', [[(None, 1.0, 1.0)]])
+            open(os.path.join(directory, 'empty.gpx'), 'w').close()
+            rename_gpx_files(directory, 'hike', workers=2)
+            assert sorted(os.listdir(directory)) == ['2024-06-01_08-00-00Z_hike.gpx', '2024-06-01_08-00-00Z_hike_1.gpx', 'empty.gpx', 'untimed.gpx']
+    finally:
+        os.chdir(saved[0])
+        if saved[1] is None:
+            os.environ.pop('FILE_PROCESSING_CACHE', None)
+        else:
+            os.environ['FILE_PROCESSING_CACHE'] = saved[1]
+
+def test_report_from_journal():
+    # The report is rebuilt from the journal with every section, live photo groups included,
+    # and the half line a killed run leaves at the end of the journal is ignored
+    saved = os.environ.get('FILE_PROCESSING_CACHE')
+    os.environ['FILE_PROCESSING_CACHE'] = 'off'
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            takeout_fixture(directory, 3)
+            for name in ('IMG_0300.jpg', 'IMG_0300.jpeg', 'IMG_0301.jpg', 'IMG_0302.jpg'):
+                with open(os.path.join(directory, name), 'wb') as file:
+                    file.write(jpeg_stub(1000, None, name) if name != 'IMG_0302.jpg' else b'not a jpeg')
+            for name in ('IMG_0300', 'IMG_0302.jpg'):
+                with open(os.path.join(directory, name + '.json'), 'w') as file:
+                    json.dump(sidecar_json(name, 1600100000, (48.1, 11.5)), file)
+            process_google_photos.process_directory(directory, 60)
+
+            journal_path = [os.path.join(directory, f) for f in os.listdir(directory) if f.startswith('report_') and f.endswith('.jsonl')][0]
+            with open(os.path.splitext(journal_path)[0] + '.json') as report_file:
+                report = json.load(report_file)
+
+            # The same report built the simple way, everything in memory
+            expected = {section: {'total': 0, 'filelist': []} for section in ('error-missing-sidecars', 'error-processing', 'error-renaming')}
+            expected['modifications'] = {}
+            with open(journal_path) as journal_file:
+                for line in journal_file:
+                    event = json.loads(line)
+                    if event['section'] != 'modifications':
+                        expected[event['section']]['total'] += 1
+                        expected[event['section']]['filelist'].append(event['entry'])
+                    elif 'group' in event:
+                        expected['modifications'].setdefault(event['extension'], {}).setdefault(event['group'], []).append(event['entry'])
+                    else:
+                        expected['modifications'].setdefault(event['extension'], []).append(event['entry'])
+            del report['run-datetime']
+            assert report == expected, report
+
+            assert [os.path.basename(path) for path in report['error-missing-sidecars']['filelist']] == ['IMG_0301.jpg'], report['error-missing-sidecars']
+            assert [entry['filename'] for entry in report['error-processing']['filelist']] == ['IMG_0302.jpg']
+            assert sorted(entry['filename'] for entry in report['modifications']['LIVE']['IMG_0300']) == ['IMG_0300.jpeg', 'IMG_0300.jpg']
+            assert len(report['modifications']['JPG']) == 3
+
+            with open(journal_path, 'a') as journal_file:
+                journal_file.write('{"section": "modifications", "entry": {"filename": "IMG_9')
+            rebuilt_path = process_google_photos.write_report_from_journal(journal_path, os.path.join(directory, 'rebuilt.json'))
+            with open(rebuilt_path) as report_file:
+                rebuilt = json.load(report_file)
+            del rebuilt['run-datetime']
+            assert rebuilt == report
+    finally:
+        if saved is None:
+            os.environ.pop('FILE_PROCESSING_CACHE', None)
+        else:
+            os.environ['FILE_PROCESSING_CACHE'] = saved
+
+def synthetic_takeout_listing(count):
+    # Roughly the mix of a real Takeout folder: live photos, copies,
+    # supplemental-metadata sidecars and truncated long names
+    file_list = []
+    i = 0
+    while len(file_list) < count:
+        name = f"IMG_{i:07d}"
+        if i % 4 == 0:
+            file_list += [f"{name}.HEIC", f"{name}.MP4", f"{name}.HEIC.json"]
+        elif i % 4 == 1:
+            file_list += [f"{name}(1).JPG", f"{name}.JPG(1).json"]
+        elif i % 4 == 2:
+            file_list += [f"{name}.JPG", f"{name}.JPG.supplemental-metadata.json"]
+        else:
+            long_file = f"Screenshot_{i:07d}_Samsung Internet Browser Long Name"
+            file_list += [f"{long_file}.jpg", f"{long_file[:46]}.json"]
+        i += 1
+    return file_list[:count]
+
+def benchmark_create_matched_file_list(sizes=(10000, 100000, 1000000)):
+    previous = None
+    for size in sizes:
+        file_list = synthetic_takeout_listing(size)
+        start = time.perf_counter()
+        matched_files = create_matched_file_list(file_list)
+        elapsed = time.perf_counter() - start
+        matched = sum(1 for file_group in matched_files.values() if file_group['json'])
+        line = f"{len(file_list):>9} names: {elapsed:.2f}s, {len(matched_files)} groups, {matched} with a sidecar"
+        if previous:
+            # Near-linear matching keeps this close to the size ratio
+            line += f", {elapsed / previous[1]:.1f}x the time for {len(file_list) / previous[0]:.0f}x the names"
+        print(line)
+        previous = (len(file_list), elapsed)
+
+if __name__ == "__main__":
+    if '--benchmark' in sys.argv:
+        benchmark_create_matched_file_list()
+    else:
+        test_create_matched_file_list()
+        test_benchmark_takeout_matches()
+        test_unprocessable_files_keep_their_folders()
+        test_ready_watched_files()
+        test_exif_writer_gps_round_trip()
+        test_exif_writer_keeps_existing_exif()
+        test_exif_writer_leaves_xmp_and_iptc_to_exiftool()
+        test_exif_reader_jpeg_and_heif()
+        test_exif_reader_rejects_broken_files()
+        test_archive_members_stay_inside_the_output()
+        test_resume_after_interrupted_writes()
+        test_undo_from_another_folder()
+        test_undo_removes_placed_copies()
+        test_async_pipeline_matches_a_normal_run()
+        test_find_duplicates_hashes_only_what_it_has_to()
+        test_find_duplicates_in_the_library_index()
+        test_duplicates_report_where_the_original_went()
+        test_local_times_match_zoneinfo()
+        test_exiftool_pool_batches()
+        test_exiftool_pool_timeout_and_retry()
+        test_exiftool_pool_close_and_resize()
+        test_gpx_track_index()
+        test_gpx_readers()
+        test_rename_gpx_files()
+        test_report_from_journal()